@@ -0,0 +1,177 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Python version: 3.6
+# Buffered asynchronous (FedBuff) version of main_fed.py, compared with synchronous FedAvg
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import copy
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from torchvision import datasets, transforms
+import torch
+import wandb
+
+from utils.sampling import mnist_iid, mnist_non_iid, cifar_iid, cifar_non_iid
+from utils.options import args_parser, snn_model_options, client_model_args
+from utils.device import setup_device, model_to_device
+from models.Update import LocalUpdate
+from models.Fed import FedLearn, BufferedAggregator
+from models.buffered import ClientClock, History, train_buffered, train_synchronous
+from models.test import test_img
+import models.vgg as ann_models
+import models.vgg_spiking_bntt as snn_models_bntt
+from models.simple_conv_cf10 import Simple_CF10_BNTT, VGG5_CF10_NoBNTT
+from models.simple_conv_mnist import Simple_Mnist_BNTT, Simple_Mnist_NoBNTT, Simple_Mnist_BNTT_Rate
+
+
+if __name__ == '__main__':
+    # parse args
+    args = args_parser()
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    setup_device(args)
+
+    if args.wandb:
+        wandb.init(project=args.project, name=args.wandb,
+                    config={"epochs": args.epochs, "num_users": args.num_users, "frac_users": args.frac, "dataset": args.dataset, "alpha": args.alpha,
+                    "buffer_size": args.buffer_size, "async_concurrency": args.async_concurrency, "server_lr": args.server_lr, "client_speed_sigma": args.client_speed_sigma})
+
+    # load dataset and split users
+    if args.dataset == 'CIFAR10':
+        trans_cifar = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+        dataset_train = datasets.CIFAR10('../data/cifar', train=True, download=True, transform=trans_cifar)
+        dataset_test = datasets.CIFAR10('../data/cifar', train=False, download=True, transform=trans_cifar)
+        if args.iid:
+            dict_users = cifar_iid(dataset_train, args.num_users)
+        else:
+            dict_users = cifar_non_iid(dataset_train, args.num_classes, args.num_users, args.alpha)
+    elif args.dataset == 'CIFAR100':
+        trans_cifar = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
+        dataset_train = datasets.CIFAR100('../data/cifar100', train=True, download=True, transform=trans_cifar)
+        dataset_test = datasets.CIFAR100('../data/cifar100', train=False, download=True, transform=trans_cifar)
+        if args.iid:
+            dict_users = cifar_iid(dataset_train, args.num_users)
+        else:
+            dict_users = cifar_non_iid(dataset_train, args.num_classes, args.num_users, args.alpha)
+    elif args.dataset == 'MNIST':
+        trans_mnist = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))])
+        dataset_train = datasets.MNIST('../data/mnist', train=True, download=True, transform=trans_mnist)
+        dataset_test = datasets.MNIST('../data/mnist', train=False, download=True, transform=trans_mnist)
+        if args.iid:
+            dict_users = mnist_iid(dataset_train, args.num_users)
+        else:
+            dict_users = mnist_non_iid(dataset_train, args.num_classes, args.num_users, args.alpha)
+    elif args.dataset == 'EMNIST':
+        # same transform and splitting as MNIST
+        trans_mnist = transforms.Compose([transforms.ToTensor(), transforms.Normalize((0.1307,), (0.3081,))])
+        dataset_train = datasets.EMNIST('../data/emnist', 'bymerge', train=True, download=True, transform=trans_mnist)
+        dataset_test = datasets.EMNIST('../data/emnist', 'bymerge', train=False, download=True, transform=trans_mnist)
+        if args.iid:
+            dict_users = mnist_iid(dataset_train, args.num_users)
+        else:
+            dict_users = mnist_non_iid(dataset_train, args.num_classes, args.num_users, args.alpha)
+    else:
+        exit('Error: unrecognized dataset')
+
+    print("dict_users: ", [len(ds) for ds in dict_users.values()])
+
+    # build model
+    if args.model[0:3].lower() == 'vgg':
+        if args.snn:
+            model_cls = snn_models_bntt.SNN_VGG9_BNTT
+            model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps, **snn_model_options(args)}
+        else:
+            model_cls = ann_models.VGG
+            model_args = {'vgg_name': args.model, 'labels': args.num_classes, 'dataset': args.dataset, 'kernel_size': 3, 'dropout': args.dropout}
+    elif args.model == 'simple':
+        model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps, 'img_size': args.img_size, **snn_model_options(args)}
+        if args.dataset == 'MNIST' or args.dataset == 'EMNIST':
+            if args.bntt:
+                model_cls = Simple_Mnist_BNTT if args.direct else Simple_Mnist_BNTT_Rate
+            else:
+                model_args['leak_mem'] = 0.5
+                model_cls = Simple_Mnist_NoBNTT
+        else:
+            if args.bntt:
+                model_cls = Simple_CF10_BNTT
+            else:
+                model_args['leak_mem'] = 0.5
+                model_cls = VGG5_CF10_NoBNTT
+    else:
+        exit('Error: unrecognized model')
+    net_glob = model_to_device(model_cls(**model_args), args)
+    print(net_glob)
+
+    # copy weights
+    if args.pretrained_model:
+        net_glob.load_state_dict(torch.load(args.pretrained_model, map_location='cpu'))
+    w_init = copy.deepcopy(net_glob.state_dict())
+
+    def train_client(client, w, job):
+        # runs in a worker thread: its own data loader and model copy, whose encoder stream is derived from the job index
+        local = LocalUpdate(args=args, dataset=dataset_train, idxs=dict_users[client])
+        model_copy = model_cls(**client_model_args(model_args, args, job, client))
+        model_copy.load_state_dict(w)
+        model_copy = model_to_device(model_copy, args)
+        w_local, loss, trained_data_size = local.train(net=model_copy)
+        return copy.deepcopy(w_local)
+
+    def evaluate(w):
+        net_glob.load_state_dict(w)
+        net_glob.eval()
+        acc_test, loss_test = test_img(net_glob, dataset_test, args)
+        return float(acc_test)
+
+    # simulated training time: samples trained per participation, times a log-normal speed per client
+    work = [len(LocalUpdate(args=args, dataset=dataset_train, idxs=dict_users[idx]).ldr_train) * args.local_bs * args.local_ep
+            for idx in range(args.num_users)]
+    clock = ClientClock(work, args.client_speed_sigma, args.client_delay, args.seed)
+    m = max(int(args.frac * args.num_users), 1)
+    concurrency = args.async_concurrency or m
+    # both runs train the same number of clients: --epochs synchronous rounds of m clients
+    max_versions = max(args.epochs * m // args.buffer_size, 1)
+    # and are evaluated about as often: every --eval_every rounds of m updates
+    eval_every_versions = max(args.eval_every * m // args.buffer_size, 1)
+    print("FedBuff: {} clients training concurrently, an aggregate every {} updates, {} versions".format(concurrency, args.buffer_size, max_versions))
+
+    runs = {}
+    aggregator = BufferedAggregator(w_init, args.buffer_size, args.server_lr)
+    runs['FedBuff'] = train_buffered(aggregator, train_client, clock, args.num_users, concurrency, max_versions,
+                                     History(evaluate, args.target_acc), args.async_workers, eval_every_versions,
+                                     np.random.RandomState(args.seed))
+    if args.compare_sync:
+        runs['FedAvg'], w_glob = train_synchronous(FedLearn(args), w_init, train_client, clock, args.num_users, m, args.epochs,
+                                                   History(evaluate, args.target_acc), args.async_workers, args.eval_every,
+                                                   np.random.RandomState(args.seed))
+
+    for name, history in runs.items():
+        for record in history.records:
+            print("{} step {:d}, {:d} client updates, simulated time {:.2f}, real time {:.1f} s, Testing accuracy: {:.2f}".format(
+                name, record['step'], record['updates'], record['sim_time'], record['real_time'], record['acc']))
+            if args.wandb:
+                wandb.log({"{}_server_test_acc".format(name): record['acc'], "{}_sim_time".format(name): record['sim_time'],
+                           "{}_real_time".format(name): record['real_time'], "{}_updates".format(name): record['updates']})
+    if args.target_acc is not None:
+        for name, history in runs.items():
+            reached = history.time_to_target()
+            if reached is None:
+                print("{} did not reach {:.2f}% test accuracy".format(name, args.target_acc))
+            else:
+                print("{} reached {:.2f}% test accuracy after simulated time {:.2f}, real time {:.1f} s".format(name, args.target_acc, *reached))
+
+    Path('./{}'.format(args.result_dir)).mkdir(parents=True, exist_ok=True)
+    # plot accuracy against simulated time
+    plt.figure()
+    for name, history in runs.items():
+        plt.plot([record['sim_time'] for record in history.records], [record['acc'] for record in history.records])
+    plt.xlabel('simulated time')
+    plt.ylabel('Testing accuracy')
+    plt.legend(list(runs.keys()))
+    plt.savefig('./{}/async_acc_{}_{}_{}_C{}_iid{}.png'.format(args.result_dir, args.dataset, args.model, args.epochs, args.frac, args.iid))
+
+    # Write metric store into a CSV
+    metrics_df = pd.DataFrame([dict(record, engine=name) for name, history in runs.items() for record in history.records])
+    metrics_df.to_csv('./{}/async_stats_{}_{}_{}_C{}_iid{}.csv'.format(args.result_dir, args.dataset, args.model, args.epochs, args.frac, args.iid), sep='\t')
@@ -0,0 +1,845 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Python version: 3.6
+
+import argparse
+import copy
+import time
+import types
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.profiler import profile, ProfilerActivity
+
+import models.vgg as ann_models
+import models.vgg_spiking_bntt as snn_models_bntt
+from models.simple_conv_cf10 import Simple_CF10_BNTT, VGG5_CF10_NoBNTT
+from models.simple_conv_mnist import Simple_Mnist_BNTT, Simple_Mnist_NoBNTT, Simple_Mnist_BNTT_Rate
+from models.vgg_spiking_bntt_activity import LinearSpike
+from models.spiking import lif_step, truncated_backward
+from models.encoding import PoissonEncoder, RateEncoder, SpikeTrainCache
+from models.export import export_inference, calibrate_running_stats
+from models.quantize import quantize_inference
+from models.event_conv import event_conv2d
+from models.activity import ActivityRecorder
+from models.cost import OpCounter, ENERGY_MAC, ENERGY_AC
+from models.Fed import FedLearn, FlatState, BufferedAggregator, encode_update, average_payloads
+from models.buffered import ClientClock, History, train_buffered, train_synchronous
+from models.codec import UpdateCompressor, LowRankCompressor, ErrorFeedback
+from utils.device import setup_device, model_to_device, to_device, autocast
+
+
+def bench_args_parser():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', type=str, default='throughput', help="which benchmark to run")
+    parser.add_argument('--models', type=str, default='all', help="comma-separated model names, or all")
+    parser.add_argument('--bs', type=int, default=16, help="batch size")
+    parser.add_argument('--timesteps', type=int, default=5, help="simulation timesteps")
+    parser.add_argument('--timestep_list', type=str, default='10,20,25', help="comma-separated timesteps for the sweep benchmarks")
+    parser.add_argument('--iters', type=int, default=3, help="timed iterations per model")
+    parser.add_argument('--warmup', type=int, default=1, help="untimed warmup iterations per model")
+    parser.add_argument('--train', action='store_true', help="time forward + backward instead of inference")
+    parser.add_argument('--gpu', type=int, default=-1, help="GPU ID, -1 for CPU")
+    parser.add_argument('--num_threads', type=int, default=None, help="intra-op threads when running on CPU")
+    parser.add_argument('--num_interop_threads', type=int, default=None, help="inter-op threads when running on CPU")
+    parser.add_argument('--channels_last', action='store_true', help="use channels_last memory format")
+    parser.add_argument('--compile', action='store_true', help="compile the models with torch.compile")
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help="precision of the timed forward passes")
+    parser.add_argument('--fit_steps', type=int, default=30, help="SGD steps on a fixed batch for the precision benchmark")
+    parser.add_argument('--seed', type=int, default=1, help="random seed")
+    parser.add_argument('--checkpoint_list', type=str, default='0:0,1:0,5:0,0:1,0:3,5:3',
+                        help="comma-separated checkpoint_timesteps:checkpoint_layers pairs for the checkpoint benchmark")
+    parser.add_argument('--window_list', type=str, default='0,1,5', help="comma-separated truncated BPTT windows for the tbptt benchmark, 0 for full BPTT")
+    parser.add_argument('--margin_list', type=str, default='0.1,0.5,1', help="comma-separated early exit margins for the early_exit benchmark")
+    parser.add_argument('--patience', type=int, default=3, help="early exit patience for the early_exit benchmark")
+    parser.add_argument('--density_list', type=str, default='0.001,0.005,0.01,0.02,0.05,0.1,0.2', help="comma-separated spike densities for the event benchmark")
+    parser.add_argument('--sparse_threshold', type=float, default=0.005, help="density below which exported models run a layer event-driven")
+    parser.add_argument('--client_list', type=str, default='10,100,1000', help="comma-separated numbers of clients for the fedavg benchmark")
+    parser.add_argument('--num_clients', type=int, default=10, help="clients aggregated by the sparse benchmark")
+    parser.add_argument('--sparsity_list', type=str, default='90,99,99.9', help="comma-separated update sparsities (percent dropped) for the sparse benchmark")
+    parser.add_argument('--rounds', type=int, default=10, help="rounds of the simulated federated training of the codec benchmark")
+    parser.add_argument('--local_steps', type=int, default=5, help="SGD steps per client and round in the codec benchmark")
+    parser.add_argument('--lowrank_rank', type=int, default=4, help="rank of the lowrank codec in the codec benchmark")
+    parser.add_argument('--buffer_size', type=int, default=2, help="client updates per aggregate in the async benchmark")
+    parser.add_argument('--async_workers', type=int, default=1, help="worker threads that train the clients in the async benchmark")
+    parser.add_argument('--client_speed_sigma', type=float, default=1.0, help="standard deviation of the log-normal client speeds in the async benchmark")
+    parser.add_argument('--client_delay', type=float, default=0.0, help="real seconds a client of the async benchmark sleeps per unit of simulated time")
+    parser.add_argument('--target_acc', type=float, default=80.0, help="test accuracy the async benchmark times")
+    parser.add_argument('--lif_shape', type=str, default='128,16,16', help="C,H,W of the layer used by the lif benchmark")
+    return parser.parse_args()
+
+
+def build_models(timesteps, snn_options={}):
+    """
+    Returns {name: (constructor, model_args, input_shape)} for every model the entry scripts can build
+    """
+    cifar = (3, 32, 32)
+    mnist = (1, 28, 28)
+    snn_args = {'num_cls': 10, 'timesteps': timesteps, **snn_options}
+    return {
+        'SNN_VGG9_BNTT': (snn_models_bntt.SNN_VGG9_BNTT, dict(snn_args), cifar),
+        'Simple_CF10_BNTT': (Simple_CF10_BNTT, dict(snn_args, img_size=32), cifar),
+        'VGG5_CF10_NoBNTT': (VGG5_CF10_NoBNTT, dict(snn_args, img_size=32, leak_mem=0.5), cifar),
+        'Simple_Mnist_BNTT': (Simple_Mnist_BNTT, dict(snn_args, img_size=28), mnist),
+        'Simple_Mnist_BNTT_Rate': (Simple_Mnist_BNTT_Rate, dict(snn_args, img_size=28), mnist),
+        'Simple_Mnist_NoBNTT': (Simple_Mnist_NoBNTT, dict(snn_args, img_size=28, leak_mem=0.5), mnist),
+        'VGG9': (ann_models.VGG, {'vgg_name': 'VGG9', 'labels': 10, 'dataset': 'CIFAR10', 'kernel_size': 3, 'dropout': 0.2}, cifar),
+    }
+
+
+def selected_models(args, timesteps=None, snn_options={}, snn_only=False):
+    all_models = build_models(args.timesteps if timesteps is None else timesteps, snn_options)
+    if snn_only:
+        all_models.pop('VGG9')
+    if args.models == 'all':
+        return all_models
+    return {name: spec for name, spec in all_models.items() if name in args.models.split(',')}
+
+
+def make_batch(shape, args):
+    images = to_device(torch.rand(args.bs, *shape), args)
+    labels = torch.randint(0, 10, (args.bs,), device=args.device)
+    return images, labels
+
+
+def time_model(net, images, labels, args):
+    """
+    Average seconds per batch over args.iters runs after args.warmup untimed runs
+    """
+    loss_func = nn.CrossEntropyLoss()
+    elapsed = 0.0
+    for it in range(args.warmup + args.iters):
+        start = time.perf_counter()
+        if args.train:
+            net.zero_grad()
+            with autocast(args):
+                loss = loss_func(net(images), labels)
+            loss.backward()
+        else:
+            with torch.no_grad(), autocast(args):
+                net(images)
+        if args.device.type == 'cuda':
+            torch.cuda.synchronize(args.device)
+        if it >= args.warmup:
+            elapsed += time.perf_counter() - start
+    return elapsed / args.iters
+
+
+def bench_throughput(args):
+    """
+    Samples/sec of every model on args.device
+    """
+    print("{:<24s} {:>12s} {:>12s}".format("model", "sec/batch", "samples/sec"))
+    for name, (model_cls, model_args, shape) in selected_models(args).items():
+        net = model_to_device(model_cls(**model_args), args)
+        net.train(args.train)
+        images, labels = make_batch(shape, args)
+        sec = time_model(net, images, labels, args)
+        print("{:<24s} {:>12.4f} {:>12.1f}".format(name, sec, args.bs / sec))
+
+
+def bench_layer_major(args):
+    """
+    Samples/sec of the time-major and layer-major forward of every SNN for each T in --timestep_list
+    """
+    print("{:<24s} {:>6s} {:>14s} {:>14s} {:>8s}".format("model", "T", "time-major/s", "layer-major/s", "speedup"))
+    for timesteps in [int(x) for x in args.timestep_list.split(',')]:
+        for name in selected_models(args, timesteps, snn_only=True):
+            rates = []
+            for layer_major in (False, True):
+                model_cls, model_args, shape = selected_models(args, timesteps, {'layer_major': layer_major}, snn_only=True)[name]
+                net = model_to_device(model_cls(**model_args), args)
+                net.train(args.train)
+                images, labels = make_batch(shape, args)
+                rates.append(args.bs / time_model(net, images, labels, args))
+            print("{:<24s} {:>6d} {:>14.1f} {:>14.1f} {:>7.2f}x".format(name, timesteps, rates[0], rates[1], rates[1] / rates[0]))
+
+
+def bench_direct(args):
+    """
+    Samples/sec of every SNN with rate coding and with direct coding, where conv1 runs once per batch
+    """
+    print("{:<24s} {:>6s} {:>14s} {:>14s} {:>8s}".format("model", "T", "rate/s", "direct/s", "speedup"))
+    for timesteps in [int(x) for x in args.timestep_list.split(',')]:
+        for name in selected_models(args, timesteps, snn_only=True):
+            rates = []
+            for direct in (False, True):
+                model_cls, model_args, shape = selected_models(args, timesteps, {'direct': direct}, snn_only=True)[name]
+                net = model_to_device(model_cls(**model_args), args)
+                net.train(args.train)
+                images, labels = make_batch(shape, args)
+                rates.append(args.bs / time_model(net, images, labels, args))
+            print("{:<24s} {:>6d} {:>14.1f} {:>14.1f} {:>7.2f}x".format(name, timesteps, rates[0], rates[1], rates[1] / rates[0]))
+
+
+def peak_memory(fn, args):
+    """
+    Peak MB allocated while running fn, measured by the CUDA allocator or, on CPU, by the profiler
+    """
+    if args.device.type == 'cuda':
+        torch.cuda.synchronize(args.device)
+        base = torch.cuda.memory_allocated(args.device)
+        torch.cuda.reset_peak_memory_stats(args.device)
+        fn()
+        return (torch.cuda.max_memory_allocated(args.device) - base) / 2**20
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    events = sorted((e for e in prof.events() if e.self_cpu_memory_usage != 0), key=lambda e: e.time_range.start)
+    allocated = peak = 0
+    for e in events:
+        allocated += e.self_cpu_memory_usage
+        peak = max(peak, allocated)
+    return peak / 2**20
+
+
+def bench_checkpoint(args):
+    """
+    Time and peak memory of a training step of every BNTT SNN for each checkpoint setting in --checkpoint_list
+    """
+    args.train = True
+    loss_func = nn.CrossEntropyLoss()
+    print("{:<24s} {:>6s} {:>8s} {:>8s} {:>12s} {:>12s}".format("model", "T", "t-seg", "l-seg", "sec/batch", "peak MB"))
+    for name in selected_models(args, snn_only=True):
+        if 'NoBNTT' in name:
+            continue
+        for setting in args.checkpoint_list.split(','):
+            checkpoint_timesteps, checkpoint_layers = [int(x) for x in setting.split(':')]
+            snn_options = {'checkpoint_timesteps': checkpoint_timesteps, 'checkpoint_layers': checkpoint_layers}
+            model_cls, model_args, shape = selected_models(args, snn_options=snn_options, snn_only=True)[name]
+            net = model_to_device(model_cls(**model_args), args)
+            net.train()
+            images, labels = make_batch(shape, args)
+            sec = time_model(net, images, labels, args)
+            mb = peak_memory(lambda: loss_func(net(images), labels).backward(), args)
+            print("{:<24s} {:>6d} {:>8d} {:>8d} {:>12.4f} {:>12.1f}".format(name, args.timesteps, checkpoint_timesteps,
+                                                                         checkpoint_layers, sec, mb))
+
+
+def bench_tbptt(args):
+    """
+    Time and peak memory of a client training step of every BNTT SNN with full and truncated BPTT,
+    for each T in --timestep_list and window in --window_list
+    """
+    loss_func = nn.CrossEntropyLoss()
+    print("{:<24s} {:>6s} {:>8s} {:>12s} {:>12s}".format("model", "T", "window", "sec/batch", "peak MB"))
+    for timesteps in [int(x) for x in args.timestep_list.split(',')]:
+        for name, (model_cls, model_args, shape) in selected_models(args, timesteps, snn_only=True).items():
+            if 'NoBNTT' in name:
+                continue
+            net = model_to_device(model_cls(**model_args), args)
+            net.train()
+            images, labels = make_batch(shape, args)
+            for window in [int(x) for x in args.window_list.split(',')]:
+                if window:
+                    step = lambda: truncated_backward(net, loss_func, images, labels, window)
+                else:
+                    step = lambda: loss_func(net(images), labels).backward()
+                elapsed = 0.0
+                for it in range(args.warmup + args.iters):
+                    net.zero_grad()
+                    start = time.perf_counter()
+                    step()
+                    if args.device.type == 'cuda':
+                        torch.cuda.synchronize(args.device)
+                    if it >= args.warmup:
+                        elapsed += time.perf_counter() - start
+                mb = peak_memory(step, args)
+                print("{:<24s} {:>6d} {:>8d} {:>12.4f} {:>12.1f}".format(name, timesteps, window, elapsed / args.iters, mb))
+
+
+def bench_compress(args):
+    """
+    Time and peak memory of a training step of every SNN with float32 and with compressed saved activations,
+    for each T in --timestep_list
+    """
+    args.train = True
+    loss_func = nn.CrossEntropyLoss()
+    print("{:<24s} {:>6s} {:>12s} {:>12s} {:>12s} {:>12s} {:>10s}".format("model", "T", "float s/b", "compact s/b",
+                                                                         "float MB", "compact MB", "reduction"))
+    for timesteps in [int(x) for x in args.timestep_list.split(',')]:
+        for name in selected_models(args, timesteps, snn_only=True):
+            secs, mbs = [], []
+            for compress in (False, True):
+                model_cls, model_args, shape = selected_models(args, timesteps, {'compress_activations': compress}, snn_only=True)[name]
+                net = model_to_device(model_cls(**model_args), args)
+                net.train()
+                images, labels = make_batch(shape, args)
+                secs.append(time_model(net, images, labels, args))
+                mbs.append(peak_memory(lambda: loss_func(net(images), labels).backward(), args))
+            print("{:<24s} {:>6d} {:>12.4f} {:>12.4f} {:>12.1f} {:>12.1f} {:>9.2f}x".format(name, timesteps, secs[0], secs[1],
+                                                                                    mbs[0], mbs[1], mbs[0] / mbs[1]))
+
+
+def bench_early_exit(args):
+    """
+    Inference samples/sec and average timesteps of every BNTT SNN with the full T and with early exit
+    for each margin in --margin_list. With untrained weights the margins only show the cost side.
+    """
+    print("{:<24s} {:>8s} {:>12s} {:>12s} {:>12s}".format("model", "margin", "samples/sec", "avg T", "agreement"))
+    for name, (model_cls, model_args, shape) in selected_models(args, snn_only=True).items():
+        if 'NoBNTT' in name:
+            continue
+        net = model_to_device(model_cls(**model_args), args)
+        net.eval()
+        images, labels = make_batch(shape, args)
+        # early exit shrinks the batch, so the BNTT must not use batch statistics
+        calibrate_running_stats(net, [images])
+        with torch.no_grad():
+            full_pred = net(images).argmax(1)
+        sec = time_model(net, images, labels, args)
+        print("{:<24s} {:>8s} {:>12.1f} {:>12.2f} {:>12.2f}".format(name, "off", args.bs / sec, args.timesteps, 1.0))
+        for margin in [float(x) for x in args.margin_list.split(',')]:
+            elapsed = 0.0
+            with torch.no_grad():
+                for it in range(args.warmup + args.iters):
+                    start = time.perf_counter()
+                    out, timesteps = net.forward_early_exit(images, margin, args.patience)
+                    if args.device.type == 'cuda':
+                        torch.cuda.synchronize(args.device)
+                    if it >= args.warmup:
+                        elapsed += time.perf_counter() - start
+            agreement = (out.argmax(1) == full_pred).float().mean().item()
+            print("{:<24s} {:>8.2f} {:>12.1f} {:>12.2f} {:>12.2f}".format(name, margin, args.bs * args.iters / elapsed,
+                                                                       timesteps.float().mean().item(), agreement))
+
+
+def bench_encoder(args):
+    """
+    Cost of producing the input spikes of a CIFAR batch per timestep with each encoder, and of
+    replaying them from a bit-packed SpikeTrainCache
+    """
+    images = to_device(torch.rand(args.bs, 3, 32, 32) * 2 - 1, args)
+    cache = SpikeTrainCache(PoissonEncoder(seed=args.seed), [images], args.timesteps)
+    encoders = {
+        'poisson': PoissonEncoder(),
+        'poisson_seeded': PoissonEncoder(seed=args.seed),
+        'rate': RateEncoder(),
+        'cached': cache.replay(torch.arange(args.bs, device=args.device)),
+    }
+    print("{:<16s} {:>14s}".format("encoder", "ms/timestep"))
+    for name, encoder in encoders.items():
+        for it in range(args.warmup):
+            encoder(images, 0)
+        start = time.perf_counter()
+        for it in range(args.iters):
+            for t in range(args.timesteps):
+                encoder(images, t)
+        if args.device.type == 'cuda':
+            torch.cuda.synchronize(args.device)
+        print("{:<16s} {:>14.3f}".format(name, (time.perf_counter() - start) / (args.iters * args.timesteps) * 1000))
+    float_mb = images.numel() * images.element_size() * args.timesteps / 2**20
+    cache_mb = (cache.spikes.numel() + cache.negative.numel()) / 2**20
+    print("cache {:.2f} MB for {} images x {} timesteps ({:.2f} MB as float spikes)".format(cache_mb, args.bs, args.timesteps, float_mb))
+
+
+def bench_compile(args):
+    """
+    First-call time (compilation included) and steady-state sec/batch of every SNN compiled with
+    torch.compile, against eager, with the time-major and the layer-major forward. In inference mode
+    the BNTT models are also exported with BNTT folded and compiled with torch.jit.script.
+    """
+    # the eager baselines must not be compiled by model_to_device
+    args.compile = False
+
+    def first_and_steady(net, images, labels):
+        warmup, iters = args.warmup, args.iters
+        args.warmup, args.iters = 0, 1
+        first = time_model(net, images, labels, args)
+        args.warmup, args.iters = warmup, iters
+        return first, time_model(net, images, labels, args)
+
+    row = "{:<24s} {:>12s} {:>10.4f} {:>12.2f} {:>12.4f} {:>7.2f}x"
+    print("{:<24s} {:>12s} {:>10s} {:>12s} {:>12s} {:>8s}".format("model", "forward", "eager s/b", "1st call s",
+                                                                  "compiled s/b", "speedup"))
+    for name in selected_models(args, snn_only=True):
+        for layer_major in (False, True):
+            model_cls, model_args, shape = selected_models(args, snn_options={'layer_major': layer_major}, snn_only=True)[name]
+            net = model_to_device(model_cls(**model_args), args)
+            net.train(args.train)
+            images, labels = make_batch(shape, args)
+            eager = time_model(net, images, labels, args)
+            net.compile()
+            first, compiled = first_and_steady(net, images, labels)
+            print(row.format(name, 'layer-major' if layer_major else 'time-major', eager, first, compiled, eager / compiled))
+
+        if args.train or 'NoBNTT' in name:
+            continue
+        net.eval()
+        folded = model_to_device(export_inference(net, [images]), args)
+        eager = time_model(folded, images, labels, args)
+        start = time.perf_counter()
+        scripted = torch.jit.script(folded)
+        script_sec = time.perf_counter() - start
+        first, compiled = first_and_steady(scripted, images, labels)
+        print(row.format(name, 'folded jit', eager, script_sec + first, compiled, eager / compiled))
+
+
+def bench_precision(args):
+    """
+    Training sec/batch of every model in fp32 and with bf16 autocast, and the loss and accuracy both
+    reach after --fit_steps SGD steps on one fixed batch from the same initial weights
+    """
+    args.train = True
+    print("{:<24s} {:>10s} {:>10s} {:>8s} {:>16s} {:>16s}".format("model", "fp32 s/b", "bf16 s/b", "speedup",
+                                                                  "fp32 loss/acc", "bf16 loss/acc"))
+    for name, (model_cls, model_args, shape) in selected_models(args).items():
+        torch.manual_seed(args.seed)
+        initial = model_cls(**model_args).state_dict()
+        images, labels = make_batch(shape, args)
+        sec, fit = {}, {}
+        for precision in ('fp32', 'bf16'):
+            args.precision = precision
+            net = model_to_device(model_cls(**model_args), args)
+            net.load_state_dict(initial)
+            net.train()
+            sec[precision] = time_model(net, images, labels, args)
+            net.load_state_dict(initial)
+            optimizer = torch.optim.SGD(net.parameters(), lr=0.1, momentum=0.9)
+            for step in range(args.fit_steps):
+                optimizer.zero_grad()
+                with autocast(args):
+                    log_probs = net(images)
+                    loss = F.cross_entropy(log_probs, labels)
+                loss.backward()
+                optimizer.step()
+            accuracy = log_probs.argmax(1).eq(labels).float().mean().item() * 100
+            fit[precision] = "{:.3f}/{:.0f}%".format(loss.item(), accuracy)
+        print("{:<24s} {:>10.4f} {:>10.4f} {:>7.2f}x {:>16s} {:>16s}".format(
+            name, sec['fp32'], sec['bf16'], sec['fp32'] / sec['bf16'], fit['fp32'], fit['bf16']))
+
+
+def bench_activity(args):
+    """
+    Samples/sec of every SNN without and with an ActivityRecorder attached, and the recorded activity
+    """
+    print("{:<24s} {:>14s} {:>14s} {:>10s}  {}".format("model", "plain/s", "recorded/s", "overhead", "firing rate per layer"))
+    for name, (model_cls, model_args, shape) in selected_models(args, snn_only=True).items():
+        net = model_to_device(model_cls(**model_args), args)
+        net.train(args.train)
+        images, labels = make_batch(shape, args)
+        plain = args.bs / time_model(net, images, labels, args)
+        recorder = ActivityRecorder(net)
+        recorded = args.bs / time_model(net, images, labels, args)
+        activity = recorder.read()
+        recorder.remove()
+        print("{:<24s} {:>14.1f} {:>14.1f} {:>9.1f}%  {}".format(name, plain, recorded, (plain / recorded - 1) * 100,
+                                                              ' '.join('{:.3f}'.format(r) for r in activity['firing_rate'])))
+
+
+def per_key_fedavg(w, agg_weights, w_init):
+    """
+    FedAvgWeighted without stragglers and noise as a loop over keys and clients, the reference of bench_fedavg
+    """
+    w_avg = {}
+    for k in w_init.keys():
+        w_avg[k] = sum(w_init[k].cpu() + (w_i[k].cpu() - w_init[k].cpu()) * a for w_i, a in zip(w, agg_weights)) / len(w)
+    return w_avg
+
+
+def bench_fedavg(args):
+    """
+    Server aggregation time of SNN_VGG9_BNTT states for each number of clients of --client_list: the
+    flat-buffer FedAvg / FedAvgWeighted against a loop over keys and clients. The clients cycle
+    through 4 distinct states, so that 1000 of them fit in memory.
+    """
+    w_init = snn_models_bntt.SNN_VGG9_BNTT(timesteps=args.timesteps).state_dict()
+    states = [{k: v + 0.01 * torch.randn_like(v) for k, v in w_init.items()} for _ in range(4)]
+    fl = FedLearn(types.SimpleNamespace(straggler_prob=0.0, grad_noise_stdev=0.0))
+    print("{} tensors, {:.1f} MB per client".format(len(w_init), sum(v.numel() * v.element_size() for v in w_init.values()) / 2 ** 20))
+    print("{:<8s} {:>12s} {:>14s} {:>12s} {:>8s} {:>10s}".format("clients", "FedAvg s", "weighted s", "per-key s", "speedup", "max diff"))
+    for num_clients in [int(x) for x in args.client_list.split(',')]:
+        w = [states[i % len(states)] for i in range(num_clients)]
+        agg_weights = [0.5 + (i % 3) * 0.5 for i in range(num_clients)]
+        start = time.perf_counter()
+        fl.FedAvg(w, w_init=w_init)
+        sec_avg = time.perf_counter() - start
+        start = time.perf_counter()
+        w_avg = fl.FedAvgWeighted(w, agg_weights, w_init)
+        sec_weighted = time.perf_counter() - start
+        start = time.perf_counter()
+        reference = per_key_fedavg(w, agg_weights, w_init)
+        sec_reference = time.perf_counter() - start
+        diff = max((w_avg[k] - reference[k]).abs().max().item() for k in w_init)
+        print("{:<8d} {:>12.3f} {:>14.3f} {:>12.3f} {:>7.2f}x {:>10.2e}".format(
+            num_clients, sec_avg, sec_weighted, sec_reference, sec_reference / sec_weighted, diff))
+
+
+def bench_sparse(args):
+    """
+    Sparse aggregation of --num_clients SNN_VGG9_BNTT updates at each sparsity of --sparsity_list:
+    FedAvgSparse (per-tensor percentile threshold, dense masked updates) + count_gradients against
+    FedAvgTopK (top-k of the flattened update, SparsePayload). Upload per client: the dense masked
+    tensors against the encoded payload.
+    """
+    w_init = snn_models_bntt.SNN_VGG9_BNTT(timesteps=args.timesteps).state_dict()
+    deltas = [{k: 0.01 * torch.randn_like(v) for k, v in w_init.items()} for _ in range(args.num_clients)]
+    fl = FedLearn(types.SimpleNamespace(straggler_prob=0.0, grad_noise_stdev=0.0))
+    dense_mb = sum(v.numel() * v.element_size() for v in w_init.values()) / 2 ** 20
+    print("{:<10s} {:>10s} {:>10s} {:>8s} {:>12s} {:>12s} {:>12s} {:>12s}".format(
+        "sparsity", "masked s", "top-k s", "speedup", "masked nnz", "top-k nnz", "masked MB", "payload MB"))
+    for sparsity in [float(x) for x in args.sparsity_list.split(',')]:
+        start = time.perf_counter()
+        w_avg, delta_w_avg, sparse_deltas = fl.FedAvgSparse(w_init, deltas, "magnitude", "uniform", sparsity)
+        num_grads, nz_grads = fl.count_gradients(deltas, sparse_deltas)
+        sec_masked = time.perf_counter() - start
+        start = time.perf_counter()
+        w_avg, delta_w_avg, payloads = fl.FedAvgTopK(w_init, deltas, sparsity)
+        sec_topk = time.perf_counter() - start
+        print("{:<10.1f} {:>10.3f} {:>10.3f} {:>7.2f}x {:>12d} {:>12d} {:>12.2f} {:>12.3f}".format(
+            sparsity, sec_masked, sec_topk, sec_masked / sec_topk, nz_grads[0], payloads[0].values.numel(),
+            dense_mb, payloads[0].nbytes / 2 ** 20))
+
+
+def local_sgd(net, w, images, labels, steps):
+    """
+    State of a client after `steps` SGD steps on its batch, starting from the global state w
+    """
+    net.load_state_dict(w)
+    net.train()
+    optimizer = torch.optim.SGD(net.parameters(), lr=0.05, momentum=0.9)
+    for step in range(steps):
+        optimizer.zero_grad()
+        F.cross_entropy(net(images), labels).backward()
+        optimizer.step()
+    return copy.deepcopy(net.state_dict())
+
+
+def federated_fit(args, model_cls, model_args, shape, aggregate):
+    """
+    Simulated federated training: each of --num_clients clients holds one fixed random batch and runs
+    --local_steps SGD steps from the global weights every round, for --rounds rounds
+    :param aggregate: (client states, global state) -> (new global state, bytes uploaded)
+    :return: (loss and accuracy of the global model on all the client batches, bytes uploaded per round)
+    """
+    torch.manual_seed(args.seed)
+    net = model_to_device(model_cls(**model_args), args)
+    batches = [make_batch(shape, args) for _ in range(args.num_clients)]
+    w_glob = copy.deepcopy(net.state_dict())
+    upload = 0
+    for round_idx in range(args.rounds):
+        w_locals = [local_sgd(net, w_glob, images, labels, args.local_steps) for images, labels in batches]
+        w_glob, round_upload = aggregate(w_locals, w_glob)
+        upload += round_upload
+    net.load_state_dict(w_glob)
+    net.eval()
+    images, labels = torch.cat([b[0] for b in batches]), torch.cat([b[1] for b in batches])
+    with torch.no_grad():
+        log_probs = net(images)
+    return F.cross_entropy(log_probs, labels).item(), log_probs.argmax(1).eq(labels).float().mean().item() * 100, upload / args.rounds
+
+
+def bench_codec(args):
+    """
+    Upload per round, encode / decode time per client and final fit of simulated federated training
+    (see federated_fit) with each --update_codec (lowrank with --lowrank_rank), with and without
+    error feedback, against uncompressed FedAvg
+    """
+    name = 'Simple_Mnist_BNTT' if args.models == 'all' else args.models.split(',')[0]
+    model_cls, model_args, shape = build_models(args.timesteps)[name]
+    fl = FedLearn(types.SimpleNamespace(straggler_prob=0.0, grad_noise_stdev=0.0))
+    shapes = FlatState(model_cls(**model_args).state_dict()).shapes
+
+    # seconds spent encoding and decoding by every run
+    seconds = {}
+
+    def dense(w_locals, w_init):
+        return fl.FedAvg(w_locals, w_init=w_init), len(w_locals) * sum(v.numel() * v.element_size() for v in w_init.values())
+
+    def compressed(label, codec, error_feedback):
+        seconds[label] = [0.0, 0.0]
+        error_feedback = ErrorFeedback() if error_feedback else None
+        if codec == 'lowrank':
+            compressor = LowRankCompressor(shapes, args.lowrank_rank, error_feedback, args.seed)
+        else:
+            compressor = UpdateCompressor(codec, error_feedback=error_feedback, seed=args.seed)
+
+        def aggregate(w_locals, w_init):
+            start = time.perf_counter()
+            payloads = [encode_update(compressor, w, w_init, client=i) for i, w in enumerate(w_locals)]
+            encoded = time.perf_counter()
+            w_avg = average_payloads(payloads, w_init)
+            seconds[label][0] += encoded - start
+            seconds[label][1] += time.perf_counter() - encoded
+            return w_avg, sum(payload.nbytes for payload in payloads)
+        return aggregate
+
+    print("{}, {} clients, {} rounds of {} local steps".format(name, args.num_clients, args.rounds, args.local_steps))
+    print("{:<14s} {:>14s} {:>8s} {:>10s} {:>10s} {:>10s} {:>8s}".format("codec", "MB/round", "ratio", "enc ms", "dec ms", "loss", "acc"))
+    runs = [('fp32', dense)]
+    for codec in ('q8', 'q4', 'q2', 'sign', 'lowrank'):
+        for error_feedback in (False, True):
+            label = codec + (' + EF' if error_feedback else '')
+            runs.append((label, compressed(label, codec, error_feedback)))
+    # per client: every one is encoded and decoded once per round
+    dense_upload = None
+    for label, aggregate in runs:
+        loss, accuracy, upload = federated_fit(args, model_cls, model_args, shape, aggregate)
+        dense_upload = upload if dense_upload is None else dense_upload
+        encode, decode = [1e3 * t / (args.rounds * args.num_clients) for t in seconds.get(label, (0.0, 0.0))]
+        print("{:<14s} {:>14.4f} {:>7.1f}x {:>10.2f} {:>10.2f} {:>10.3f} {:>7.1f}%".format(
+            label, upload / 2 ** 20, dense_upload / upload, encode, decode, loss, accuracy))
+
+
+def bench_async(args):
+    """
+    Simulated and real time to --target_acc of buffered asynchronous training (FedBuff) against
+    synchronous FedAvg. --num_clients clients hold a batch of two classes each of a synthetic task
+    (noisy class templates) and train --local_steps SGD steps per participation, with log-normal
+    speeds (--client_speed_sigma), slept on the real clock with --client_delay. FedAvg runs --rounds rounds of half the clients; FedBuff keeps as
+    many training at once, trains the same number of clients in total and is evaluated about as often.
+    """
+    name = 'Simple_Mnist_BNTT' if args.models == 'all' else args.models.split(',')[0]
+    model_cls, model_args, shape = build_models(args.timesteps)[name]
+    torch.manual_seed(args.seed)
+    templates = torch.rand(10, *shape)
+
+    def samples(labels):
+        images = 0.6 * templates[labels] + 0.4 * torch.rand(len(labels), *shape)
+        return to_device(images, args), labels.to(args.device)
+
+    batches = [samples(torch.tensor([2 * c % 10, (2 * c + 1) % 10]).repeat(args.bs)[torch.randperm(2 * args.bs)[:args.bs]])
+               for c in range(args.num_clients)]
+    test_images, test_labels = samples(torch.arange(10).repeat(20))
+    net_eval = model_to_device(model_cls(**model_args), args)
+    w_init = copy.deepcopy(net_eval.state_dict())
+
+    def train_client(client, w, job):
+        # a model per call, the clients train in several threads
+        return local_sgd(model_to_device(model_cls(**model_args), args), w, *batches[client], args.local_steps)
+
+    def evaluate(w):
+        net_eval.load_state_dict(w)
+        net_eval.eval()
+        with torch.no_grad():
+            return net_eval(test_images).argmax(1).eq(test_labels).float().mean().item() * 100
+
+    clock = ClientClock([1] * args.num_clients, args.client_speed_sigma, args.client_delay, args.seed)
+    m = max(args.num_clients // 2, 1)
+    fl = FedLearn(types.SimpleNamespace(straggler_prob=0.0, grad_noise_stdev=0.0))
+    runs = {}
+    runs['FedAvg'], _ = train_synchronous(fl, w_init, train_client, clock, args.num_clients, m, args.rounds,
+                                          History(evaluate, args.target_acc), args.async_workers, rng=np.random.RandomState(args.seed))
+    runs['FedBuff K={}'.format(args.buffer_size)] = train_buffered(
+        BufferedAggregator(w_init, args.buffer_size), train_client, clock, args.num_clients, m,
+        max(args.rounds * m // args.buffer_size, 1), History(evaluate, args.target_acc), args.async_workers,
+        eval_every=max(m // args.buffer_size, 1), rng=np.random.RandomState(args.seed))
+
+    print("{}, {} clients, {} training at once, {} worker threads, target {:.1f}%".format(name, args.num_clients, m, args.async_workers, args.target_acc))
+    print("{:<14s} {:>10s} {:>12s} {:>12s} {:>10s} {:>10s}".format("", "updates", "sim time", "real time s", "final acc", "versions"))
+    for label, history in runs.items():
+        reached = [r for r in history.records if r['acc'] >= args.target_acc]
+        record = reached[0] if reached else history.records[-1]
+        print("{:<14s} {:>10d} {:>12.2f} {:>12.2f} {:>9.1f}% {:>10d}{}".format(
+            label, record['updates'], record['sim_time'], record['real_time'], history.records[-1]['acc'],
+            history.records[-1]['step'], '' if reached else '  (target not reached)'))
+
+
+def bench_cost(args):
+    """
+    MACs, SynOps and energy per inference of every model on a random batch, SNNs at args.timesteps
+    """
+    print("{:<24s} {:>14s} {:>14s} {:>14s}".format("model", "MACs", "SynOps", "energy uJ"))
+    for name, (model_cls, model_args, shape) in selected_models(args).items():
+        net = model_to_device(model_cls(**model_args), args)
+        net.eval()
+        images, labels = make_batch(shape, args)
+        counter = OpCounter(net, spiking=name != 'VGG9')
+        with torch.no_grad():
+            net(images)
+        cost = counter.read(ENERGY_MAC, ENERGY_AC)
+        counter.remove()
+        print("{:<24s} {:>14.4g} {:>14.4g} {:>14.2f}".format(name, cost['macs_per_inference'], cost['synops_per_inference'],
+                                                             cost['energy_per_inference'] / 1e6))
+
+
+def bench_fold(args):
+    """
+    Inference latency of every BNTT SNN against its export_inference module with BNTT folded into
+    per-timestep weights (models without running stats are calibrated on the benchmark batch)
+    """
+    args.train = False
+    print("{:<24s} {:>14s} {:>14s} {:>8s}".format("model", "module ms", "folded ms", "speedup"))
+    for name, (model_cls, model_args, shape) in selected_models(args, snn_only=True).items():
+        if 'NoBNTT' in name:
+            continue
+        net = model_to_device(model_cls(**model_args), args)
+        net.eval()
+        images, labels = make_batch(shape, args)
+        folded = model_to_device(export_inference(net, [images]), args)
+        sec = time_model(net, images, labels, args)
+        sec_folded = time_model(folded, images, labels, args)
+        print("{:<24s} {:>14.2f} {:>14.2f} {:>7.2f}x".format(name, sec * 1000, sec_folded * 1000, sec / sec_folded))
+
+
+def bench_quant(args):
+    """
+    Inference latency of SNN_VGG9_BNTT and the Simple SNNs against their integer inference module,
+    with the agreement of the predictions and the relative error of the output voltages. Random
+    weights and inputs; the accuracy of a trained model is reported by main_fed.py --quantize.
+    """
+    args.train = False
+    print("{:<24s} {:>12s} {:>12s} {:>8s} {:>10s} {:>10s}".format("model", "fp32 ms", "int ms", "speedup", "agreement", "rel err"))
+    for name, (model_cls, model_args, shape) in selected_models(args, snn_only=True).items():
+        if name == 'VGG5_CF10_NoBNTT':
+            continue
+        net = model_to_device(model_cls(**model_args), args)
+        net.encoder = RateEncoder()
+        net.eval()
+        images, labels = make_batch(shape, args)
+        quantized = quantize_inference(net, [images])
+        reference = export_inference(net, [images]) if hasattr(net, 'bntt_list') else net
+        sec = time_model(reference, images, labels, args)
+        sec_int = time_model(quantized, images, labels, args)
+        with torch.no_grad():
+            out, out_int = reference(images), quantized(images)
+        agreement = out.argmax(1).eq(out_int.argmax(1)).float().mean().item()
+        error = ((out_int - out).norm() / out.norm().clamp(min=1e-12)).item()
+        print("{:<24s} {:>12.2f} {:>12.2f} {:>7.2f}x {:>10.3f} {:>10.4f}".format(
+            name, sec * 1000, sec_int * 1000, sec / sec_int, agreement, error))
+
+
+def bench_latency(args):
+    """
+    Single-sample inference of the BNTT SNNs after calibrate_running_stats (a no-op for the models
+    that track running stats): batch-size-1 latency against the per-sample time at --bs, and how
+    the outputs of the batch compare with those of its samples run one by one. They only differ by
+    fp32 rounding of the batched kernels, which can flip a spike close to threshold.
+    """
+    args.train = False
+    print("{:<24s} {:>12s} {:>14s} {:>10s} {:>12s}".format("model", "bs 1 ms", "bs {} ms/img".format(args.bs), "agreement", "max diff"))
+    for name, (model_cls, model_args, shape) in selected_models(args, snn_only=True).items():
+        if 'NoBNTT' in name:
+            continue
+        net = model_to_device(model_cls(**model_args), args)
+        net.encoder = RateEncoder()
+        net.eval()
+        images, labels = make_batch(shape, args)
+        calibrate_running_stats(net, [images])
+        sec_single = time_model(net, images[:1], labels[:1], args)
+        sec = time_model(net, images, labels, args)
+        with torch.no_grad():
+            out = net(images)
+            out_single = torch.cat([net(images[i:i + 1]) for i in range(images.size(0))])
+        agreement = out.argmax(1).eq(out_single.argmax(1)).float().mean().item()
+        print("{:<24s} {:>12.2f} {:>14.2f} {:>10.3f} {:>12.2e}".format(
+            name, sec_single * 1000, sec / args.bs * 1000, agreement, (out - out_single).abs().max().item()))
+
+
+def bench_event(args):
+    """
+    Dense F.conv2d against event_conv2d on spike maps of --lif_shape at each density of --density_list,
+    then every exported BNTT SNN with and without --sparse_threshold
+    """
+    channels, height, width = [int(x) for x in args.lif_shape.split(',')]
+    weight = torch.randn(channels, channels, 3, 3, device=args.device)
+    print("{:<10s} {:>12s} {:>12s} {:>8s}".format("density", "dense ms", "event ms", "speedup"))
+    for density in [float(x) for x in args.density_list.split(',')]:
+        spikes = (torch.rand(args.bs, channels, height, width, device=args.device) < density).float()
+        times = []
+        for conv in (F.conv2d, event_conv2d):
+            for it in range(args.warmup):
+                conv(spikes, weight, None, 1, 1)
+            start = time.perf_counter()
+            for it in range(args.iters):
+                conv(spikes, weight, None, 1, 1)
+            if args.device.type == 'cuda':
+                torch.cuda.synchronize(args.device)
+            times.append((time.perf_counter() - start) / args.iters * 1000)
+        print("{:<10.4f} {:>12.3f} {:>12.3f} {:>7.2f}x".format(density, times[0], times[1], times[0] / times[1]))
+
+    args.train = False
+    print("{:<24s} {:>14s} {:>14s} {:>8s}".format("model", "dense ms", "adaptive ms", "speedup"))
+    for name, (model_cls, model_args, shape) in selected_models(args, snn_only=True).items():
+        if 'NoBNTT' in name:
+            continue
+        net = model_to_device(model_cls(**model_args), args)
+        net.eval()
+        images, labels = make_batch(shape, args)
+        dense = export_inference(net, [images])
+        adaptive = export_inference(net, [images], sparse_threshold=args.sparse_threshold)
+        sec = time_model(dense, images, labels, args)
+        sec_adaptive = time_model(adaptive, images, labels, args)
+        print("{:<24s} {:>14.2f} {:>14.2f} {:>7.2f}x".format(name, sec * 1000, sec_adaptive * 1000, sec / sec_adaptive))
+
+
+def unfused_lif_step(current, mem, leak, threshold):
+    """
+    The per-layer LIF block the models used before lif_step, kept as the baseline
+    """
+    mem = current + leak * mem
+    mem_thr = (mem / threshold) - 1.0
+    out = LinearSpike.apply(mem_thr)
+    rst = torch.zeros_like(mem)
+    rst[mem_thr > 0] = threshold
+    mem = mem - rst
+    return out.clone(), mem
+
+
+def run_lif(step_fn, currents, mem, leak):
+    loss = 0
+    for current in currents:
+        out, mem = step_fn(current, mem, leak, 1.0)
+        loss = loss + out.sum()
+    loss.backward()
+
+
+def bench_lif(args):
+    """
+    Time and allocations per timestep of one layer of LIF neurons, fused vs unfused (forward + backward)
+    """
+    shape = [args.bs] + [int(x) for x in args.lif_shape.split(',')]
+    currents = [(1.5 * torch.randn(shape, device=args.device)).requires_grad_() for t in range(args.timesteps)]
+    step_fns = {
+        'unfused': (unfused_lif_step, torch.zeros(shape, device=args.device)),
+        'lif_step': (lif_step, None),
+    }
+    print("{:<10s} {:>14s} {:>14s} {:>14s}".format("lif", "ms/step", "allocs/step", "MB/step"))
+    for name, (step_fn, mem) in step_fns.items():
+        for it in range(args.warmup):
+            run_lif(step_fn, currents, mem, 0.95)
+        start = time.perf_counter()
+        for it in range(args.iters):
+            run_lif(step_fn, currents, mem, 0.95)
+        if args.device.type == 'cuda':
+            torch.cuda.synchronize(args.device)
+        ms = (time.perf_counter() - start) / (args.iters * args.timesteps) * 1000
+
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            run_lif(step_fn, currents, mem, 0.95)
+        allocs = [e.self_cpu_memory_usage for e in prof.events() if e.name != '[memory]' and e.self_cpu_memory_usage > 0]
+        print("{:<10s} {:>14.3f} {:>14.1f} {:>14.2f}".format(name, ms, len(allocs) / args.timesteps,
+                                                         sum(allocs) / args.timesteps / 2**20))
+
+
+BENCHMARKS = {
+    'throughput': bench_throughput,
+    'lif': bench_lif,
+    'layer_major': bench_layer_major,
+    'direct': bench_direct,
+    'checkpoint': bench_checkpoint,
+    'tbptt': bench_tbptt,
+    'compress': bench_compress,
+    'early_exit': bench_early_exit,
+    'encoder': bench_encoder,
+    'activity': bench_activity,
+    'compile': bench_compile,
+    'precision': bench_precision,
+    'quant': bench_quant,
+    'latency': bench_latency,
+    'fedavg': bench_fedavg,
+    'sparse': bench_sparse,
+    'codec': bench_codec,
+    'async': bench_async,
+    'cost': bench_cost,
+    'fold': bench_fold,
+    'event': bench_event,
+}
+
+
+if __name__ == '__main__':
+    args = bench_args_parser()
+    torch.manual_seed(args.seed)
+    setup_device(args)
+    BENCHMARKS[args.bench](args)
@@ -17,13 +17,14 @@ import torch.nn as nn
 import wandb
 
 from utils.sampling import mnist_iid, mnist_non_iid, cifar_iid, cifar_non_iid
-from utils.options import args_parser
+from utils.options import args_parser, snn_model_options
+from utils.device import setup_device, model_to_device, to_device, autocast
 from models.Update import LocalUpdate, DatasetSplit
 from models.Fed import FedLearn
 from models.Fed import model_deviation
 from models.test import test_img
 import models.vgg_spiking_bntt as snn_models_bntt
-from models.simple_conv_cf10 import Simple_CF10_BNTT
+from models.simple_conv_cf10 import Simple_CF10_BNTT, VGG5_CF10_NoBNTT
 from models.simple_conv_mnist import Simple_Mnist_BNTT, Simple_Mnist_NoBNTT, Simple_Mnist_BNTT_Rate
 import models.client_selection as client_selection
 import models.candidate_selection as candidate_selection
@@ -42,10 +43,7 @@ if __name__ == '__main__':
     args = args_parser()
     torch.manual_seed(args.seed)
     np.random.seed(args.seed)
-    args.device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() and args.gpu != -1 else 'cpu')
-    if args.device != 'cpu':
-        torch.backends.cudnn.deterministic = True
-        torch.backends.cudnn.benchmark = False
+    setup_device(args)
     # torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
     if args.wandb:
@@ -89,25 +87,25 @@ if __name__ == '__main__':
     model_args = {'args': args}
     if args.model[0:3].lower() == 'vgg':
         if args.snn:
-            model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps}
-            net = snn_models_bntt.SNN_VGG9_BNTT(**model_args).cuda()
+            model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps, **snn_model_options(args)}
+            net = model_to_device(snn_models_bntt.SNN_VGG9_BNTT(**model_args), args)
     elif args.model == 'simple':
-        model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps, 'img_size': args.img_size}
+        model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps, 'img_size': args.img_size, **snn_model_options(args)}
         if args.dataset == 'EMNIST':
             if args.bntt:
                 if args.direct:
-                    net = Simple_Mnist_BNTT(**model_args).cuda()
+                    net = model_to_device(Simple_Mnist_BNTT(**model_args), args)
                 else:
-                    net = Simple_Mnist_BNTT_Rate(**model_args).cuda()
+                    net = model_to_device(Simple_Mnist_BNTT_Rate(**model_args), args)
             else:
                 model_args['leak_mem'] = 0.5
-                net = Simple_Mnist_NoBNTT(**model_args).cuda()
+                net = model_to_device(Simple_Mnist_NoBNTT(**model_args), args)
         else:
             if args.bntt:
-                net = Simple_CF10_BNTT(**model_args).cuda()
+                net = model_to_device(Simple_CF10_BNTT(**model_args), args)
             else:
                 model_args['leak_mem'] = 0.5
-                net = VGG5_CF10_NoBNTT(**model_args).cuda()
+                net = model_to_device(VGG5_CF10_NoBNTT(**model_args), args)
     else:
         exit('Error: unrecognized model')
     print(net)
@@ -145,11 +143,12 @@ if __name__ == '__main__':
             print("local epoch: ", local_ep)
             batch_loss = []
             for batch_idx, (images, labels) in enumerate(ldr_train):
-                images, labels = images.to(args.device), labels.to(args.device)
+                images, labels = to_device(images, args), labels.to(args.device)
                 trained_data_size += len(images)
                 net.zero_grad()
-                log_probs = net(images)
-                loss = loss_func(log_probs, labels)
+                with autocast(args):
+                    log_probs = net(images)
+                    loss = loss_func(log_probs, labels)
                 loss.backward()
                 optimizer.step()
                 if args.verbose and batch_idx % 10 == 0:
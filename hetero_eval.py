@@ -17,14 +17,15 @@ import wandb
 from statistics import pstdev
 
 from utils.sampling import mnist_iid, mnist_non_iid, cifar_iid, cifar_non_iid
-from utils.options import args_parser
+from utils.options import args_parser, snn_model_options, client_model_args
+from utils.device import setup_device, model_to_device
 from models.Update import LocalUpdate, DatasetSplit
 from models.Fed import FedLearn
 from models.Fed import model_deviation
-from models.test import test_img
+from models.test import test_img, test_img_horizons
 import models.vgg_spiking_bntt as snn_models_bntt
 # import models.vgg as ann_models
-# from models.simple_conv_cf10 import Simple_CF10_BNTT
+# from models.simple_conv_cf10 import Simple_CF10_BNTT, VGG5_CF10_NoBNTT
 # from models.simple_conv_mnist import Simple_Mnist_BNTT, Simple_Mnist_NoBNTT, Simple_Mnist_BNTT_Rate
 
 import tables
@@ -41,10 +42,7 @@ if __name__ == '__main__':
     args = args_parser()
     torch.manual_seed(args.seed)
     np.random.seed(args.seed)
-    args.device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() and args.gpu != -1 else 'cpu')
-    if args.device != 'cpu':
-        torch.backends.cudnn.deterministic = True
-        torch.backends.cudnn.benchmark = False
+    setup_device(args)
     # torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
     if args.wandb:
@@ -92,28 +90,28 @@ if __name__ == '__main__':
     model_args = {'args': args}
     if args.model[0:3].lower() == 'vgg':
         if args.snn:
-            model_args = {'num_cls': args.num_classes, 'timesteps': args.timestep_mean, 'max_timestep': max_timestep, 'img_size': args.img_size}
-            net_glob = snn_models_bntt.SNN_VGG9_BNTT(**model_args).cuda()
+            model_args = {'num_cls': args.num_classes, 'timesteps': args.timestep_mean, 'max_timestep': max_timestep, 'img_size': args.img_size, **snn_model_options(args)}
+            net_glob = model_to_device(snn_models_bntt.SNN_VGG9_BNTT(**model_args), args)
         else:
             model_args = {'vgg_name': args.model, 'labels': args.num_classes, 'dataset': args.dataset, 'kernel_size': 3, 'dropout': args.dropout}
-            net_glob = ann_models.VGG(**model_args).cuda()
+            net_glob = model_to_device(ann_models.VGG(**model_args), args)
     elif args.model == 'simple':
-        model_args = {'num_cls': args.num_classes, 'timesteps': args.timestep_mean, 'max_timestep': max_timestep, 'img_size': args.img_size}
+        model_args = {'num_cls': args.num_classes, 'timesteps': args.timestep_mean, 'max_timestep': max_timestep, 'img_size': args.img_size, **snn_model_options(args)}
         if args.dataset == 'EMNIST':
             if args.bntt:
                 if args.direct:
-                    net_glob = Simple_Mnist_BNTT(**model_args).cuda()
+                    net_glob = model_to_device(Simple_Mnist_BNTT(**model_args), args)
                 else:
-                    net_glob = Simple_Mnist_BNTT_Rate(**model_args).cuda()
+                    net_glob = model_to_device(Simple_Mnist_BNTT_Rate(**model_args), args)
             else:
                 model_args['leak_mem'] = 0.5
-                net_glob = Simple_Mnist_NoBNTT(**model_args).cuda()
+                net_glob = model_to_device(Simple_Mnist_NoBNTT(**model_args), args)
         else:
             if args.bntt:
-                net_glob = Simple_CF10_BNTT(**model_args).cuda()
+                net_glob = model_to_device(Simple_CF10_BNTT(**model_args), args)
             else:
                 model_args['leak_mem'] = 0.5
-                net_glob = VGG5_CF10_NoBNTT(**model_args).cuda()
+                net_glob = model_to_device(VGG5_CF10_NoBNTT(**model_args), args)
     else:
         exit('Error: unrecognized model')
     # print(net_glob)
@@ -185,15 +183,17 @@ if __name__ == '__main__':
 
         for counter, idx in enumerate(chosen_users):
             local = LocalUpdate(args=args, dataset=dataset_train, idxs=dict_users[idx]) # idxs needs the list of indices assigned to this particular client
-            model_args = {'num_cls': args.num_classes, 'timesteps': max(1, round(timesteps_list[idx])), 'max_timestep': max_timestep}
-            model_copy = type(net_glob.module)(**model_args) # get a new instance
+            timesteps = max(1, round(timesteps_list[idx]))
+            # the replica only builds the BNTT slots of its own timesteps
+            model_args = {'num_cls': args.num_classes, 'timesteps': timesteps, 'max_timestep': max_timestep, 'bntt_slots': timesteps, **snn_model_options(args)}
+            model_copy = type(net_glob.module)(**client_model_args(model_args, args, iter, idx)) # get a new instance
             model_copy = nn.DataParallel(model_copy)
             model_copy.load_state_dict(net_glob.state_dict()) # copy weights and stuff
 
-            # tmp_acc, tmp_loss = local.test_with_train_data(net=model_copy.to(args.device))
+            # tmp_acc, tmp_loss = local.test_with_train_data(net=model_to_device(model_copy, args))
             # print("Estimate loss: ", tmp_loss)
 
-            w, loss, trained_data_size = local.train(net=model_copy.to(args.device))
+            w, loss, trained_data_size = local.train(net=model_to_device(model_copy, args))
             w_locals_all.append(copy.deepcopy(w))
             loss_locals_all.append(copy.deepcopy(loss))
             trained_data_size_all.append(trained_data_size)
@@ -235,11 +235,12 @@ if __name__ == '__main__':
             # testing
             net_glob.eval()
             avg_train_acc, avg_train_loss, avg_test_acc, avg_test_loss = [], [], [], []
-            for ts in [15, 20, 25]:
-                net_glob.module.set_timestep(ts)
-                acc_train, loss_train = test_img(net_glob, dataset_train, args)
+            eval_timesteps = [15, 20, 25]
+            # one simulation to 25 timesteps, read out at 15, 20 and 25
+            train_results = test_img_horizons(net_glob, dataset_train, args, eval_timesteps)
+            test_results = test_img_horizons(net_glob, dataset_test, args, eval_timesteps)
+            for ts, (acc_train, loss_train), (acc_test, loss_test) in zip(eval_timesteps, train_results, test_results):
                 print("Round {:d}, Timestep {}, Training accuracy: {:.2f}".format(iter+1, ts, acc_train))
-                acc_test, loss_test = test_img(net_glob, dataset_test, args)
                 print("Round {:d}, Timestep {}, Testing accuracy: {:.2f}".format(iter+1, ts, acc_test))
                 avg_train_acc.append(acc_train)
                 avg_train_loss.append(loss_train)
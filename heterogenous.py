@@ -17,14 +17,15 @@ import wandb
 from statistics import pstdev
 
 from utils.sampling import mnist_iid, mnist_non_iid, cifar_iid, cifar_non_iid
-from utils.options import args_parser
+from utils.options import args_parser, snn_model_options, client_model_args
+from utils.device import setup_device, model_to_device
 from models.Update import LocalUpdate, DatasetSplit
-from models.Fed import FedLearn
+from models.Fed import FedLearn, StreamingAggregator
 from models.Fed import model_deviation
 from models.test import test_img
 import models.vgg_spiking_bntt as snn_models_bntt
 # import models.vgg as ann_models
-# from models.simple_conv_cf10 import Simple_CF10_BNTT
+# from models.simple_conv_cf10 import Simple_CF10_BNTT, VGG5_CF10_NoBNTT
 # from models.simple_conv_mnist import Simple_Mnist_BNTT, Simple_Mnist_NoBNTT, Simple_Mnist_BNTT_Rate
 
 import tables
@@ -41,10 +42,7 @@ if __name__ == '__main__':
     args = args_parser()
     torch.manual_seed(args.seed)
     np.random.seed(args.seed)
-    args.device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() and args.gpu != -1 else 'cpu')
-    if args.device != 'cpu':
-        torch.backends.cudnn.deterministic = True
-        torch.backends.cudnn.benchmark = False
+    setup_device(args)
     # torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
     if args.wandb:
@@ -92,28 +90,28 @@ if __name__ == '__main__':
     model_args = {'args': args}
     if args.model[0:3].lower() == 'vgg':
         if args.snn:
-            model_args = {'num_cls': args.num_classes, 'timesteps': args.timestep_mean, 'max_timestep': max_timestep, 'img_size': args.img_size}
-            net_glob = snn_models_bntt.SNN_VGG9_BNTT(**model_args).cuda()
+            model_args = {'num_cls': args.num_classes, 'timesteps': args.timestep_mean, 'max_timestep': max_timestep, 'img_size': args.img_size, **snn_model_options(args)}
+            net_glob = model_to_device(snn_models_bntt.SNN_VGG9_BNTT(**model_args), args)
         else:
             model_args = {'vgg_name': args.model, 'labels': args.num_classes, 'dataset': args.dataset, 'kernel_size': 3, 'dropout': args.dropout}
-            net_glob = ann_models.VGG(**model_args).cuda()
+            net_glob = model_to_device(ann_models.VGG(**model_args), args)
     elif args.model == 'simple':
-        model_args = {'num_cls': args.num_classes, 'timesteps': args.timestep_mean, 'max_timestep': max_timestep, 'img_size': args.img_size}
+        model_args = {'num_cls': args.num_classes, 'timesteps': args.timestep_mean, 'max_timestep': max_timestep, 'img_size': args.img_size, **snn_model_options(args)}
         if args.dataset == 'EMNIST':
             if args.bntt:
                 if args.direct:
-                    net_glob = Simple_Mnist_BNTT(**model_args).cuda()
+                    net_glob = model_to_device(Simple_Mnist_BNTT(**model_args), args)
                 else:
-                    net_glob = Simple_Mnist_BNTT_Rate(**model_args).cuda()
+                    net_glob = model_to_device(Simple_Mnist_BNTT_Rate(**model_args), args)
             else:
                 model_args['leak_mem'] = 0.5
-                net_glob = Simple_Mnist_NoBNTT(**model_args).cuda()
+                net_glob = model_to_device(Simple_Mnist_NoBNTT(**model_args), args)
         else:
             if args.bntt:
-                net_glob = Simple_CF10_BNTT(**model_args).cuda()
+                net_glob = model_to_device(Simple_CF10_BNTT(**model_args), args)
             else:
                 model_args['leak_mem'] = 0.5
-                net_glob = VGG5_CF10_NoBNTT(**model_args).cuda()
+                net_glob = model_to_device(VGG5_CF10_NoBNTT(**model_args), args)
     else:
         exit('Error: unrecognized model')
     # print(net_glob)
@@ -163,6 +161,18 @@ if __name__ == '__main__':
     chosen_users = None
     client_set = set()
 
+    def client_weight(timesteps, loss):
+        # unnormalised FedAvgWeight of a client, agg_weights normalises them to sum to the number of clients
+        if args.FedAvgWeight == "timestep_prop":
+            return timesteps
+        elif args.FedAvgWeight == "timestep_inv":
+            return 1/(timesteps)
+        elif args.FedAvgWeight == "train_loss_prop":
+            return loss
+        elif args.FedAvgWeight == "train_loss_inv":
+            return 1/(loss)
+        return 1
+
     for iter in range(args.epochs):
         print("--------------------------------------------------")
         print("Round {}, Learning rate {}".format(iter+1, args.lr))
@@ -179,11 +189,13 @@ if __name__ == '__main__':
             tmp_losses = []
             for idx in candidates:
                 local = LocalUpdate(args=args, dataset=dataset_train, idxs=dict_users[idx]) # idxs needs the list of indices assigned to this particular client
-                model_args = {'num_cls': args.num_classes, 'timesteps': max(1, round(timesteps_list[idx])), 'max_timestep': max_timestep}
-                model_copy = type(net_glob.module)(**model_args) # get a new instance
+                timesteps = max(1, round(timesteps_list[idx]))
+                # the replica only builds the BNTT slots of its own timesteps
+                model_args = {'num_cls': args.num_classes, 'timesteps': timesteps, 'max_timestep': max_timestep, 'bntt_slots': timesteps, **snn_model_options(args)}
+                model_copy = type(net_glob.module)(**client_model_args(model_args, args, iter, idx)) # get a new instance
                 model_copy = nn.DataParallel(model_copy)
                 model_copy.load_state_dict(net_glob.state_dict()) # copy weights and stuff
-                tmp_acc, tmp_loss = local.test_with_train_data(net=model_copy.to(args.device))
+                tmp_acc, tmp_loss = local.test_with_train_data(net=model_to_device(model_copy, args))
                 tmp_losses.append(tmp_loss)
             ret = sorted(list(range(len(tmp_losses))), key=lambda x: tmp_losses[x], reverse=True)
             chosen_users = [candidates[idx] for idx in ret[:m]]
@@ -196,18 +208,25 @@ if __name__ == '__main__':
         if args.wandb:
             wandb.log({"diff_client_num":len(client_set), "Round": iter+1})
 
+        # with --stream_aggregation every update is folded in as soon as it is trained, instead of kept until the end of the round
+        aggregator = StreamingAggregator(args, net_glob.state_dict()) if args.stream_aggregation else None
         for counter, idx in enumerate(chosen_users):
             local = LocalUpdate(args=args, dataset=dataset_train, idxs=dict_users[idx]) # idxs needs the list of indices assigned to this particular client
-            model_args = {'num_cls': args.num_classes, 'timesteps': max(1, round(timesteps_list[idx])), 'max_timestep': max_timestep}
-            model_copy = type(net_glob.module)(**model_args) # get a new instance
+            timesteps = max(1, round(timesteps_list[idx]))
+            # the replica only builds the BNTT slots of its own timesteps
+            model_args = {'num_cls': args.num_classes, 'timesteps': timesteps, 'max_timestep': max_timestep, 'bntt_slots': timesteps, **snn_model_options(args)}
+            model_copy = type(net_glob.module)(**client_model_args(model_args, args, iter, idx)) # get a new instance
             model_copy = nn.DataParallel(model_copy)
             model_copy.load_state_dict(net_glob.state_dict()) # copy weights and stuff
 
-            # tmp_acc, tmp_loss = local.test_with_train_data(net=model_copy.to(args.device))
+            # tmp_acc, tmp_loss = local.test_with_train_data(net=model_to_device(model_copy, args))
             # print("Estimate loss: ", tmp_loss)
 
-            w, loss, trained_data_size = local.train(net=model_copy.to(args.device))
-            w_locals_all.append(copy.deepcopy(w))
+            w, loss, trained_data_size = local.train(net=model_to_device(model_copy, args))
+            if aggregator is not None:
+                aggregator.add(w, client_weight(timesteps, loss))
+            else:
+                w_locals_all.append(copy.deepcopy(w))
             loss_locals_all.append(copy.deepcopy(loss))
             trained_data_size_all.append(trained_data_size)
 
@@ -226,21 +245,14 @@ if __name__ == '__main__':
 
         # update global weights
         chosen_timesteps = [max(1, round(timesteps_list[idx])) for idx in chosen_users]
-        if args.FedAvgWeight == "timestep_prop":
-            agg_weights = [timestep / sum(chosen_timesteps) * len(chosen_users) for timestep in chosen_timesteps]
-        elif args.FedAvgWeight == "timestep_inv":
-            inverse_chosen_timesteps = [1/(timestep) for timestep in chosen_timesteps]
-            agg_weights = [val / sum(inverse_chosen_timesteps) * len(chosen_users) for val in inverse_chosen_timesteps]
-        elif args.FedAvgWeight == "train_loss_prop":
-            agg_weights = [loss / sum(loss_locals_all) * len(chosen_users) for loss in loss_locals_all]
-        elif args.FedAvgWeight == "train_loss_inv":
-            inverse_train_loss = [1/(loss) for loss in loss_locals_all]
-            agg_weights = [val / sum(inverse_train_loss) * len(chosen_users) for val in inverse_train_loss]
-        else:
-            agg_weights = [1 for i in range(len(chosen_users))]
+        client_weights = [client_weight(timestep, loss) for timestep, loss in zip(chosen_timesteps, loss_locals_all)]
+        agg_weights = [val / sum(client_weights) * len(chosen_users) for val in client_weights]
         print("Perform weighted FedAvg by {}, weights {}".format(args.FedAvgWeight, agg_weights))
 
-        w_glob = fl.FedAvgWeighted(w_locals_all, agg_weights, w_init = net_glob.state_dict())
+        if aggregator is not None:
+            w_glob = aggregator.result()
+        else:
+            w_glob = fl.FedAvgWeighted(w_locals_all, agg_weights, w_init = net_glob.state_dict())
         
         # delta_w = {}
         # w_init = net_glob.state_dict()
@@ -6,24 +6,31 @@ import matplotlib
 matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import copy
+import itertools
 import numpy as np
 import pandas as pd
 from pathlib import Path
 from torchvision import datasets, transforms
 import torch
 import torch.nn as nn
+from torch.utils.data import DataLoader
 import wandb
 
 from utils.sampling import mnist_iid, mnist_non_iid, cifar_iid, cifar_non_iid, mnist_dvs_iid, mnist_dvs_non_iid, nmnist_iid, nmnist_non_iid
-from utils.options import args_parser
+from utils.options import args_parser, snn_model_options, client_model_args
+from utils.device import setup_device, model_to_device, to_device
 from models.Update import LocalUpdate
-from models.Fed import FedLearn
+from models.Fed import FedLearn, StreamingAggregator, FlatState
+from models.codec import UpdateCompressor, LowRankCompressor, ErrorFeedback
 from models.Fed import model_deviation
 from models.test import test_img
+from models.cost import OpCounter
+from models.quantize import quantize_inference
+from models.export import calibrate_running_stats
 import models.vgg as ann_models
 import models.resnet as resnet_models
 import models.vgg_spiking_bntt as snn_models_bntt
-from models.simple_conv_cf10 import Simple_CF10_BNTT
+from models.simple_conv_cf10 import Simple_CF10_BNTT, VGG5_CF10_NoBNTT
 from models.simple_conv_mnist import Simple_Mnist_BNTT, Simple_Mnist_NoBNTT, Simple_Mnist_BNTT_Rate
 import models.client_selection as client_selection
 
@@ -41,10 +48,7 @@ if __name__ == '__main__':
     args = args_parser()
     torch.manual_seed(args.seed)
     np.random.seed(args.seed)
-    args.device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() and args.gpu != -1 else 'cpu')
-    if args.device != 'cpu':
-        torch.backends.cudnn.deterministic = True
-        torch.backends.cudnn.benchmark = False
+    setup_device(args)
     # torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
     if args.wandb:
@@ -106,34 +110,34 @@ if __name__ == '__main__':
     model_args = {'args': args}
     if args.model[0:3].lower() == 'vgg':
         if args.snn:
-            model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps}
-            net_glob = snn_models_bntt.SNN_VGG9_BNTT(**model_args).cuda()
+            model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps, **snn_model_options(args)}
+            net_glob = model_to_device(snn_models_bntt.SNN_VGG9_BNTT(**model_args), args)
         else:
             model_args = {'vgg_name': args.model, 'labels': args.num_classes, 'dataset': args.dataset, 'kernel_size': 3, 'dropout': args.dropout}
-            net_glob = ann_models.VGG(**model_args).cuda()
+            net_glob = model_to_device(ann_models.VGG(**model_args), args)
     elif args.model[0:6].lower() == 'resnet':
         if args.snn:
             pass
         else:
             model_args = {'num_cls': args.num_classes}
-            net_glob = resnet_models.Network(**model_args).cuda()
+            net_glob = model_to_device(resnet_models.Network(**model_args), args)
     elif args.model == 'simple':
-        model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps, 'img_size': args.img_size}
+        model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps, 'img_size': args.img_size, **snn_model_options(args)}
         if args.dataset == 'MNIST' or args.dataset == 'EMNIST':
             if args.bntt:
                 if args.direct:
-                    net_glob = Simple_Mnist_BNTT(**model_args).cuda()
+                    net_glob = model_to_device(Simple_Mnist_BNTT(**model_args), args)
                 else:
-                    net_glob = Simple_Mnist_BNTT_Rate(**model_args).cuda()
+                    net_glob = model_to_device(Simple_Mnist_BNTT_Rate(**model_args), args)
             else:
                 model_args['leak_mem'] = 0.5
-                net_glob = Simple_Mnist_NoBNTT(**model_args).cuda()
+                net_glob = model_to_device(Simple_Mnist_NoBNTT(**model_args), args)
         else:
             if args.bntt:
-                net = Simple_CF10_BNTT(**model_args).cuda()
+                net_glob = model_to_device(Simple_CF10_BNTT(**model_args), args)
             else:
                 model_args['leak_mem'] = 0.5
-                net = VGG5_CF10_NoBNTT(**model_args).cuda()
+                net_glob = model_to_device(VGG5_CF10_NoBNTT(**model_args), args)
     else:
         exit('Error: unrecognized model')
     print(net_glob)
@@ -156,6 +160,14 @@ if __name__ == '__main__':
     ms_acc_test_list, ms_loss_test_list = [], []
     ms_num_client_list, ms_tot_comm_cost_list, ms_avg_comm_cost_list, ms_max_comm_cost_list = [], [], [], []
     ms_tot_nz_grad_list, ms_avg_nz_grad_list, ms_max_nz_grad_list = [], [], []
+    # the initial row is not evaluated, so its inference cost is unknown; no client has trained yet
+    ms_macs_list, ms_synops_list, ms_energy_list = [float('nan')], [float('nan')], [float('nan')]
+    ms_client_ops_list, ms_total_ops_list = [0], [0]
+    # forward MACs + SynOps of the client training, summed over the experiment
+    total_train_ops, client_ops = 0, 0
+    # bytes uploaded by the aggregated clients, in the last round and summed over the experiment
+    ms_upload_list, ms_total_upload_list = [0], [0]
+    round_upload, total_upload = 0, 0
     # ms_model_deviation = []
 
     # testing
@@ -182,6 +194,20 @@ if __name__ == '__main__':
     # Define Fed Learn object
     fl = FedLearn(args)
 
+    compressor = None
+    if args.update_codec != 'none':
+        if args.stream_aggregation or args.client_selection not in ("random", "biggest_train_loss"):
+            exit('Error: --update_codec needs --client_selection random or biggest_train_loss, without --stream_aggregation')
+        error_feedback = ErrorFeedback(args.ef_dir) if args.error_feedback else None
+        if args.update_codec == 'lowrank':
+            compressor = LowRankCompressor(FlatState(net_glob.state_dict()).shapes, args.lowrank_rank, error_feedback, args.seed)
+        else:
+            compressor = UpdateCompressor(args.update_codec, args.codec_bucket, error_feedback, args.seed)
+
+    def calibration_batches():
+        calib_loader = DataLoader(dataset_train, batch_size=args.bs, shuffle=True)
+        return [to_device(images, args) for images, _ in itertools.islice(calib_loader, args.calib_batches)]
+
     client_selection_history, client_set, dropped_clients = [], set(), []
 
     # federated learning constants 
@@ -196,6 +222,7 @@ if __name__ == '__main__':
         net_glob.train()
         w_locals_selected, loss_locals_selected = [], []
         w_locals_all, loss_locals_all = [], []
+        round_ops = 0
         trained_data_size_all = []
         
         candidates = [idx for idx in range(args.num_users) if len(dict_users[idx]) > args.bs]
@@ -264,22 +291,46 @@ if __name__ == '__main__':
         chosen_candidates = copy.deepcopy(candidates)
         print("candidate clients: ", candidates)
         
+        aggregator = None
+        if args.stream_aggregation:
+            if args.client_selection != "random":
+                exit('Error: --stream_aggregation needs --client_selection random, the other strategies select from all the trained updates')
+            # every selected update is folded in as soon as it is trained, so the clients are selected beforehand
+            idxs_users = client_selection.random(len(candidates), m)
+            aggregator = StreamingAggregator(args, net_glob.state_dict())
+
         # for idx in idxs_users:
         # Do local update in all the clients # Not required (local updates in only the selected clients is enough) for normal experiments but neeeded for model deviation analysis
-        for idx in candidates:
+        for counter, idx in enumerate(candidates):
             local = LocalUpdate(args=args, dataset=dataset_train, idxs=dict_users[idx]) # idxs needs the list of indices assigned to this particular client
-            model_copy = type(net_glob.module)(**model_args) # get a new instance
+            model_copy = type(net_glob.module)(**client_model_args(model_args, args, iter, idx)) # get a new instance
             model_copy = nn.DataParallel(model_copy)
             model_copy.load_state_dict(net_glob.state_dict()) # copy weights and stuff
-            w, loss, trained_data_size = local.train(net=model_copy.to(args.device))
-            w_locals_all.append(copy.deepcopy(w))
+            model_copy = model_to_device(model_copy, args)
+            if args.count_ops:
+                op_counter = OpCounter(model_copy, args.snn)
+            w, loss, trained_data_size = local.train(net=model_copy)
+            if args.count_ops:
+                cost = op_counter.read(args.energy_mac, args.energy_ac)
+                op_counter.remove()
+                round_ops += cost['macs'] + cost['synops']
+            if aggregator is None:
+                w_locals_all.append(copy.deepcopy(w))
+            elif counter in idxs_users:
+                aggregator.add(w)
             loss_locals_all.append(copy.deepcopy(loss))
             trained_data_size_all.append(trained_data_size)
 
+        if args.count_ops:
+            client_ops = round_ops / len(candidates)
+            total_train_ops += round_ops
+
         # print("local loss: ", loss_locals_all)
         # print("training data distribution: ", trained_data_size_all)
         
-        if args.client_selection == "random":
+        if aggregator is not None:
+            print("Clients selected before training for streaming aggregation")
+        elif args.client_selection == "random":
             idxs_users = client_selection.random(len(candidates), m)
         elif args.client_selection == "biggest_train_loss":
             idxs_users = client_selection.biggest_loss(loss_locals_all, len(candidates), m)
@@ -332,14 +383,30 @@ if __name__ == '__main__':
         
 
         for idx in idxs_users:
-            w_locals_selected.append(copy.deepcopy(w_locals_all[idx]))
+            if aggregator is None:
+                w_locals_selected.append(copy.deepcopy(w_locals_all[idx]))
             loss_locals_selected.append(copy.deepcopy(loss_locals_all[idx]))
         
         # model_dev_list = model_deviation(w_locals_all, net_glob.state_dict())
         # ms_model_deviation.append(model_dev_list)
 
         # update global weights
-        w_glob = fl.FedAvg(w_locals_selected, w_init = net_glob.state_dict())
+        if aggregator is not None:
+            w_glob = aggregator.result()
+        elif compressor is not None:
+            # only the aggregated clients encode, so their error feedback and warm start follow what the server received
+            w_glob, payloads = fl.FedAvgCompressed(w_locals_selected, net_glob.state_dict(), compressor, clients=chosen_users)
+        else:
+            w_glob = fl.FedAvg(w_locals_selected, w_init = net_glob.state_dict())
+
+        if compressor is not None:
+            round_upload = sum(payload.nbytes for payload in payloads)
+        else:
+            # stragglers dropped by the aggregation upload nothing
+            num_aggregated = aggregator.num_aggregated if aggregator is not None else fl.num_aggregated
+            round_upload = num_aggregated * sum(v.numel() * v.element_size() for v in net_glob.state_dict().values())
+        total_upload += round_upload
+        print("Round {:d}, upload of the aggregated clients: {:.3f} MB".format(iter, round_upload / 2 ** 20))
         
         # copy weight to net_glob
         net_glob.load_state_dict(w_glob)
@@ -353,14 +420,31 @@ if __name__ == '__main__':
         if iter % args.eval_every == 0:
             # testing
             net_glob.eval()
+            if args.calibrate_bntt:
+                calibrate_running_stats(net_glob, calibration_batches())
             acc_train, loss_train = test_img(net_glob, dataset_train, args)
             print("Round {:d}, Training accuracy: {:.2f}".format(iter, acc_train))
+            if args.count_ops:
+                op_counter = OpCounter(net_glob, args.snn)
             acc_test, loss_test = test_img(net_glob, dataset_test, args)
             print("Round {:d}, Testing accuracy: {:.2f}".format(iter, acc_test))
+            if args.count_ops:
+                cost = op_counter.read(args.energy_mac, args.energy_ac)
+                op_counter.remove()
+                print("Round {:d}, per inference: {:.4g} MACs, {:.4g} SynOps, {:.4g} uJ".format(
+                    iter, cost['macs_per_inference'], cost['synops_per_inference'], cost['energy_per_inference'] / 1e6))
+                ms_macs_list.append(cost['macs_per_inference'])
+                ms_synops_list.append(cost['synops_per_inference'])
+                ms_energy_list.append(cost['energy_per_inference'] / 1e6)
+                ms_client_ops_list.append(client_ops)
+                ms_total_ops_list.append(total_train_ops)
+
+            ms_upload_list.append(round_upload / 2 ** 20)
+            ms_total_upload_list.append(total_upload / 2 ** 20)
 
             if args.wandb:
                 wandb.log({"server_train_loss": loss_train, "server_test_loss": loss_test, 
-                            "server_train_acc": acc_train, "server_test_acc": acc_test, "Round": iter+1})
+                            "server_train_acc": acc_train, "server_test_acc": acc_test, "upload_mb": round_upload / 2 ** 20, "Round": iter+1})
 
             # Add metrics to store
             ms_acc_train_list.append(acc_train)
@@ -380,14 +464,38 @@ if __name__ == '__main__':
 
     # testing
     net_glob.eval()
+    if args.calibrate_bntt:
+        calibrate_running_stats(net_glob, calibration_batches())
     acc_train, loss_train = test_img(net_glob, dataset_train, args)
     print("Final Training accuracy: {:.2f}".format(acc_train))
+    if args.count_ops:
+        op_counter = OpCounter(net_glob, args.snn)
     acc_test, loss_test = test_img(net_glob, dataset_test, args)
     print("Final Testing accuracy: {:.2f}".format(acc_test))
+    if args.count_ops:
+        cost = op_counter.read(args.energy_mac, args.energy_ac)
+        op_counter.remove()
+        print("Final per inference: {:.4g} MACs, {:.4g} SynOps, {:.4g} uJ; client training: {:.4g} ops per client in the last round, {:.4g} in total".format(
+            cost['macs_per_inference'], cost['synops_per_inference'], cost['energy_per_inference'] / 1e6, client_ops, total_train_ops))
+        ms_macs_list.append(cost['macs_per_inference'])
+        ms_synops_list.append(cost['synops_per_inference'])
+        ms_energy_list.append(cost['energy_per_inference'] / 1e6)
+        ms_client_ops_list.append(client_ops)
+        ms_total_ops_list.append(total_train_ops)
+    ms_upload_list.append(round_upload / 2 ** 20)
+    ms_total_upload_list.append(total_upload / 2 ** 20)
+    print("Final upload: {:.3f} MB in the last round, {:.3f} MB in total".format(round_upload / 2 ** 20, total_upload / 2 ** 20))
+
+    if args.quantize:
+        net_int = quantize_inference(net_glob, calibration_batches())
+        acc_int, loss_int = test_img(net_int, dataset_test, args)
+        print("Final integer inference testing accuracy: {:.2f} (fp32 {:.2f})".format(acc_int, acc_test))
 
     if args.wandb:
         wandb.log({"server_train_loss": loss_train, "server_test_loss": loss_test, 
                     "server_train_acc": acc_train, "server_test_acc": acc_test, "Round": args.epochs})
+        if args.quantize:
+            wandb.log({"server_int_test_acc": acc_int, "server_int_test_loss": loss_int, "Round": args.epochs})
 
     # Add metrics to store
     ms_acc_train_list.append(acc_train)
@@ -406,13 +514,23 @@ if __name__ == '__main__':
     plt.savefig('./{}/fed_acc_{}_{}_{}_C{}_iid{}.png'.format(args.result_dir, args.dataset, args.model, args.epochs, args.frac, args.iid))
 
     # Write metric store into a CSV
-    metrics_df = pd.DataFrame(
-        {
+    metrics = {
             'Train acc': ms_acc_train_list,
             'Test acc': ms_acc_test_list,
             'Train loss': ms_loss_train_list,
-            'Test loss': ms_loss_test_list
+            'Test loss': ms_loss_test_list,
+            'Upload MB/round': ms_upload_list,
+            'Total upload MB': ms_total_upload_list
+        }
+    if args.count_ops:
+        metrics.update({
+            'MACs/inference': ms_macs_list,
+            'SynOps/inference': ms_synops_list,
+            'Energy/inference (uJ)': ms_energy_list,
+            'Client fwd ops/round': ms_client_ops_list,
+            'Total client fwd ops': ms_total_ops_list
         })
+    metrics_df = pd.DataFrame(metrics)
     metrics_df.to_csv('./{}/fed_stats_{}_{}_{}_C{}_iid{}.csv'.format(args.result_dir, args.dataset, args.model, args.epochs, args.frac, args.iid), sep='\t')
 
     # torch.save(net_glob.module.state_dict(), './{}/saved_model'.format(args.result_dir))
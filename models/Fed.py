@@ -9,6 +9,8 @@ from torch import nn
 from typing import Union
 from collections import OrderedDict
 
+from models.codec import topk_encode, topk_decode_add, decode_sum
+
 def percentile(t: torch.tensor, q: float) -> Union[int, float]:
     """
     Return the ``q``-th percentile of the flattened input tensor's data.
@@ -41,9 +43,206 @@ def model_deviation(w_locals, w_init):
         model_deviation_list.append(model_diff(w, w_init).item())
     return model_deviation_list
 
+# --------------------------------------------------
+# Flat-buffer aggregation
+# The floating-point entries of every client state are copied into one row of a block of
+# FLAT_BLOCK contiguous vectors, and the block is reduced with a single weighted sum (addmv).
+# This replaces one small op per key and client with a few large kernels, and memory stays at
+# FLAT_BLOCK rows whatever the number of clients. Aggregation runs on the CPU, as before.
+# --------------------------------------------------
+FLAT_BLOCK = 16
+
+
+class FlatState(object):
+    """
+    Layout of the floating-point entries of a state_dict in one float32 vector
+    """
+
+    def __init__(self, w_like):
+        self.keys = [k for k, v in w_like.items() if v.is_floating_point()]
+        self.shapes = [w_like[k].shape for k in self.keys]
+        self.sizes = [w_like[k].numel() for k in self.keys]
+        self.numel = sum(self.sizes)
+
+    def flatten(self, w, out=None, default=None):
+        """
+        :param default: state_dict of the entries missing from w (the BNTT slots a replica did not build)
+        """
+        return torch.cat([(w[k] if k in w else default[k]).detach().reshape(-1).to('cpu', torch.float32)
+                          for k in self.keys], out=out)
+
+    def unflatten(self, flat):
+        return OrderedDict((k, t.reshape(shape)) for k, t, shape in zip(self.keys, flat.split(self.sizes), self.shapes))
+
+    def key_means(self, flat):
+        """
+        Mean of the entries of every key in flat, repeated for each of its elements
+        """
+        means = torch.stack([t.mean() for t in flat.split(self.sizes)])
+        return means.repeat_interleave(torch.tensor(self.sizes))
+
+
+def flat_weighted_sum(flat_state, w, weights, init=None, default=None, noise_stdev=0):
+    """
+    sum_i weights[i] * (w[i] - init) over the flattened client states (init = 0 if None), plus
+    Gaussian noise per client scaled by noise_stdev and by the mean absolute update of each key
+    (or by 1 without init). No noise is drawn when noise_stdev is 0.
+    :return: float32 vector of flat_state.numel
+    """
+    total = torch.zeros(flat_state.numel)
+    # the last row of the block holds init, weighted by minus the sum of the block's weights
+    block = torch.zeros(min(FLAT_BLOCK, len(w)) + 1, flat_state.numel)
+    if init is not None:
+        block[-1].copy_(init)
+    for start in range(0, len(w), FLAT_BLOCK):
+        clients, block_weights = w[start:start + FLAT_BLOCK], weights[start:start + FLAT_BLOCK]
+        for row, w_i in zip(block, clients):
+            flat_state.flatten(w_i, out=row, default=default)
+        rows = torch.cat([block[:len(clients)], block[-1:]]) if len(clients) < len(block) - 1 else block
+        total.addmv_(rows.t(), torch.tensor(list(block_weights) + [-sum(block_weights)], dtype=torch.float32))
+        if noise_stdev:
+            for row in block[:len(clients)]:
+                scale = flat_state.key_means((row - init).abs_()) if init is not None else 1.0
+                total.add_(torch.randn(flat_state.numel) * scale * noise_stdev)
+    return total
+
+
+def merge_flat(flat_state, flat, w_like, other):
+    """
+    State dict in the key order of w_like, from the flat float entries and the other (integer) entries
+    """
+    w_avg = flat_state.unflatten(flat)
+    return OrderedDict((k, w_avg[k] if k in w_avg else other[k]) for k in w_like.keys())
+
+
+def encode_update(compressor, w, w_init, client=None):
+    """
+    Payload a client uploads for its trained state w: its update w - w_init, flattened and
+    compressed by an UpdateCompressor or LowRankCompressor (with the client's error feedback)
+    """
+    flat_state = FlatState(w_init)
+    return compressor.encode(flat_state.flatten(w, default=w_init).sub_(flat_state.flatten(w_init)), client)
+
+
+def average_payloads(payloads, w_init):
+    """
+    w_init plus the mean of the decoded payloads, which are summed together in blocks of DECODE_BLOCK
+    """
+    flat_state = FlatState(w_init)
+    delta_avg = decode_sum(payloads, torch.zeros(flat_state.numel), [1.0 / len(payloads)] * len(payloads))
+    # integer buffers are not part of the update
+    other = {k: w_init[k].cpu() for k in w_init.keys() if k not in flat_state.keys}
+    return merge_flat(flat_state, flat_state.flatten(w_init).add_(delta_avg), w_init, other)
+
+
+class StreamingAggregator(object):
+    """
+    FedAvg / FedAvgWeighted folded in one client at a time, as soon as it has trained, so the server
+    keeps a few flat model copies however many clients train in a round. Weights that are only known
+    at the end of the round (normalised train losses) are deferred: a client is accumulated with its
+    unnormalised weight, and the normalisation by the sum over all the clients is applied in result().
+    Stragglers are drawn as clients arrive; the first one is never a straggler, as in FedAvg.
+    """
+
+    def __init__(self, args, w_init):
+        self.args = args
+        self.w_init = w_init
+        self.flat_state = FlatState(w_init)
+        self.init = self.flat_state.flatten(w_init)
+        self.total = torch.zeros(self.flat_state.numel)
+        self.noise = torch.zeros(self.flat_state.numel) if args.grad_noise_stdev else None
+        self.other = {k: torch.zeros(v.shape, dtype=torch.float64) for k, v in w_init.items() if k not in self.flat_state.keys}
+        self.weight_sum = 0.0
+        self.num_clients = 0
+        self.num_aggregated = 0
+
+    def add(self, w, weight=1.0):
+        """
+        :param w: state_dict of a trained client, may lack the BNTT slots its replica did not build
+        :param weight: unnormalised aggregation weight, e.g. the train loss for loss-proportional weighting
+        """
+        self.num_clients += 1
+        self.weight_sum += weight
+        if self.num_clients > 1 and random.uniform(0, 1) < self.args.straggler_prob:
+            return
+        self.num_aggregated += 1
+        delta = self.flat_state.flatten(w, default=self.w_init).sub_(self.init)
+        self.total.add_(delta, alpha=weight)
+        if self.noise is not None:
+            # Scale the noise by mean of the absolute value of the model updates
+            self.noise.add_(torch.randn(self.flat_state.numel) * self.flat_state.key_means(delta.abs_()) * self.args.grad_noise_stdev)
+        for k in self.other.keys():
+            self.other[k] += (w.get(k, self.w_init[k]).cpu().double() - self.w_init[k].cpu().double()) * weight
+
+    def result(self):
+        """
+        w_init + sum_i a_i * (w_i - w_init) / n over the n non-stragglers, with a_i the weights
+        normalised to sum to the number of clients added, as agg_weights of FedAvgWeighted
+        """
+        scale = self.num_clients / self.weight_sum / self.num_aggregated
+        w_avg = self.init + self.total * scale
+        if self.noise is not None:
+            w_avg.add_(self.noise, alpha=1.0 / self.num_aggregated)
+        other = {k: (self.w_init[k].cpu().double() + v * scale).to(self.w_init[k].dtype) for k, v in self.other.items()}
+        return merge_flat(self.flat_state, w_avg, self.w_init, other)
+
+
+def staleness_weight(staleness):
+    """
+    Down-weighting of an update trained from a global model `staleness` versions old, 1 / sqrt(1 + s) as in FedBuff
+    """
+    return 1.0 / (1.0 + staleness) ** 0.5
+
+
+class BufferedAggregator(object):
+    """
+    Server of buffered asynchronous FedAvg (FedBuff): client updates arrive one at a time, each
+    relative to the global version the client downloaded, and are summed with their staleness
+    weight; after buffer_size of them the global model moves by server_lr times their mean and the
+    version increases. Integer buffers keep their initial values.
+    """
+
+    def __init__(self, w_init, buffer_size, server_lr=1.0):
+        self.w_init = w_init
+        self.flat_state = FlatState(w_init)
+        self.flat = self.flat_state.flatten(w_init)
+        self.buffer = torch.zeros(self.flat_state.numel)
+        self.other = {k: w_init[k].cpu() for k in w_init.keys() if k not in self.flat_state.keys}
+        self.buffer_size = buffer_size
+        self.server_lr = server_lr
+        self.num_buffered = 0
+        self.version = 0
+        self.staleness = []
+
+    def add(self, w, w_download, version):
+        """
+        :param w: state_dict of a trained client
+        :param w_download: global state_dict the client trained from
+        :param version: global version of w_download
+        :return: True if the buffer was applied and the global model advanced a version
+        """
+        staleness = self.version - version
+        self.staleness.append(staleness)
+        delta = self.flat_state.flatten(w, default=w_download).sub_(self.flat_state.flatten(w_download))
+        self.buffer.add_(delta, alpha=staleness_weight(staleness))
+        self.num_buffered += 1
+        if self.num_buffered < self.buffer_size:
+            return False
+        self.flat.add_(self.buffer, alpha=self.server_lr / self.num_buffered)
+        self.buffer.zero_()
+        self.num_buffered = 0
+        self.version += 1
+        return True
+
+    def state_dict(self):
+        return merge_flat(self.flat_state, self.flat.clone(), self.w_init, self.other)
+
+
 class FedLearn(object):
     def __init__(self, args):
         self.args = args
+        # clients left after the straggler draw of the last FedAvg / FedAvgWeighted
+        self.num_aggregated = 0
 
     def FedAvg(self, w, w_init = None):
         non_stragglers = [1]*len(w)
@@ -51,22 +250,16 @@ class FedLearn(object):
             epsilon = random.uniform(0, 1)
             if epsilon < self.args.straggler_prob:
                 non_stragglers[i] = 0
-        w_avg = copy.deepcopy(w[0]) 
-        for k in w_avg.keys():
-            if w_init:
-                w_avg[k] = w_avg[k].cpu() + torch.mean(torch.abs(w_init[k].cpu() - w[0][k].cpu())*1.0) * torch.randn(w[0][k].size()) * self.args.grad_noise_stdev # Scale the noise by mean of the absolute value of the model updates
-            else:
-                w_avg[k] = w_avg[k].cpu() + torch.randn(w[0][k].size()) * self.args.grad_noise_stdev # Add gaussian noise to the model updates
-        for k in w[0].keys():
-            for i in range(len(w)):
-                if non_stragglers[i] == 1:
-                    if w_init:
-                        w_avg[k] = w_avg[k].cpu() + w[i][k].cpu() + torch.mean(torch.abs(w_init[k].cpu() - w[i][k].cpu())*1.0) * torch.randn(w[i][k].size()) * self.args.grad_noise_stdev # Scale the noise by mean of the absolute value of the model updates
-                        # 1.0 is to convert into float
-                    else:
-                        w_avg[k] = w_avg[k].cpu() + w[i][k].cpu() + torch.randn(w[i][k].size()) * self.args.grad_noise_stdev # Add gaussian noise to the model updates
-            w_avg[k] = torch.div(w_avg[k], sum(non_stragglers))
-        return w_avg
+        w = [w_i for w_i, keep in zip(w, non_stragglers) if keep]
+        self.num_aggregated = len(w)
+        flat_state = FlatState(w[0])
+        init = flat_state.flatten(w_init) if w_init else None
+        # Add gaussian noise to the model updates, scaled by the mean of the absolute value of the model updates with w_init
+        total = flat_weighted_sum(flat_state, w, [1.0] * len(w), init, noise_stdev=self.args.grad_noise_stdev)
+        w_avg = total.div_(len(w)) if init is None else init.add_(total, alpha=1.0 / len(w))
+        other = {k: torch.stack([w_i[k].cpu() for w_i in w]).double().mean(0).to(w[0][k].dtype)
+                 for k in w[0].keys() if k not in flat_state.keys}
+        return merge_flat(flat_state, w_avg, w[0], other)
 
     def FedAvgWeighted(self, w, agg_weights, w_init):
         non_stragglers = [1]*len(w)
@@ -74,18 +267,22 @@ class FedLearn(object):
             epsilon = random.uniform(0, 1)
             if epsilon < self.args.straggler_prob:
                 non_stragglers[i] = 0
-        
-        w_avg = OrderedDict()
-        for k in w[0].keys():
-            for i in range(len(w)):
-                if non_stragglers[i] == 1:
-                    if k not in w_avg.keys():
-                        w_avg[k] = w_init[k].cpu() + (w[i][k].cpu() - w_init[k].cpu()) * agg_weights[i] + torch.mean(torch.abs(w_init[k].cpu() - w[i][k].cpu())*1.0) * torch.randn(w[i][k].size()) * self.args.grad_noise_stdev 
-                    else:
-                        w_avg[k] += w_init[k].cpu() + (w[i][k].cpu() - w_init[k].cpu()) * agg_weights[i] + torch.mean(torch.abs(w_init[k].cpu() - w[i][k].cpu())*1.0) * torch.randn(w[i][k].size()) * self.args.grad_noise_stdev # Scale the noise by mean of the absolute value of the model updates
-                    # 1.0 is to convert into float
-            w_avg[k] = torch.div(w_avg[k], sum(non_stragglers))
-        return w_avg
+        agg_weights = [a for a, keep in zip(agg_weights, non_stragglers) if keep]
+        w = [w_i for w_i, keep in zip(w, non_stragglers) if keep]
+        self.num_aggregated = len(w)
+
+        # w_init + sum_i agg_weights[i] * (w[i] - w_init) / n, with noise scaled by the mean of the absolute value of each update
+        flat_state = FlatState(w_init)
+        init = flat_state.flatten(w_init)
+        # replicas with fewer BNTT slots than the server leave the missing ones unchanged
+        total = flat_weighted_sum(flat_state, w, agg_weights, init, default=w_init, noise_stdev=self.args.grad_noise_stdev)
+        w_avg = init.add_(total, alpha=1.0 / len(w))
+        other = {}
+        for k in w_init.keys():
+            if k not in flat_state.keys:
+                delta = sum((w_i.get(k, w_init[k]).cpu().double() - w_init[k].cpu().double()) * a for w_i, a in zip(w, agg_weights))
+                other[k] = (w_init[k].cpu().double() + delta / len(w)).to(w_init[k].dtype)
+        return merge_flat(flat_state, w_avg, w_init, other)
 
 
     def FedAvgSparse(self, w_init, delta_w_locals, th_basis = "magnitude", pruning_type = "uniform", sparsity = 0, activity = None, activity_multiplier = 1, activity_mask = None):
@@ -102,7 +299,7 @@ class FedLearn(object):
             # Threshold Calculation
             if th_basis == "magnitude" and pruning_type == "uniform":
                 th = percentile(torch.abs(delta_w_locals[0][k]), sparsity)
-                th = torch.FloatTensor([th]).cuda()
+                th = torch.tensor([th], device=w_init[k].device)
                 mask = torch.abs(delta_w_locals[0][k]) > th.expand_as(w_init[k])
             elif th_basis == "magnitude" and pruning_type == "dynamic":
                 if activity is None:
@@ -123,7 +320,7 @@ class FedLearn(object):
                 print("sparsity", s)
                 th = percentile(torch.abs(delta_w_locals[0][k]), s)
                 print("Threshold", th)
-                th = torch.FloatTensor([th]).cuda()
+                th = torch.tensor([th], device=w_init[k].device)
                 mask = torch.abs(delta_w_locals[0][k]) > th.expand_as(w_init[k])
             elif th_basis == "activity" and pruning_type == "uniform":
                 if activity_mask is None:
@@ -142,11 +339,11 @@ class FedLearn(object):
                     print("Unknown Layer!")
                 if layer_activity_mask.shape == torch.Size([]):
                     th = percentile(torch.abs(delta_w_locals[0][k]), sparsity)
-                    th = torch.FloatTensor([th]).cuda()
+                    th = torch.tensor([th], device=w_init[k].device)
                     mask = torch.abs(delta_w_locals[0][k]) > th.expand_as(w_init[k])
                 else:
                     th = percentile(layer_activity_mask, sparsity)
-                    th = torch.FloatTensor([th]).cuda()
+                    th = torch.tensor([th], device=w_init[k].device)
                     mask = layer_activity_mask > th.expand_as(w_init[k])
             elif th_basis == "activity" and pruning_type == "dynamic":
                 if activity is None:
@@ -173,11 +370,11 @@ class FedLearn(object):
                 s = 100*(1 - layer_activity/activity_multiplier)
                 if layer_activity_mask.shape == torch.Size([]):
                     th = percentile(torch.abs(delta_w_locals[0][k]), s)
-                    th = torch.FloatTensor([th]).cuda()
+                    th = torch.tensor([th], device=w_init[k].device)
                     mask = torch.abs(delta_w_locals[0][k]) > th.expand_as(w_init[k])
                 else:
                     th = percentile(layer_activity_mask, s)
-                    th = torch.FloatTensor([th]).cuda()
+                    th = torch.tensor([th], device=w_init[k].device)
                     mask = layer_activity_mask > th.expand_as(w_init[k])
             else:
                 print("Unknown threshold basis or pruning_type. Available options: th_basis - magnitude or activity, pruning_type - uniform or dynamic")
@@ -188,7 +385,7 @@ class FedLearn(object):
                 # Threshold Calculation
                 if th_basis == "magnitude" and pruning_type == "uniform":
                     th = percentile(torch.abs(delta_w_locals[i][k]), sparsity)
-                    th = torch.FloatTensor([th]).cuda()
+                    th = torch.tensor([th], device=w_init[k].device)
                     mask = torch.abs(delta_w_locals[i][k]) > th.expand_as(w_init[k])
                 elif th_basis == "magnitude" and pruning_type == "dynamic":
                     if activity is None:
@@ -209,7 +406,7 @@ class FedLearn(object):
                     print("sparsity", s)
                     th = percentile(torch.abs(delta_w_locals[i][k]), s)
                     print("Threshold", th)
-                    th = torch.FloatTensor([th]).cuda()
+                    th = torch.tensor([th], device=w_init[k].device)
                     mask = torch.abs(delta_w_locals[i][k]) > th.expand_as(w_init[k])
                 elif th_basis == "activity" and pruning_type == "uniform":
                     if activity_mask is None:
@@ -228,11 +425,11 @@ class FedLearn(object):
                         print("Unknown Layer!")
                     if layer_activity_mask.shape == torch.Size([]):
                         th = percentile(torch.abs(delta_w_locals[i][k]), sparsity)
-                        th = torch.FloatTensor([th]).cuda()
+                        th = torch.tensor([th], device=w_init[k].device)
                         mask = torch.abs(delta_w_locals[i][k]) > th.expand_as(w_init[k])
                     else:
                         th = percentile(layer_activity_mask, sparsity)
-                        th = torch.FloatTensor([th]).cuda()
+                        th = torch.tensor([th], device=w_init[k].device)
                         mask = layer_activity_mask > th.expand_as(w_init[k])
                 elif th_basis == "activity" and pruning_type == "dynamic":
                     if activity is None:
@@ -259,11 +456,11 @@ class FedLearn(object):
                     s = 100*(1 - layer_activity/activity_multiplier)
                     if layer_activity_mask.shape == torch.Size([]):
                         th = percentile(torch.abs(delta_w_locals[i][k]), s)
-                        th = torch.FloatTensor([th]).cuda()
+                        th = torch.tensor([th], device=w_init[k].device)
                         mask = torch.abs(delta_w_locals[i][k]) > th.expand_as(w_init[k])
                     else:
                         th = percentile(layer_activity_mask, s)
-                        th = torch.FloatTensor([th]).cuda()
+                        th = torch.tensor([th], device=w_init[k].device)
                         mask = layer_activity_mask > th.expand_as(w_init[k])
                 else:
                     print("Unknown threshold basis or pruning_type. Available options: th_basis - magnitude or activity, pruning_type - uniform or dynamic")
@@ -273,6 +470,52 @@ class FedLearn(object):
             w_avg[k] = w_init[k] + delta_w_avg[k]
         return w_avg, delta_w_avg, sparse_delta_w_locals
 
+    def FedAvgCompressed(self, w, w_init, compressor, clients=None):
+        """
+        FedAvg of compressed client updates: the stragglers are drawn first, then only the other
+        clients encode their update (encode_update), so the error feedback and the low-rank warm start
+        of a client only advance when its payload is aggregated
+        :param compressor: UpdateCompressor or LowRankCompressor
+        :param clients: keys of the clients' error feedback and warm start, in the order of w
+        :return: (w_avg, payloads of the aggregated clients); payload.nbytes is their upload
+        """
+        clients = list(range(len(w))) if clients is None else clients
+        non_stragglers = [1]*len(w)
+        for i in range(1, len(w)):
+            epsilon = random.uniform(0, 1)
+            if epsilon < self.args.straggler_prob:
+                non_stragglers[i] = 0
+        payloads = [encode_update(compressor, w_i, w_init, client=client)
+                    for w_i, client, keep in zip(w, clients, non_stragglers) if keep]
+        return average_payloads(payloads, w_init), payloads
+
+    def FedAvgTopK(self, w_init, delta_w_locals, sparsity = 0):
+        """
+        Magnitude-based sparse FedAvg with real sparse updates: each client keeps the top
+        (100 - sparsity)% entries of its whole flattened update and sends them as a SparsePayload,
+        which the server scatter-adds into the average. Stragglers are drawn as in FedAvg and neither
+        encode nor count in the average.
+        :param sparsity: percentage of the update entries dropped, as in FedAvgSparse
+        :return: (w_avg, delta_w_avg, payloads); payload.nbytes is the upload of each aggregated client
+        """
+        non_stragglers = [1]*len(delta_w_locals)
+        for i in range(1, len(delta_w_locals)):
+            epsilon = random.uniform(0, 1)
+            if epsilon < self.args.straggler_prob:
+                non_stragglers[i] = 0
+        delta_w_locals = [delta_w for delta_w, keep in zip(delta_w_locals, non_stragglers) if keep]
+        flat_state = FlatState(w_init)
+        delta_avg = torch.zeros(flat_state.numel)
+        payloads = []
+        for delta_w in delta_w_locals:
+            payload = topk_encode(flat_state.flatten(delta_w), 1 - sparsity / 100)
+            topk_decode_add(payload, delta_avg, alpha=1.0 / len(delta_w_locals))
+            payloads.append(payload)
+        # integer buffers are not part of the update
+        other = {k: w_init[k].cpu() for k in w_init.keys() if k not in flat_state.keys}
+        w_avg = merge_flat(flat_state, flat_state.flatten(w_init).add_(delta_avg), w_init, other)
+        return w_avg, flat_state.unflatten(delta_avg), payloads
+
     def count_gradients(self, delta_w_locals, sparse_delta_w_locals):
          num_grads = []
          nz_grads = []
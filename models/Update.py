@@ -12,6 +12,8 @@ from sklearn import metrics
 import sys
 import os
 import copy
+from utils.device import to_device, autocast
+from models.spiking import truncated_backward
 
 
 class DatasetSplit(Dataset):
@@ -59,13 +61,18 @@ class LocalUpdate(object):
         for iter in range(local_epochs):
             batch_loss = []
             for batch_idx, (images, labels) in enumerate(self.ldr_train):
-                images, labels = images.to(self.args.device), labels.to(self.args.device)
+                images, labels = to_device(images, self.args), labels.to(self.args.device)
                 trained_data_size += len(images)
                 net.zero_grad()
-                log_probs = net(images)
-                # activities.append(activity)
-                loss = self.loss_func(log_probs, labels)
-                loss.backward()
+                if self.args.tbptt:
+                    loss = truncated_backward(net, self.loss_func, images, labels, self.args.tbptt,
+                                              autocast=lambda: autocast(self.args))
+                else:
+                    with autocast(self.args):
+                        log_probs = net(images)
+                        # activities.append(activity)
+                        loss = self.loss_func(log_probs, labels)
+                    loss.backward()
                 optimizer.step()
                 if self.args.verbose and batch_idx % 10 == 0:
                     print('Update Epoch: {} [{}/{} ({:.0f}%)]\tLoss: {:.6f}'.format(
@@ -94,8 +101,7 @@ class LocalUpdate(object):
         print("Testing on {} images".format(test_size))
         # l = len(data_loader)
         for idx, (data, target) in enumerate(data_loader):
-            if self.args.gpu != -1:
-                data, target = data.cuda(), target.cuda()
+            data, target = to_device(data, self.args), target.to(self.args.device)
             log_probs = net(data)
             # sum up batch loss
             test_loss += F.cross_entropy(log_probs, target, reduction='sum').item()
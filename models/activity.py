@@ -0,0 +1,124 @@
+import threading
+
+import torch
+import torch.nn as nn
+
+from models.spiking import push_spike_observer, pop_spike_observer
+
+
+# --------------------------------------------------
+# Spike activity recorder
+# Per-neuron spike counts of every spiking layer are accumulated on the device the model runs on,
+# so recording adds a sum over the batch per layer-step and no host synchronisation. The counts are
+# copied to the host in one transfer when read, e.g. once per batch or once per epoch. They are kept
+# as float32, exact up to 2^24 spikes per neuron.
+# --------------------------------------------------
+class ActivityRecorder(object):
+    """
+    Opt-in firing-rate instrumentation of any SNN whose layers spike through lif_step / lif_over_time.
+    Layer k is the k-th spiking layer of the forward, the encoded input spikes of rate-coded models
+    are recorded separately. Only calls of the model's forward are recorded.
+
+        recorder = ActivityRecorder(net)
+        for images, _ in loader:
+            net(images)
+        activity = recorder.read()
+        recorder.remove()
+    """
+
+    def __init__(self, net):
+        """
+        :param net: SNN model, or nn.DataParallel of one (its replicas are recorded as well)
+        """
+        model = net.module if isinstance(net, nn.DataParallel) else net
+        self.handles = [model.register_forward_pre_hook(self.enter), model.register_forward_hook(self.exit)]
+        # position in the current forward, one per thread for the DataParallel replicas
+        self.position = threading.local()
+        self.reset()
+
+    def reset(self):
+        """
+        Zero all the counts
+        """
+        self.counts = []
+        self.steps = []
+        self.input_count = None
+        self.input_steps = 0
+
+    def remove(self):
+        """
+        Detach from the model
+        """
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def enter(self, module, inputs):
+        self.position.calls = 0
+        self.position.layers = 0
+        push_spike_observer(self)
+
+    def exit(self, module, inputs, output):
+        pop_spike_observer()
+
+    def record_spikes(self, spikes, first):
+        """
+        :param spikes: (rows, ...) spikes of one layer, rows being samples or sample-timesteps
+        :param first: first step of the layer in this forward (resting membrane), so every layer
+            is seen once before any of them repeats
+        """
+        position = self.position
+        if first:
+            layer = position.layers
+            position.layers += 1
+        else:
+            layer = position.calls % position.layers
+        position.calls += 1
+        count = spikes.detach().sum(0)
+        if layer == len(self.counts):
+            self.counts.append(torch.zeros_like(count))
+            self.steps.append(0)
+        self.counts[layer].add_(count.to(self.counts[layer].device))
+        self.steps[layer] += spikes.size(0)
+
+    def record_input(self, spikes):
+        # input spikes are signed
+        count = spikes.detach().abs().sum(0)
+        if self.input_count is None:
+            self.input_count = torch.zeros_like(count)
+        self.input_count.add_(count.to(self.input_count.device))
+        self.input_steps += spikes.size(0)
+
+    def read(self):
+        """
+        Copy the counts to the host, the only synchronisation of the recorder.
+        Steps are sample-timesteps: a neuron can fire at most once per step.
+        :return: dict of per-layer lists
+            'firing_rate': spikes per neuron per step
+            'spikes': total spikes
+            'neurons': number of neurons
+            'dead': neurons that never fired
+            'saturated': neurons that fired at every step
+            'input_rate': spikes per input pixel per step of rate-coded models, None with direct coding
+        """
+        if not self.counts:
+            return {'firing_rate': [], 'spikes': [], 'neurons': [], 'dead': [], 'saturated': [], 'input_rate': None}
+        flat = [c.flatten() for c in self.counts]
+        if self.input_count is not None:
+            flat.append(self.input_count.flatten().to(flat[0].device))
+        counts = torch.cat(flat).cpu()
+
+        activity = {'firing_rate': [], 'spikes': [], 'neurons': [], 'dead': [], 'saturated': [], 'input_rate': None}
+        offset = 0
+        for c, steps in zip(self.counts, self.steps):
+            layer = counts[offset:offset + c.numel()]
+            offset += c.numel()
+            spikes = int(layer.sum(dtype=torch.float64).item())
+            activity['spikes'].append(spikes)
+            activity['neurons'].append(c.numel())
+            activity['firing_rate'].append(spikes / (c.numel() * steps))
+            activity['dead'].append((layer == 0).sum().item())
+            activity['saturated'].append((layer == steps).sum().item())
+        if self.input_count is not None:
+            activity['input_rate'] = counts[offset:].sum(dtype=torch.float64).item() / (self.input_count.numel() * self.input_steps)
+        return activity
@@ -0,0 +1,151 @@
+import heapq
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+# --------------------------------------------------
+# Buffered asynchronous federated training (FedBuff) and the synchronous FedAvg baseline
+# Clients train in a thread pool. Both engines share a simulated clock: a client needs
+# ClientClock.duration of simulated time to train, so a synchronous round lasts as long as its slowest
+# client, while the buffered server folds updates in as they arrive and applies an aggregate every
+# buffer_size of them. Updates are consumed in simulated arrival order, so the outcome does not
+# depend on the number of worker threads. Real wall-clock time is measured alongside; it includes
+# the evaluations, during which the asynchronous clients keep training.
+# --------------------------------------------------
+class ClientClock(object):
+    """
+    Simulated training time of the clients: a fixed speed per client, drawn log-normally around 1,
+    times its work (samples trained per participation). With delay > 0 a client also sleeps for delay
+    real seconds per simulated unit, to emulate slow devices on the real clock.
+    """
+
+    def __init__(self, work, sigma=1.0, delay=0.0, seed=0):
+        """
+        :param work: samples each client trains per participation
+        :param sigma: standard deviation of the log speed; 0 for identical clients
+        """
+        self.speed = np.random.RandomState(seed).lognormal(0.0, sigma, len(work))
+        self.work = np.asarray(work, dtype=np.float64)
+        self.delay = delay
+
+    def duration(self, client):
+        return float(self.speed[client] * self.work[client]) / float(self.work.mean())
+
+    def wait(self, client):
+        if self.delay:
+            time.sleep(self.delay * self.duration(client))
+
+
+def run_client(train_client, clock, client, w, job):
+    """
+    Job of a worker thread: the state of the client after training from the downloaded state w
+    :param job: index of the participation, in launch order (e.g. to derive the client's encoder seed)
+    """
+    w_local = train_client(client, w, job)
+    clock.wait(client)
+    return w_local
+
+
+class History(object):
+    """
+    Evaluations of the global model against the simulated and the real time
+    """
+
+    def __init__(self, evaluate, target_acc=None):
+        self.evaluate = evaluate
+        self.target_acc = target_acc
+        self.records = []
+        self.begin()
+
+    def begin(self):
+        self.start = time.perf_counter()
+
+    def record(self, step, updates, sim_time, w):
+        """
+        Evaluate w and log it; True once the target accuracy is reached
+        """
+        real_time = time.perf_counter() - self.start
+        acc = self.evaluate(w)
+        self.records.append({'step': step, 'updates': updates, 'sim_time': sim_time, 'real_time': real_time, 'acc': acc})
+        return self.reached()
+
+    def reached(self):
+        return self.target_acc is not None and bool(self.records) and self.records[-1]['acc'] >= self.target_acc
+
+    def time_to_target(self):
+        """
+        (simulated, real) time of the first evaluation at or above target_acc, None if never reached
+        """
+        for record in self.records:
+            if self.target_acc is not None and record['acc'] >= self.target_acc:
+                return record['sim_time'], record['real_time']
+        return None
+
+
+def train_buffered(aggregator, train_client, clock, num_users, concurrency, max_versions, history,
+                   workers=1, eval_every=1, rng=np.random):
+    """
+    FedBuff: concurrency clients, sampled uniformly among the idle ones, are always training from the
+    version of the global model they downloaded; each arriving update goes to the aggregator
+    (models.Fed.BufferedAggregator), which applies its buffer every buffer_size updates
+    :param train_client: (client, state_dict, job) -> trained state_dict, called from the worker threads
+    :param max_versions: stop after this many global versions, or earlier when history reaches its target
+    :return: history
+    """
+    pending = []
+    busy = set()
+    updates, sim_now, sequence = 0, 0.0, 0
+    history.begin()
+
+    with ThreadPoolExecutor(workers) as pool:
+        def launch():
+            nonlocal sequence
+            idle = [c for c in range(num_users) if c not in busy]
+            client = int(rng.choice(idle))
+            w = aggregator.state_dict()
+            future = pool.submit(run_client, train_client, clock, client, w, sequence)
+            heapq.heappush(pending, (sim_now + clock.duration(client), sequence, client, aggregator.version, w, future))
+            busy.add(client)
+            sequence += 1
+
+        for _ in range(min(concurrency, num_users)):
+            launch()
+        while aggregator.version < max_versions:
+            sim_now, _, client, version, w_download, future = heapq.heappop(pending)
+            w_local = future.result()
+            busy.discard(client)
+            updates += 1
+            if aggregator.add(w_local, w_download, version):
+                if aggregator.version % eval_every == 0 or aggregator.version == max_versions:
+                    if history.record(aggregator.version, updates, sim_now, aggregator.state_dict()):
+                        break
+            launch()
+        for *_, future in pending:
+            future.cancel()
+    return history
+
+
+def train_synchronous(fl, w_glob, train_client, clock, num_users, clients_per_round, max_rounds, history,
+                      workers=1, eval_every=1, rng=np.random):
+    """
+    Synchronous FedAvg on the same clock: every round the sampled clients train in the pool from the
+    same global model, and the round lasts as long as its slowest client
+    :param train_client: as in train_buffered
+    :return: (history, final global state_dict)
+    """
+    updates, sim_now = 0, 0.0
+    history.begin()
+    with ThreadPoolExecutor(workers) as pool:
+        for round_idx in range(1, max_rounds + 1):
+            clients = [int(c) for c in rng.choice(num_users, clients_per_round, replace=False)]
+            futures = [pool.submit(run_client, train_client, clock, client, w_glob, updates + i) for i, client in enumerate(clients)]
+            w_locals = [future.result() for future in futures]
+            w_glob = fl.FedAvg(w_locals, w_init=w_glob)
+            sim_now += max(clock.duration(client) for client in clients)
+            updates += len(clients)
+            if round_idx % eval_every == 0 or round_idx == max_rounds:
+                if history.record(round_idx, updates, sim_now, w_glob):
+                    break
+    return history, w_glob
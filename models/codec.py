@@ -0,0 +1,335 @@
+import os
+
+import torch
+
+
+# --------------------------------------------------
+# Client update codecs
+# A client update (w - w_init, flattened by models.Fed.FlatState) is encoded into the payload that
+# would be sent to the server; nbytes of the payload is what the client uploads. The server adds
+# the decoded payloads straight into its flat accumulator.
+# --------------------------------------------------
+class SparsePayload(object):
+    """
+    Top-k update: the positions of the kept entries in increasing order, delta-encoded as int32
+    (first position, then the gaps), and their float32 values
+    """
+
+    def __init__(self, index_deltas, values, numel):
+        self.index_deltas = index_deltas
+        self.values = values
+        self.numel = numel
+
+    @property
+    def nbytes(self):
+        return self.index_deltas.numel() * self.index_deltas.element_size() + self.values.numel() * self.values.element_size()
+
+    def indices(self):
+        return self.index_deltas.long().cumsum(0)
+
+
+# entries sampled to estimate the top-k threshold, from their own random stream
+TOPK_SAMPLE = 2 ** 16
+topk_generator = torch.Generator().manual_seed(0)
+
+
+def topk_indices(magnitude, k):
+    """
+    Positions of the k largest entries of a flat tensor, in increasing order. A threshold taken
+    from a random sample keeps about 2k candidates, so the exact top-k only runs on those; if the
+    sample underestimates and fewer than k pass, the whole tensor is used.
+    """
+    n = magnitude.numel()
+    if 2 * k < n and n > TOPK_SAMPLE:
+        sample = magnitude[torch.randint(n, (TOPK_SAMPLE,), generator=topk_generator).to(magnitude.device)]
+        threshold = sample.kthvalue(max(1, TOPK_SAMPLE - int(2 * k / n * TOPK_SAMPLE))).values
+        candidates = (magnitude >= threshold).nonzero().squeeze(1)
+        if candidates.numel() >= k:
+            return candidates[magnitude[candidates].topk(k, sorted=False).indices].sort().values
+    return magnitude.topk(k, sorted=False).indices.sort().values
+
+
+def topk_encode(delta, density):
+    """
+    Keep the round(density * numel) entries of largest magnitude of a flat update
+    :return: SparsePayload
+    """
+    k = min(delta.numel(), max(1, round(density * delta.numel())))
+    indices = topk_indices(delta.abs(), k)
+    index_deltas = torch.diff(indices, prepend=indices.new_zeros(1)).to(torch.int32)
+    return SparsePayload(index_deltas, delta[indices], delta.numel())
+
+
+def topk_decode_add(payload, out, alpha=1.0):
+    """
+    out += alpha * the decoded update, as one scatter-add
+    """
+    return out.index_add_(0, payload.indices(), payload.values, alpha=alpha)
+
+
+# --------------------------------------------------
+# Stochastic quantisation (QSGD-style) and sign compression
+# The update is split into buckets of `bucket` entries with one float32 scale each. With b bits an
+# entry becomes an integer level in [-s, s], s = 2^(b-1) - 1, of the bucket's max magnitude, rounded
+# up or down at random so that the decoded update is unbiased; the levels are stored offset by s,
+# 8 / b per byte. Sign compression sends one bit per entry and the mean magnitude of the bucket.
+# --------------------------------------------------
+CODEC_BITS = {'q8': 8, 'q4': 4, 'q2': 2, 'sign': 1}
+# payloads dequantised and summed together
+DECODE_BLOCK = 16
+
+
+def pack_codes(codes, bits):
+    """
+    Pack unsigned codes below 2^bits (uint8, length divisible by 8 / bits) 8 / bits to a byte
+    """
+    per_byte = 8 // bits
+    shifts = torch.arange(0, 8, bits, dtype=torch.uint8, device=codes.device)
+    return torch.bitwise_left_shift(codes.reshape(-1, per_byte), shifts).sum(-1, dtype=torch.uint8)
+
+
+def unpack_codes(packed, bits):
+    """
+    Inverse of pack_codes, along the last dim: (..., n) -> (..., n * 8 / bits) uint8
+    """
+    shifts = torch.arange(0, 8, bits, dtype=torch.uint8, device=packed.device)
+    codes = torch.bitwise_right_shift(packed.unsqueeze(-1), shifts).bitwise_and_(2 ** bits - 1)
+    return codes.reshape(*packed.shape[:-1], -1)
+
+
+class QuantPayload(object):
+    """
+    Quantised update: packed codes of the padded (num_buckets, bucket) update and a scale per bucket
+    """
+
+    def __init__(self, codes, scales, bits, numel):
+        self.codes = codes
+        self.scales = scales
+        self.bits = bits
+        self.numel = numel
+
+    @property
+    def nbytes(self):
+        return self.codes.numel() * self.codes.element_size() + self.scales.numel() * self.scales.element_size()
+
+
+def quantize_update(delta, bits, bucket=512, generator=None):
+    """
+    Stochastic b-bit quantisation (bits 8, 4 or 2) or sign compression (bits 1) of a flat update
+    :return: QuantPayload
+    """
+    x = torch.nn.functional.pad(delta, (0, (-delta.numel()) % bucket)).reshape(-1, bucket)
+    if bits == 1:
+        scales = x.abs().mean(1)
+        codes = (x >= 0).to(torch.uint8)
+    else:
+        levels = 2 ** (bits - 1) - 1
+        scales = x.abs().amax(1)
+        magnitude = x.abs().div_(scales.clamp(min=1e-30).unsqueeze(1)).mul_(levels)
+        magnitude.add_(torch.rand(magnitude.shape, generator=generator, device=magnitude.device)).floor_().clamp_(max=levels)
+        codes = magnitude.copysign_(x).add_(levels).to(torch.uint8)
+    return QuantPayload(pack_codes(codes.reshape(-1), bits).reshape(x.size(0), -1), scales, bits, delta.numel())
+
+
+def dequantize_sum(payloads, out, weights=None):
+    """
+    out += sum_i weights[i] * the decoded payloads[i] (weights 1 if None). The payloads of a block
+    are unpacked together and reduced with a single sum per block.
+    """
+    weights = [1.0] * len(payloads) if weights is None else weights
+    for start in range(0, len(payloads), DECODE_BLOCK):
+        block = payloads[start:start + DECODE_BLOCK]
+        bits = block[0].bits
+        if any(payload.bits != bits for payload in block):
+            raise ValueError("payloads of one block must have the same number of bits")
+        codes = unpack_codes(torch.stack([payload.codes for payload in block]), bits).float()
+        # value per code: levels (code - s) / s of the scale, or sign 2 * code - 1 times the mean magnitude
+        levels = 2 ** (bits - 1) - 1 if bits > 1 else 0.5
+        scales = torch.stack([payload.scales for payload in block]) / levels
+        scales = scales * torch.tensor(weights[start:start + len(block)], device=scales.device).unsqueeze(1)
+        decoded = codes.sub_(levels).mul_(scales.unsqueeze(2)).sum(0)
+        out.add_(decoded.reshape(-1)[:block[0].numel])
+    return out
+
+
+class ErrorFeedback(object):
+    """
+    Per-client residual of the compression (what the decoded payload missed), added to the client's
+    next update. Residuals are kept in bfloat16, in memory or on disk as one file per client.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.residuals = {}
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def path(self, client):
+        return os.path.join(self.directory, 'residual_{}.pt'.format(client))
+
+    def get(self, client, numel):
+        if self.directory is None:
+            residual = self.residuals.get(client)
+        else:
+            residual = torch.load(self.path(client)) if os.path.exists(self.path(client)) else None
+        if residual is None or residual.numel() != numel:
+            return torch.zeros(numel)
+        return residual.float()
+
+    def put(self, client, residual):
+        residual = residual.to(torch.bfloat16)
+        if self.directory is None:
+            self.residuals[client] = residual
+        else:
+            torch.save(residual, self.path(client))
+
+
+class UpdateCompressor(object):
+    """
+    Client-side compression of flat updates with one of CODEC_BITS, with optional error feedback
+    """
+
+    def __init__(self, codec, bucket=512, error_feedback=None, seed=0):
+        """
+        :param codec: q8, q4, q2 (stochastic quantisation) or sign
+        :param error_feedback: ErrorFeedback store, or None
+        :param seed: seed of the stochastic rounding
+        """
+        self.bits = CODEC_BITS[codec]
+        self.bucket = bucket
+        self.error_feedback = error_feedback
+        self.generator = torch.Generator().manual_seed(seed)
+
+    def encode(self, delta, client=None):
+        """
+        :param delta: flat float32 update of the client
+        :param client: key of the client's error-feedback residual
+        :return: QuantPayload
+        """
+        if self.error_feedback is not None:
+            delta = delta + self.error_feedback.get(client, delta.numel())
+        payload = quantize_update(delta, self.bits, self.bucket, self.generator)
+        if self.error_feedback is not None:
+            self.error_feedback.put(client, delta - dequantize_sum([payload], torch.zeros_like(delta)))
+        return payload
+
+
+# --------------------------------------------------
+# Low-rank (PowerSGD-style) compression
+# Every tensor of two or more dims (convs reshaped to C_out x C_in k k) whose rank-r factors are
+# smaller than it is sent as P (rows x r) and Q (cols x r) with delta ~ P Q^T, from one power
+# iteration warm-started with the client's Q of the previous round. Vectors (biases, BNTT scales)
+# and tensors too small to gain are sent uncompressed in one float32 vector.
+# --------------------------------------------------
+class LowRankLayout(object):
+    """
+    Matrices of a flat update: (offset, rows, cols) for every compressed tensor, and the positions
+    of the entries sent uncompressed
+    """
+
+    def __init__(self, shapes, rank):
+        self.rank = rank
+        self.segments = []
+        dense = []
+        offset = 0
+        for shape in shapes:
+            numel = shape.numel()
+            rows = shape[0] if len(shape) >= 2 else 1
+            cols = numel // rows
+            if len(shape) >= 2 and rank * (rows + cols) < numel:
+                self.segments.append((offset, rows, cols))
+            else:
+                dense.append(torch.arange(offset, offset + numel))
+            offset += numel
+        self.numel = offset
+        self.dense_index = torch.cat(dense) if dense else torch.zeros(0, dtype=torch.long)
+
+
+class LowRankPayload(object):
+    """
+    Low-rank update: (P, Q) float32 factors per matrix of the layout and the uncompressed entries
+    """
+
+    def __init__(self, factors, dense, layout):
+        self.factors = factors
+        self.dense = dense
+        self.layout = layout
+        self.numel = layout.numel
+
+    @property
+    def nbytes(self):
+        return sum(p.numel() * p.element_size() + q.numel() * q.element_size() for p, q in self.factors) + \
+            self.dense.numel() * self.dense.element_size()
+
+
+def lowrank_decode_sum(payloads, out, weights=None):
+    """
+    out += sum_i weights[i] * the decoded payloads[i] (weights 1 if None). Within a block the
+    weighted P factors and the Q factors of a matrix are concatenated along the rank, so every
+    matrix is decoded and summed with a single matmul.
+    """
+    weights = [1.0] * len(payloads) if weights is None else weights
+    layout = payloads[0].layout
+    for start in range(0, len(payloads), DECODE_BLOCK):
+        block = payloads[start:start + DECODE_BLOCK]
+        block_weights = weights[start:start + len(block)]
+        for j, (offset, rows, cols) in enumerate(layout.segments):
+            p = torch.cat([payload.factors[j][0] * weight for payload, weight in zip(block, block_weights)], 1)
+            q = torch.cat([payload.factors[j][1] for payload in block], 1)
+            out[offset:offset + rows * cols].view(rows, cols).addmm_(p, q.t())
+        dense = torch.stack([payload.dense for payload in block]).t().mv(torch.tensor(block_weights, dtype=out.dtype))
+        out.index_add_(0, layout.dense_index, dense)
+    return out
+
+
+def decode_sum(payloads, out, weights=None):
+    """
+    out += sum_i weights[i] * the decoded payloads[i], for QuantPayloads or LowRankPayloads
+    """
+    if all(isinstance(payload, LowRankPayload) for payload in payloads):
+        return lowrank_decode_sum(payloads, out, weights)
+    if all(isinstance(payload, QuantPayload) for payload in payloads):
+        return dequantize_sum(payloads, out, weights)
+    raise ValueError("cannot decode a mix of payload types")
+
+
+class LowRankCompressor(object):
+    """
+    Client-side low-rank compression of flat updates, with optional error feedback. The Q factors
+    of every client are kept to warm-start its next power iteration.
+    """
+
+    def __init__(self, shapes, rank=4, error_feedback=None, seed=0):
+        """
+        :param shapes: shapes of the flattened tensors, FlatState.shapes
+        :param rank: rank r of the factors
+        :param error_feedback: ErrorFeedback store, or None
+        :param seed: seed of the initial Q factors
+        """
+        self.layout = LowRankLayout(shapes, rank)
+        self.error_feedback = error_feedback
+        self.generator = torch.Generator().manual_seed(seed)
+        self.warm_start = {}
+
+    def encode(self, delta, client=None):
+        """
+        :param delta: flat float32 update of the client
+        :param client: key of the client's warm start and error-feedback residual
+        :return: LowRankPayload
+        """
+        if self.error_feedback is not None:
+            delta = delta + self.error_feedback.get(client, delta.numel())
+        rank = self.layout.rank
+        previous = self.warm_start.get(client)
+        if previous is None:
+            previous = [torch.randn(cols, rank, generator=self.generator) for _, _, cols in self.layout.segments]
+        factors = []
+        for (offset, rows, cols), q in zip(self.layout.segments, previous):
+            matrix = delta[offset:offset + rows * cols].view(rows, cols)
+            p = torch.linalg.qr(matrix.mm(q)).Q
+            factors.append((p, matrix.t().mm(p)))
+        self.warm_start[client] = [q for _, q in factors]
+        payload = LowRankPayload(factors, delta[self.layout.dense_index], self.layout)
+        if self.error_feedback is not None:
+            self.error_feedback.put(client, delta - lowrank_decode_sum([payload], torch.zeros_like(delta)))
+        return payload
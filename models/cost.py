@@ -0,0 +1,153 @@
+import threading
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+# --------------------------------------------------
+# Compute cost of SNN and ANN inference
+# A layer of an ANN, or a layer fed the analog image (first layer, and direct coding), performs one
+# multiply-accumulate (MAC) per connection. A spiking layer only performs an accumulate (SynOp) per
+# connection of a nonzero input, so its cost follows the measured spikes. Energy uses per-op costs,
+# by default the 45nm CMOS figures of Horowitz (ISSCC 2014), 4.6 pJ per 32-bit MAC and 0.9 pJ per
+# 32-bit add, the usual basis of SNN / ANN energy comparisons.
+# --------------------------------------------------
+ENERGY_MAC = 4.6
+ENERGY_AC = 0.9
+# inference / training entry points of the BNTT models besides forward, counted like it
+ENTRY_POINTS = ('forward_early_exit', 'forward_horizons', 'forward_truncated')
+
+
+def dense_connections(layer, output):
+    """
+    Connections evaluated by a Conv2d / Linear layer that visits every input, for the whole batch
+    """
+    if isinstance(layer, nn.Conv2d):
+        return output.numel() * layer.in_channels // layer.groups * layer.kernel_size[0] * layer.kernel_size[1]
+    return output.numel() * layer.in_features
+
+
+def active_connections(layer, x):
+    """
+    Connections of the nonzero entries of x through a Conv2d / Linear layer, for the whole batch,
+    as a 0-dim float64 tensor on the device of x. Exact at the borders: the active inputs reached by
+    every output are counted with a single-channel convolution.
+    """
+    active = x.detach().ne(0)
+    if isinstance(layer, nn.Conv2d):
+        per_position = active.sum(1, keepdim=True, dtype=x.dtype)
+        window = per_position.new_ones(1, 1, *layer.kernel_size)
+        reached = F.conv2d(per_position, window, stride=layer.stride, padding=layer.padding, dilation=layer.dilation)
+        return reached.sum(dtype=torch.float64) * (layer.out_channels // layer.groups)
+    return active.sum(dtype=torch.float64) * layer.out_features
+
+
+class OpCounter(object):
+    """
+    Counts the MACs and SynOps of every Conv2d / Linear layer during the forward of a model, keeping
+    the spike-dependent counts on the device until read. Only calls of the model's forward and of its
+    ENTRY_POINTS are counted.
+
+        counter = OpCounter(net, spiking=True)
+        test_img(net, dataset_test, args)
+        cost = counter.read()
+        counter.remove()
+    """
+
+    def __init__(self, net, spiking):
+        """
+        :param net: model, or nn.DataParallel of one
+        :param spiking: True for an SNN, whose layers are counted in SynOps except the ones fed the model input
+        """
+        model = net.module if isinstance(net, nn.DataParallel) else net
+        self.spiking = spiking
+        self.layers = [m for m in model.modules() if isinstance(m, (nn.Conv2d, nn.Linear))]
+        # copied to the layers of DataParallel replicas, which are other module objects
+        for i, layer in enumerate(self.layers):
+            layer.op_index = i
+        self.handles = [model.register_forward_pre_hook(self.enter), model.register_forward_hook(self.exit)]
+        self.handles += [layer.register_forward_hook(self.count) for layer in self.layers]
+        # the other entry points bypass the model hooks, they are wrapped on the instance
+        self.model = model
+        self.entry_points = [name for name in ENTRY_POINTS if hasattr(model, name)]
+        for name in self.entry_points:
+            setattr(model, name, self.counted(getattr(model, name)))
+        # the model input of the forward running in this thread, one per DataParallel replica
+        self.current = threading.local()
+        self.reset()
+
+    def reset(self):
+        """
+        Zero all the counts
+        """
+        self.samples = 0
+        self.macs = [0] * len(self.layers)
+        self.synops = [None] * len(self.layers)
+
+    def remove(self):
+        """
+        Detach from the model
+        """
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        for name in self.entry_points:
+            delattr(self.model, name)
+        self.entry_points = []
+
+    def enter(self, module, inputs):
+        self.current.inp = inputs[0]
+        self.samples += inputs[0].size(0)
+
+    def exit(self, module, inputs, output):
+        self.current.inp = None
+
+    def counted(self, method):
+        """
+        method of the model, counted like its forward
+        """
+        def run(inp, *args, **kwargs):
+            self.enter(self.model, (inp,))
+            try:
+                return method(inp, *args, **kwargs)
+            finally:
+                self.exit(self.model, (inp,), None)
+        return run
+
+    def count(self, layer, inputs, output):
+        inp = getattr(self.current, 'inp', None)
+        if inp is None:
+            return
+        i = layer.op_index
+        x = inputs[0]
+        if not self.spiking or x is inp:
+            self.macs[i] += dense_connections(layer, output)
+            return
+        synops = active_connections(layer, x)
+        if self.synops[i] is None:
+            self.synops[i] = synops
+        else:
+            self.synops[i] = self.synops[i] + synops.to(self.synops[i].device)
+
+    def read(self, energy_mac=ENERGY_MAC, energy_ac=ENERGY_AC):
+        """
+        Copy the counts to the host.
+        :param energy_mac: energy of a MAC, pJ
+        :param energy_ac: energy of an accumulate, pJ
+        :return: dict with the totals 'macs', 'synops', 'energy' (pJ) since the last reset, the same
+            per inference in 'macs_per_inference', 'synops_per_inference', 'energy_per_inference',
+            and the per-layer 'layer_macs', 'layer_synops'
+        """
+        counted = [s for s in self.synops if s is not None]
+        values = torch.stack([s.to(counted[0].device) for s in counted]).cpu().tolist() if counted else []
+        layer_synops = []
+        for s in self.synops:
+            layer_synops.append(values.pop(0) if s is not None else 0.0)
+        macs, synops = sum(self.macs), sum(layer_synops)
+        energy = macs * energy_mac + synops * energy_ac
+        samples = max(self.samples, 1)
+        return {'macs': macs, 'synops': synops, 'energy': energy,
+                'macs_per_inference': macs / samples, 'synops_per_inference': synops / samples,
+                'energy_per_inference': energy / samples,
+                'layer_macs': list(self.macs), 'layer_synops': layer_synops}
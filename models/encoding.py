@@ -0,0 +1,164 @@
+import sys
+
+import torch
+import torch.nn.functional as F
+
+
+# --------------------------------------------------
+# Poisson spike generator
+#   Positive spike is generated (i.e.  1 is returned) if rand()<=abs(input) and sign(input)= 1
+#   Negative spike is generated (i.e. -1 is returned) if rand()<=abs(input) and sign(input)=-1
+# --------------------------------------------------
+def PoissonGen(inp, rescale_fac=2.0, generator=None):
+    if generator is None:
+        return poisson_spikes(inp, rescale_fac)
+    rand_inp = torch.empty_like(inp).uniform_(generator=generator)
+    return torch.mul(torch.le(rand_inp * rescale_fac, torch.abs(inp)).float(), torch.sign(inp))
+
+
+# Encoding rules without generator objects, TorchScript compatible (see models/export.py)
+def poisson_spikes(inp, rescale_fac: float = 2.0):
+    return torch.mul(torch.le(torch.rand_like(inp) * rescale_fac, torch.abs(inp)).float(), torch.sign(inp))
+
+
+def rate_spikes(inp, t: int, rescale_fac: float = 2.0):
+    rate = torch.abs(inp).div(rescale_fac).clamp_(max=1.0)
+    fired = torch.gt(torch.floor(rate * (t + 1)), torch.floor(rate * t))
+    return torch.mul(fired.float(), torch.sign(inp))
+
+
+# --------------------------------------------------
+# Spike encoders of the rate-coded models
+# An encoder is called as encoder(inp, t) and returns the input spikes of timestep t.
+# --------------------------------------------------
+class PoissonEncoder(object):
+    """
+    Poisson rate coding, a fresh draw at every timestep. With a seed the draws come from a private
+    generator per device instead of the global RNG, so the stream is reproducible and does not shift
+    the random numbers drawn elsewhere (dropout, data shuffling).
+    """
+
+    def __init__(self, rescale_fac=2.0, seed=None):
+        self.rescale_fac = rescale_fac
+        self.seed = seed
+        self.generators = {}
+
+    def generator(self, device):
+        if self.seed is None:
+            return None
+        if device not in self.generators:
+            self.generators[device] = torch.Generator(device=device)
+            self.generators[device].manual_seed(self.seed)
+        return self.generators[device]
+
+    def get_state(self):
+        return {device: generator.get_state() for device, generator in self.generators.items()}
+
+    def set_state(self, state):
+        """
+        Rewind the generators to a get_state(); those created since then start again from the seed
+        """
+        for device in list(self.generators):
+            if device in state:
+                self.generators[device].set_state(state[device])
+            else:
+                del self.generators[device]
+
+    def __call__(self, inp, t):
+        return PoissonGen(inp, self.rescale_fac, self.generator(inp.device))
+
+
+class RateEncoder(object):
+    """
+    Deterministic rate coding: a pixel fires at the same average rate |inp| / rescale_fac as the
+    Poisson encoder, but at evenly spaced timesteps, i.e. at t whenever floor((t+1) r) > floor(t r).
+    No random numbers are drawn, so an image always gives the same spike train.
+    """
+
+    def __init__(self, rescale_fac=2.0, seed=None):
+        self.rescale_fac = rescale_fac
+
+    def __call__(self, inp, t):
+        return rate_spikes(inp, t, self.rescale_fac)
+
+
+ENCODERS = {
+    'poisson': PoissonEncoder,
+    'rate': RateEncoder,
+}
+
+
+def build_encoder(name, seed=None):
+    """
+    :param name: a key of ENCODERS
+    :param seed: seed of the encoder's own random stream, None to use the global RNG
+    """
+    if name not in ENCODERS:
+        sys.exit("Unknown encoder '{}'".format(name))
+    return ENCODERS[name](seed=seed)
+
+
+# --------------------------------------------------
+# Bit-packed spike trains
+# --------------------------------------------------
+def pack_bits(x):
+    """
+    Pack a bool tensor (N, ...) into uint8 (N, ceil(D / 8)), D being the number of elements per sample
+    """
+    x = x.reshape(x.size(0), -1).to(torch.uint8)
+    x = F.pad(x, (0, (-x.size(1)) % 8)).reshape(x.size(0), -1, 8)
+    shifts = torch.arange(8, dtype=torch.uint8, device=x.device)
+    return torch.bitwise_left_shift(x, shifts).sum(-1, dtype=torch.uint8)
+
+
+def unpack_bits(packed, numel):
+    """
+    Inverse of pack_bits, returns a uint8 0/1 tensor (N, numel)
+    """
+    shifts = torch.arange(8, dtype=torch.uint8, device=packed.device)
+    bits = torch.bitwise_right_shift(packed.unsqueeze(-1), shifts).bitwise_and_(1)
+    return bits.reshape(packed.size(0), -1)[:, :numel]
+
+
+class SpikeTrainCache(object):
+    """
+    Input spike trains of a fixed set of images, encoded once and kept bit-packed: one bit per pixel
+    per timestep for the spikes and one bit per pixel for their sign. Replaying them gives exactly
+    the same input spikes every round without drawing any random numbers.
+    """
+
+    def __init__(self, encoder, batches, timesteps):
+        """
+        :param encoder: encoder the trains are drawn from
+        :param batches: iterable of image batches (B, C, H, W), concatenated in order
+        :param timesteps: number of timesteps to encode
+        """
+        self.timesteps = timesteps
+        spikes, negative = [], []
+        for images in batches:
+            self.shape = images.shape[1:]
+            spikes.append(torch.stack([pack_bits(encoder(images, t) != 0) for t in range(timesteps)], dim=1))
+            negative.append(pack_bits(images < 0))
+        self.numel = self.shape.numel()
+        self.spikes = torch.cat(spikes)
+        self.negative = torch.cat(negative)
+
+    def replay(self, index):
+        """
+        Encoder that returns the cached trains of the images in index, in that order
+        """
+        return ReplayEncoder(self, index)
+
+
+class ReplayEncoder(object):
+    def __init__(self, cache, index):
+        self.cache = cache
+        self.index = index
+
+    def select(self, keep):
+        self.index = self.index[keep]
+
+    def __call__(self, inp, t):
+        spikes = unpack_bits(self.cache.spikes[self.index, t], self.cache.numel).to(inp.dtype)
+        negative = unpack_bits(self.cache.negative[self.index], self.cache.numel).to(inp.dtype)
+        return spikes.mul_(negative.mul_(-2).add_(1)).reshape(inp.shape)
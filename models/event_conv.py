@@ -0,0 +1,83 @@
+from typing import List, Optional
+
+import torch
+import torch.nn.functional as F
+from torch.nn.modules.utils import _pair
+
+
+# --------------------------------------------------
+# Event-driven layers for sparse spike maps
+# Only the nonzero inputs (events) are visited and each one scatters its column of the weight into
+# the outputs it reaches, so the cost grows with the number of spikes instead of the layer size.
+# The functions are TorchScript compatible (stride / padding may also be ints in eager mode).
+# --------------------------------------------------
+def event_conv2d(x, weight, bias: Optional[torch.Tensor] = None, stride: List[int] = (1, 1), padding: List[int] = (0, 0)):
+    """
+    F.conv2d(x, weight, bias, stride, padding) computed from the nonzero entries of x only.
+    Every event adds its weight columns to the full (stride 1, unpadded) correlation, which needs no
+    bounds checks; the requested padding and stride are then a crop and a strided slice of it.
+    :param x: (B, C_in, H, W) input, typically spikes
+    :param weight: (C_out, C_in, kh, kw)
+    """
+    stride, padding = _pair(stride), _pair(padding)
+    batch, in_channels, height, width = x.shape
+    out_channels, _, kh, kw = weight.shape
+    full_h, full_w = height + kh - 1, width + kw - 1
+
+    events = x.nonzero()
+    b, c, y, z = events[:, 0], events[:, 1], events[:, 2], events[:, 3]
+    values = x[b, c, y, z].unsqueeze(1)
+    rows = (b * full_h + y) * full_w + z
+    # (kh, kw, C_in, C_out), so the weights an event adds at one offset are one contiguous row
+    weight_rows = weight.permute(2, 3, 1, 0).contiguous()
+    out = x.new_zeros(batch * full_h * full_w, out_channels)
+    for ky in range(kh):
+        for kx in range(kw):
+            # offset (ky, kx) of an event at (y, z) lands at (y + kh-1-ky, z + kw-1-kx) of the full output
+            shift = (kh - 1 - ky) * full_w + (kw - 1 - kx)
+            out.index_add_(0, rows + shift, weight_rows[ky, kx].index_select(0, c).mul_(values))
+    out = out.reshape(batch, full_h, full_w, out_channels).permute(0, 3, 1, 2)
+
+    # full output row r is padded input row r - (kh-1) + padding, pad it where the padding reaches further
+    h_out = (height + 2 * padding[0] - kh) // stride[0] + 1
+    w_out = (width + 2 * padding[1] - kw) // stride[1] + 1
+    top, left = kh - 1 - padding[0], kw - 1 - padding[1]
+    bottom = top + (h_out - 1) * stride[0] + 1 - full_h
+    right = left + (w_out - 1) * stride[1] + 1 - full_w
+    out = F.pad(out, (max(-left, 0), max(right, 0), max(-top, 0), max(bottom, 0)))
+    top, left = max(top, 0), max(left, 0)
+    out = out[:, :, top:top + (h_out - 1) * stride[0] + 1:stride[0], left:left + (w_out - 1) * stride[1] + 1:stride[1]]
+    if bias is not None:
+        out = out + bias.reshape(1, -1, 1, 1)
+    return out
+
+
+def event_linear(x, weight, bias: Optional[torch.Tensor] = None):
+    """
+    F.linear(x, weight, bias) restricted to the input features that are nonzero in some sample
+    """
+    active = x.any(0).nonzero()[:, 0]
+    return F.linear(x[:, active], weight[:, active], bias)
+
+
+def spike_density(x) -> float:
+    return float(torch.count_nonzero(x).item()) / x.numel()
+
+
+def adaptive_conv2d(x, weight, bias: Optional[torch.Tensor] = None, stride: List[int] = (1, 1), padding: List[int] = (0, 0),
+                    sparse_threshold: float = 0.0):
+    """
+    event_conv2d when the measured density of x is below sparse_threshold, dense F.conv2d otherwise
+    """
+    if sparse_threshold > 0 and spike_density(x) < sparse_threshold:
+        return event_conv2d(x, weight, bias, stride, padding)
+    return F.conv2d(x, weight, bias, stride, padding)
+
+
+def adaptive_linear(x, weight, bias: Optional[torch.Tensor] = None, sparse_threshold: float = 0.0):
+    """
+    event_linear when the measured density of x is below sparse_threshold, dense F.linear otherwise
+    """
+    if sparse_threshold > 0 and spike_density(x) < sparse_threshold:
+        return event_linear(x, weight, bias)
+    return F.linear(x, weight, bias)
@@ -0,0 +1,241 @@
+import sys
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.spiking import lif_inference, spiking_layers
+from models.encoding import PoissonEncoder, RateEncoder, poisson_spikes, rate_spikes
+from models.event_conv import adaptive_conv2d, adaptive_linear
+
+
+# --------------------------------------------------
+# Inference export of the BNTT models
+# In eval mode bntt[t] is a per-channel affine map of the layer output,
+#   bntt[t](W * s) = (W * s - mean_t) * weight_t / sqrt(var_t + eps) = (scale_t W) * s + shift_t
+# so it is folded into a per-timestep weight and bias of the layer and no BatchNorm is left.
+# --------------------------------------------------
+def calibrate_bntt(net, batches):
+    """
+    Per-timestep statistics of the BNTT inputs of a model that does not track running stats
+    (SNN_VGG9_BNTT), pooled over all the samples of the calibration batches.
+    :param net: BNTT model built from conv_list / bntt_list / fc1 / fc2
+    :param batches: iterable of input batches on the model's device
+    :return: {bn module: (mean, var)}
+    """
+    sums = {}
+
+    def hook(bn, inputs, output):
+        x = inputs[0].detach().double()
+        dims = [d for d in range(x.dim()) if d != 1]
+        count = x.numel() // x.size(1)
+        s, sq, n = sums.get(bn, (0, 0, 0))
+        sums[bn] = (s + x.sum(dims), sq + x.pow(2).sum(dims), n + count)
+
+    handles = [net.bntt_list[i][t].register_forward_hook(hook)
+               for i in range(len(net.bntt_list)) for t in range(net.timesteps)]
+    # the layer-major forward calls batch_norm directly, so calibrate with the time-major one
+    was_training, layer_major = net.training, net.layer_major
+    net.eval()
+    net.layer_major = False
+    with torch.no_grad():
+        for inp in batches:
+            net(inp)
+    net.train(was_training)
+    net.layer_major = layer_major
+    for handle in handles:
+        handle.remove()
+
+    stats = {}
+    for bn, (s, sq, n) in sums.items():
+        mean = s / n
+        stats[bn] = (mean.float(), (sq / n - mean.pow(2)).clamp(min=0).float())
+    return stats
+
+
+def calibrate_running_stats(net, batches):
+    """
+    Calibrate the BNTT of a model that does not track running stats (SNN_VGG9_BNTT) so that eval mode
+    normalises with fixed per-timestep statistics instead of those of the batch: predictions then no
+    longer depend on the batch composition and batch size 1 works. The statistics are installed as
+    non-persistent running_mean / running_var buffers, so the state_dict is unchanged and training
+    still uses batch statistics; calibrate again after the weights change.
+    Batch invariance is exact in float64. In fp32 the batched kernels round differently, which can
+    flip a spike whose membrane is at the threshold; with direct coding a flip propagates through the
+    layers and the outputs can differ by tenths (predictions rarely change), with rate coding they
+    agree to about 1e-7.
+    Only the timesteps below net.timesteps are calibrated, the others keep batch statistics.
+    :param net: BNTT model, or nn.DataParallel of one; no-op for models that track running stats
+    :param batches: iterable of input batches on the model's device
+    """
+    model = net.module if isinstance(net, nn.DataParallel) else net
+    bns = [bn for bntt in getattr(model, 'bntt_list', []) for bn in bntt if not bn.track_running_stats]
+    if not bns:
+        return
+    # drop the previous calibration, the statistics are measured with batch statistics
+    for bn in bns:
+        bn.running_mean = bn.running_var = None
+    dtype = next(model.parameters()).dtype
+    for bn, (mean, var) in calibrate_bntt(model, batches).items():
+        bn.register_buffer('running_mean', mean.to(dtype), persistent=False)
+        bn.register_buffer('running_var', var.to(dtype), persistent=False)
+
+
+def bntt_affine(bn, stats=None):
+    """
+    (scale, shift) of a BatchNorm in eval mode, from its running stats or from calibrated (mean, var)
+    """
+    if stats is not None:
+        mean, var = stats
+    elif bn.running_mean is not None:
+        mean, var = bn.running_mean, bn.running_var
+    else:
+        sys.exit("BNTT without running stats needs calibration batches to be folded")
+    scale = torch.rsqrt(var + bn.eps)
+    if bn.weight is not None:
+        scale = scale * bn.weight
+    shift = -mean * scale
+    if bn.bias is not None:
+        shift = shift + bn.bias
+    return scale.detach(), shift.detach()
+
+
+class FoldedLayer(nn.Module):
+    """
+    One spiking layer of FoldedBNTT with the pooling that follows it. Holds the folded per-timestep
+    weight (T, C_out, ...) and bias (T, C_out), or for the direct-coded first layer (static) the plain
+    weight and the per-timestep (scale, shift) of its output.
+    """
+
+    def __init__(self, layer, scale, shift, static, pool, sparse_threshold):
+        super(FoldedLayer, self).__init__()
+        self.is_conv = isinstance(layer, nn.Conv2d)
+        self.stride = list(layer.stride) if self.is_conv else [1, 1]
+        self.padding = list(layer.padding) if self.is_conv else [0, 0]
+        self.threshold = float(layer.threshold)
+        self.static = static
+        self.sparse_threshold = sparse_threshold
+        self.pool = pool if pool is not False else nn.Identity()
+
+        timesteps = scale.size(0)
+        weight = layer.weight.detach()
+        if static:
+            self.register_buffer('weight', weight.clone())
+            self.register_buffer('bias', weight.new_zeros(0))
+            self.register_buffer('scale', scale.reshape(timesteps, -1, *[1] * (weight.dim() - 2)))
+            self.register_buffer('shift', shift.reshape(timesteps, -1, *[1] * (weight.dim() - 2)))
+        else:
+            folded = weight.unsqueeze(0) * scale.reshape(timesteps, -1, *[1] * (weight.dim() - 1))
+            self.register_buffer('weight', folded.contiguous())
+            self.register_buffer('bias', shift.contiguous())
+            self.register_buffer('scale', weight.new_zeros(0))
+            self.register_buffer('shift', weight.new_zeros(0))
+
+    def static_current(self, inp):
+        """
+        Unscaled output of the static layer, computed once per batch
+        """
+        return F.conv2d(inp, self.weight, None, self.stride, self.padding)
+
+    def current(self, x, t: int):
+        if self.static:
+            # x is static_current(inp)
+            return torch.addcmul(self.shift[t], x, self.scale[t])
+        if self.is_conv:
+            return adaptive_conv2d(x, self.weight[t], self.bias[t], self.stride, self.padding, self.sparse_threshold)
+        return adaptive_linear(x.reshape(x.size(0), -1), self.weight[t], self.bias[t], self.sparse_threshold)
+
+
+class FoldedBNTT(nn.Module):
+    """
+    Inference-only copy of a BNTT model with bntt[t] folded into per-timestep weights and biases of
+    every spiking layer, so each layer-step is a single conv / linear call and no BatchNorm runs.
+    With direct coding the first layer keeps a single weight and applies the folded (scale, shift) to
+    its once-per-batch output instead, so conv1 still runs once.
+    Layers whose input spike density is below sparse_threshold at a timestep run event-driven.
+    The module can be compiled with torch.jit.script. Direct coding and the unseeded Poisson and rate
+    encoders are part of the script; other encoders (seeded, replayed) only run in eager mode.
+    """
+
+    def __init__(self, net, stats=None, sparse_threshold=0.0):
+        """
+        :param net: trained BNTT model
+        :param stats: calibrated {bn module: (mean, var)} from calibrate_bntt, needed for the models
+            without running stats
+        :param sparse_threshold: input density below which a layer uses the event-driven kernels, 0 for always dense
+        """
+        super(FoldedBNTT, self).__init__()
+        stats = stats if stats is not None else {}
+        self.timesteps = net.timesteps
+        self.leak_mem = float(net.leak_mem)
+        self.num_cls = net.num_cls
+        self.direct = bool(net.direct)
+        self.encoder = net.encoder
+        self.encoding = 'python'
+        self.rescale_fac = float(getattr(net.encoder, 'rescale_fac', 2.0))
+        if isinstance(net.encoder, PoissonEncoder) and net.encoder.seed is None:
+            self.encoding = 'poisson'
+        elif isinstance(net.encoder, RateEncoder):
+            self.encoding = 'rate'
+
+        layers = []
+        pool_list = net.pool_list + [False]
+        for i, layer in enumerate(spiking_layers(net)):
+            affine = [bntt_affine(net.bntt_list[i][t], stats.get(net.bntt_list[i][t])) for t in range(self.timesteps)]
+            scale = torch.stack([a[0] for a in affine])
+            shift = torch.stack([a[1] for a in affine])
+            layers.append(FoldedLayer(layer, scale, shift, i == 0 and self.direct, pool_list[i], sparse_threshold))
+        self.layers = nn.ModuleList(layers)
+        self.num_layers = len(layers)
+        self.register_buffer('weight_fc2', net.fc2.weight.detach().clone())
+
+    def encode(self, inp, t: int):
+        if self.encoding == 'poisson':
+            return poisson_spikes(inp, self.rescale_fac)
+        if self.encoding == 'rate':
+            return rate_spikes(inp, t, self.rescale_fac)
+        return self.python_encode(inp, t)
+
+    @torch.jit.unused
+    def python_encode(self, inp, t: int) -> torch.Tensor:
+        return self.encoder(inp, t)
+
+    def forward(self, inp):
+        batch_size = inp.size(0)
+        # membranes start at rest, lif_inference allocates them on the first timestep
+        mems: List[Optional[torch.Tensor]] = [None for _ in range(self.num_layers)]
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
+        static_input = inp
+        if self.direct:
+            static_input = self.layers[0].static_current(inp)
+
+        for t in range(self.timesteps):
+            out_prev = static_input if self.direct else self.encode(inp, t)
+            for i, layer in enumerate(self.layers):
+                out_prev, mem = lif_inference(layer.current(out_prev, t), mems[i], self.leak_mem, layer.threshold)
+                mems[i] = mem
+                out_prev = layer.pool(out_prev)
+
+            # accumulate voltage in the last layer
+            mem_fc2 = mem_fc2 + F.linear(out_prev, self.weight_fc2)
+
+        return mem_fc2 / self.timesteps
+
+
+def export_inference(net, calib_batches=None, sparse_threshold=0.0):
+    """
+    Fold the BNTT of a trained model into an inference-only FoldedBNTT.
+    :param net: BNTT model, or nn.DataParallel of one
+    :param calib_batches: input batches used to calibrate the statistics of models that do not track
+        running stats; ignored otherwise
+    :param sparse_threshold: input spike density below which a layer runs event-driven
+    :return: FoldedBNTT in eval mode
+    """
+    model = net.module if isinstance(net, nn.DataParallel) else net
+    stats = {}
+    if model.bntt_list[0][0].running_mean is None:
+        if calib_batches is None:
+            sys.exit("{} does not track running stats, export_inference needs calib_batches".format(type(model).__name__))
+        stats = calibrate_bntt(model, calib_batches)
+    return FoldedBNTT(model, stats, sparse_threshold).eval()
@@ -0,0 +1,253 @@
+import sys
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.spiking import spiking_layers
+from models.export import calibrate_bntt, bntt_affine
+
+
+# --------------------------------------------------
+# Integer fixed-point inference of the SNNs
+# Every spiking layer becomes int8 weights with BNTT folded in (one set per timestep), requantisation
+# multipliers that bring the weighted sums to membrane units, an integer bias and an integer threshold.
+# As in FBGEMM, requantisation is one float multiply-add rounded to the nearest integer.
+# Membranes are int32, the leak is a fixed-point multiply and shift, and average pooling becomes a
+# sum pool whose 1/k^2 is folded into the next layer. Layer inputs are spikes, spike counts or the
+# int8 image, so the weighted sums are integers. They run on the float conv / linear kernels, which
+# are exact for integers below 2^24 (float64 is used for layers whose worst case can exceed that).
+# --------------------------------------------------
+WEIGHT_MAX = 127
+# membrane resolution: the firing threshold is 2^12 units
+THRESHOLD_UNITS = 2 ** 12
+LEAK_BITS = 12
+# membranes saturate here, so the leak multiply stays within int32
+MEM_MAX = 2 ** (31 - LEAK_BITS) - 1
+# added before the shift, so the fixed-point leak rounds to nearest instead of towards -inf
+LEAK_ROUND = 2 ** (LEAK_BITS - 1)
+
+
+def snn_affine_layers(net, stats=None):
+    """
+    Spiking layers of a model as (layer, scale (T, C_out), shift (T, C_out), pool) with
+    current_t = scale_t * layer(x) + shift_t: the folded BNTT, or (1 - leak) for the models without BNTT
+    """
+    stats = stats if stats is not None else {}
+    pool_list = net.pool_list + [False]
+    affine_layers = []
+    for i, layer in enumerate(spiking_layers(net)):
+        out_features = layer.out_channels if isinstance(layer, nn.Conv2d) else layer.out_features
+        if hasattr(net, 'bntt_list'):
+            affine = [bntt_affine(net.bntt_list[i][t], stats.get(net.bntt_list[i][t])) for t in range(net.timesteps)]
+            scale = torch.stack([a[0] for a in affine])
+            shift = torch.stack([a[1] for a in affine])
+        else:
+            scale = layer.weight.new_full((net.timesteps, out_features), 1 - net.leak_mem)
+            shift = layer.weight.new_zeros(net.timesteps, out_features)
+        affine_layers.append((layer, scale.detach(), shift.detach(), pool_list[i]))
+    return affine_layers
+
+
+def pool_kernel(pool):
+    """
+    Side of a non-overlapping AvgPool2d, 0 for no pooling
+    """
+    if pool is False:
+        return 0
+    if not isinstance(pool, nn.AvgPool2d) or pool.padding not in (0, (0, 0)):
+        sys.exit("Integer inference supports unpadded AvgPool2d only, got {}".format(pool))
+    kernel = pool.kernel_size if isinstance(pool.kernel_size, int) else pool.kernel_size[0]
+    stride = pool.stride if isinstance(pool.stride, int) else pool.stride[0]
+    if stride != kernel:
+        sys.exit("Integer inference supports non-overlapping AvgPool2d only, got {}".format(pool))
+    return kernel
+
+
+def quantize_weight(weight, dim):
+    """
+    Symmetric int8 quantisation with one scale per index of the leading dims
+    :param dim: the dims from dim on share a scale, e.g. 2 for (T, C_out, ...) per timestep and channel
+    :return: (int8 weight, scale of shape weight.shape[:dim])
+    """
+    scale = weight.abs().amax(dim=list(range(dim, weight.dim()))).clamp(min=1e-12) / WEIGHT_MAX
+    quantized = torch.round(weight / scale.reshape(*scale.shape, *[1] * (weight.dim() - dim)))
+    return quantized.clamp_(-WEIGHT_MAX, WEIGHT_MAX).to(torch.int8), scale
+
+
+class IntegerLayer(nn.Module):
+    """
+    One spiking layer of IntegerSNN and the pooling that follows it. The integer weighted sums are
+    rescaled to membrane units by a multiplier per timestep and channel, so every
+    timestep keeps its own int8 weight scale (the BNTT scales differ a lot between timesteps).
+    The direct-coded first layer (static) sees the same input at every timestep: it keeps the plain
+    weight, runs one conv per batch and applies the per-timestep BNTT scale in its multipliers.
+    """
+
+    def __init__(self, layer, scale, shift, pool, unit_in, max_input, static):
+        """
+        :param layer: Conv2d / Linear of the model
+        :param scale, shift: (T, C_out) affine of its output
+        :param pool: pooling after the layer, or False
+        :param unit_in: value of one unit of the layer input (pooling of the previous layer folded in)
+        :param max_input: largest magnitude of the integer input
+        :param static: direct-coded first layer
+        """
+        super(IntegerLayer, self).__init__()
+        self.is_conv = isinstance(layer, nn.Conv2d)
+        self.stride = layer.stride if self.is_conv else 1
+        self.padding = layer.padding if self.is_conv else 0
+        self.static = static
+        self.pool_kernel = pool_kernel(pool)
+        self.timesteps = scale.size(0)
+
+        weight = layer.weight.detach()
+        if static:
+            quantized, weight_scale = quantize_weight(weight, 1)
+            weight_scale = scale * weight_scale
+        else:
+            folded = weight.unsqueeze(0) * scale.reshape(self.timesteps, -1, *[1] * (weight.dim() - 1))
+            quantized, weight_scale = quantize_weight(folded, 2)
+        # the threshold is THRESHOLD_UNITS membrane units
+        unit = float(layer.threshold) / THRESHOLD_UNITS
+        self.register_buffer('weight', quantized.contiguous())
+        self.register_buffer('multiplier', weight_scale * unit_in / unit)
+        self.register_buffer('bias', torch.round(shift / unit))
+
+        # exact float accumulation needs every weighted sum below 2^24
+        fan_in = weight[0].numel()
+        self.accumulate_dtype = torch.float32 if WEIGHT_MAX * max_input * fan_in < 2 ** 24 else torch.float64
+        self.register_buffer('weight_kernel', self.weight.to(self.accumulate_dtype), persistent=False)
+
+    def weighted_sum(self, x, weight):
+        """
+        Integer weighted sum of the integer-valued x, exact in accumulate_dtype
+        """
+        x = x.to(self.accumulate_dtype)
+        if self.is_conv:
+            return F.conv2d(x, weight, None, self.stride, self.padding)
+        return F.linear(x.reshape(x.size(0), -1), weight)
+
+    def rescale(self, out, multiplier, bias):
+        """
+        Membrane-unit current round(out * multiplier + bias), as int32
+        """
+        return torch.addcmul(bias, out, multiplier).round_().to(torch.int32)
+
+    def static_currents(self, x):
+        """
+        (T, B, C_out, ...) integer currents of the static layer for all timesteps
+        """
+        out = self.weighted_sum(x, self.weight_kernel).unsqueeze(0)
+        shape = (self.timesteps, 1, -1, *[1] * (out.dim() - 3))
+        return self.rescale(out, self.multiplier.reshape(shape), self.bias.reshape(shape))
+
+    def current(self, x, t):
+        out = self.weighted_sum(x, self.weight_kernel[t])
+        shape = (1, -1, *[1] * (out.dim() - 2))
+        return self.rescale(out, self.multiplier[t].reshape(shape), self.bias[t].reshape(shape))
+
+    def output(self, spikes):
+        """
+        Input of the next layer: the spikes, or their sum over each pooling window
+        """
+        if self.pool_kernel:
+            return F.avg_pool2d(spikes, self.pool_kernel, divisor_override=1)
+        return spikes
+
+
+class IntegerSNN(nn.Module):
+    """
+    Integer fixed-point inference copy of a trained SNN: int8 weights with BNTT folded in, int32
+    membranes with a fixed-point leak and a threshold of THRESHOLD_UNITS. Rate-coded inputs are integer spikes;
+    with direct coding the image is quantised to int8 with a calibrated scale. Only the averaged
+    output voltage is converted back to float.
+    """
+
+    def __init__(self, net, stats=None, input_scale=1.0):
+        """
+        :param net: trained SNN_VGG9_BNTT / Simple_* model
+        :param stats: calibrated {bn module: (mean, var)} from calibrate_bntt, for the models without running stats
+        :param input_scale: value of one unit of the int8 image, direct coding only
+        """
+        super(IntegerSNN, self).__init__()
+        self.timesteps = net.timesteps
+        self.num_cls = net.num_cls
+        self.direct = bool(net.direct)
+        self.encoder = net.encoder
+        self.input_scale = input_scale if self.direct else 1.0
+        self.leak = round(net.leak_mem * 2 ** LEAK_BITS)
+
+        layers = []
+        unit_in, max_input = self.input_scale, WEIGHT_MAX if self.direct else 1
+        for i, (layer, scale, shift, pool) in enumerate(snn_affine_layers(net, stats)):
+            layers.append(IntegerLayer(layer, scale, shift, pool, unit_in, max_input, i == 0 and self.direct))
+            # a sum pool over k x k spikes: one input unit is 1/k^2 of a spike, up to k^2 of them
+            kernel = layers[-1].pool_kernel
+            unit_in, max_input = (1.0 / kernel ** 2, kernel ** 2) if kernel else (1.0, 1)
+        self.layers = nn.ModuleList(layers)
+        weight_fc2, scale_fc2 = quantize_weight(net.fc2.weight.detach(), 1)
+        self.register_buffer('weight_fc2', weight_fc2)
+        self.register_buffer('scale_fc2', scale_fc2)
+        self.register_buffer('weight_kernel_fc2', self.weight_fc2.float(), persistent=False)
+
+    def quantize_input(self, inp):
+        return torch.round(inp / self.input_scale).clamp_(-WEIGHT_MAX, WEIGHT_MAX)
+
+    def lif(self, current, mem):
+        """
+        Integer integrate-then-fire: mem' = round(leak * mem) + current, spike = mem' > threshold, soft reset
+        """
+        if mem is None:
+            mem = current
+        else:
+            mem = mem.clamp_(-MEM_MAX, MEM_MAX).mul_(self.leak).add_(LEAK_ROUND).bitwise_right_shift_(LEAK_BITS).add_(current)
+        spikes = mem > THRESHOLD_UNITS
+        return spikes.to(torch.float32), mem.sub_(spikes.to(torch.int32), alpha=THRESHOLD_UNITS)
+
+    def forward(self, inp):
+        batch_size = inp.size(0)
+        # membranes start at rest, the first current initialises them
+        mems = [None] * len(self.layers)
+        out_fc2 = torch.zeros(batch_size, self.num_cls, dtype=torch.int32, device=inp.device)
+
+        with torch.no_grad():
+            static_currents = None
+            if self.direct:
+                static_currents = self.layers[0].static_currents(self.quantize_input(inp))
+            for t in range(self.timesteps):
+                out_prev = None if self.direct else self.encoder(inp, t)
+                for i, layer in enumerate(self.layers):
+                    current = static_currents[t] if layer.static else layer.current(out_prev, t)
+                    spikes, mems[i] = self.lif(current, mems[i])
+                    out_prev = layer.output(spikes)
+
+                # accumulate voltage in the last layer
+                out_fc2 += F.linear(out_prev, self.weight_kernel_fc2).to(torch.int32)
+
+        return out_fc2.float() * self.scale_fc2 / self.timesteps
+
+
+def quantize_inference(net, calib_batches=None):
+    """
+    Post-training quantisation of a trained SNN to an IntegerSNN.
+    :param net: SNN_VGG9_BNTT or Simple_* model, or nn.DataParallel of one
+    :param calib_batches: list of input batches, to calibrate the BNTT statistics of models that do
+        not track running stats and the int8 image scale of direct coding
+    :return: IntegerSNN in eval mode
+    """
+    model = net.module if isinstance(net, nn.DataParallel) else net
+    # pool_list[i] must be the pooling after conv_list[i]
+    if len(getattr(model, 'pool_list', [])) != len(getattr(model, 'conv_list', [None])):
+        sys.exit("Integer inference is not supported by {}".format(type(model).__name__))
+    stats = {}
+    if hasattr(model, 'bntt_list') and model.bntt_list[0][0].running_mean is None:
+        if calib_batches is None:
+            sys.exit("{} does not track running stats, quantize_inference needs calib_batches".format(type(model).__name__))
+        stats = calibrate_bntt(model, calib_batches)
+    input_scale = 1.0
+    if model.direct:
+        if calib_batches is None:
+            sys.exit("Direct coding needs calib_batches to set the input scale")
+        input_scale = max(inp.abs().max().item() for inp in calib_batches) / WEIGHT_MAX
+    return IntegerSNN(model, stats, input_scale).eval()
@@ -195,6 +195,6 @@ class Network(nn.Module):
 
     def forward(self, x):
         x = self._forward_conv(x)
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         x = self.fc(x)
         return x
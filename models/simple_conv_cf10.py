@@ -1,40 +1,23 @@
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-import sys
 
-class Surrogate_BP_Function(torch.autograd.Function):
-
-
-    @staticmethod
-    def forward(ctx, input):
-        ctx.save_for_backward(input)
-        out = torch.zeros_like(input).cuda()
-        out[input > 0] = 1.0
-        return out
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        input, = ctx.saved_tensors
-        grad_input = grad_output.clone()
-        grad = grad_input * 0.3 * F.threshold(1.0 - torch.abs(input), 0, 0)
-        return grad
-
-
-def PoissonGen(inp, rescale_fac=2.0):
-    rand_inp = torch.rand_like(inp).cuda()
-    return torch.mul(torch.le(rand_inp * rescale_fac, torch.abs(inp)).float(), torch.sign(inp))
+from models.spiking import lif_step, compress_saved_activations, InputCurrent, sum_timesteps, lif_over_time, bntt_forward_layer_major, bntt_forward_checkpointed, bntt_forward_truncated, bntt_forward_early_exit, bntt_forward_horizons
+from models.encoding import build_encoder
 
 
 class Simple_CF10_BNTT(nn.Module):
-    def __init__(self, timesteps=10, leak_mem=0.95, img_size=32,  num_cls=10):
+    def __init__(self, timesteps=10, leak_mem=0.95, img_size=32,  num_cls=10, layer_major=False, direct=False, checkpoint_timesteps=0, checkpoint_layers=0, encoder='poisson', encoder_seed=None, compress_activations=False):
         super(Simple_CF10_BNTT, self).__init__()
 
         self.img_size = img_size
         self.num_cls = num_cls
         self.timesteps = timesteps
-        self.spike_fn = Surrogate_BP_Function.apply
         self.leak_mem = leak_mem
+        self.layer_major = layer_major
+        self.direct = direct
+        self.encoder = build_encoder(encoder, encoder_seed)
+        self.checkpoint_timesteps = checkpoint_timesteps
+        self.checkpoint_layers = checkpoint_layers
         self.batch_num = self.timesteps
 
         print (">>>>>>>>>>>>>>>>>>> Simple Model >>>>>>>>>>>>>>>>>>>>>>")
@@ -74,49 +57,42 @@ class Simple_CF10_BNTT(nn.Module):
                 m.threshold = 1.0
                 torch.nn.init.xavier_uniform_(m.weight, gain=2)
 
+        if compress_activations:
+            compress_saved_activations(self)
+
 
 
 
     def forward(self, inp):
 
+        input_current = InputCurrent(self.conv1, inp, self.direct, self.encoder)
+        if self.layer_major:
+            return bntt_forward_layer_major(self, input_current)
+        if self.checkpoint_timesteps or self.checkpoint_layers:
+            return bntt_forward_checkpointed(self, input_current)
+
         batch_size = inp.size(0)
-        mem_conv1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv2 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv_list = [mem_conv1, mem_conv2]
+        # membranes start at rest, lif_step allocates them on the first timestep
+        mem_conv_list = [None] * len(self.conv_list)
 
-        mem_fc1 = torch.zeros(batch_size, 64).cuda()
-        mem_fc2 = torch.zeros(batch_size, self.num_cls).cuda()
+        mem_fc1 = None
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
 
 
 
         for t in range(self.timesteps):
 
-            spike_inp = PoissonGen(inp)
-            out_prev = spike_inp
-
             for i in range(len(self.conv_list)):
-                mem_conv_list[i] = self.leak_mem * mem_conv_list[i] + self.bntt_list[i][t](self.conv_list[i](out_prev))
-                mem_thr = (mem_conv_list[i] / self.conv_list[i].threshold) - 1.0
-                out = self.spike_fn(mem_thr)
-                rst = torch.zeros_like(mem_conv_list[i]).cuda()
-                rst[mem_thr > 0] = self.conv_list[i].threshold
-                mem_conv_list[i] = mem_conv_list[i] - rst
-                out_prev = out.clone()
+                conv_out = input_current(t) if i == 0 else self.conv_list[i](out_prev)
+                out_prev, mem_conv_list[i] = lif_step(self.bntt_list[i][t](conv_out), mem_conv_list[i], self.leak_mem, self.conv_list[i].threshold)
 
 
                 if self.pool_list[i] is not False:
-                    out = self.pool_list[i](out_prev)
-                    out_prev = out.clone()
+                    out_prev = self.pool_list[i](out_prev)
 
             out_prev = out_prev.reshape(batch_size, -1)
 
-            mem_fc1 = self.leak_mem * mem_fc1 + self.bntt_fc[t](self.fc1(out_prev))
-            mem_thr = (mem_fc1 / self.fc1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_fc1).cuda()
-            rst[mem_thr > 0] = self.fc1.threshold
-            mem_fc1 = mem_fc1 - rst
-            out_prev = out.clone()
+            out_prev, mem_fc1 = lif_step(self.bntt_fc[t](self.fc1(out_prev)), mem_fc1, self.leak_mem, self.fc1.threshold)
 
             # accumulate voltage in the last layer
             mem_fc2 = mem_fc2 + self.fc2(out_prev)
@@ -126,14 +102,35 @@ class Simple_CF10_BNTT(nn.Module):
 
         return out_voltage
 
+    def forward_truncated(self, inp, window):
+        """
+        Forward over windows of timesteps for truncated BPTT, see bntt_forward_truncated
+        """
+        return bntt_forward_truncated(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), window)
+
+    def forward_early_exit(self, inp, margin, patience):
+        """
+        Inference that stops simulating confident samples, see bntt_forward_early_exit
+        """
+        return bntt_forward_early_exit(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), margin, patience)
+
+    def forward_horizons(self, inp, horizons):
+        """
+        Inference read out at several numbers of timesteps in one simulation, see bntt_forward_horizons
+        """
+        return bntt_forward_horizons(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), horizons)
+
+
 class VGG5_CF10_NoBNTT(nn.Module):
-    def __init__(self, timesteps, leak_mem=0.95, img_size=32, num_cls=10, input_dim=3):
+    def __init__(self, timesteps, leak_mem=0.95, img_size=32, num_cls=10, input_dim=3, layer_major=False, direct=True, encoder='poisson', encoder_seed=None, compress_activations=False):
         super(VGG5_CF10_NoBNTT, self).__init__()
         self.img_size = img_size
         self.num_cls = num_cls
         self.num_steps = timesteps
-        self.spike_fn = Surrogate_BP_Function.apply
         self.leak_mem = leak_mem
+        self.layer_major = layer_major
+        self.direct = direct
+        self.encoder = build_encoder(encoder, encoder_seed)
         self.batch_num = self.num_steps
         self.arch = "SNN"
         print(">>>>>>>>>>>>>>>>>>> VGG5_Direct Coding >>>>>>>>>>>>>>>>>>>>>>")
@@ -168,76 +165,45 @@ class VGG5_CF10_NoBNTT(nn.Module):
 
         self.fc_list = [self.fc1, self.fc2]
 
-    def forward(self, inp):
-
-        batch_size = inp.size(0)
+        if compress_activations:
+            compress_saved_activations(self)
 
-        mem_conv1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv2 = torch.zeros(batch_size, 128, (self.img_size) // 2, (self.img_size) // 2).cuda()
-        mem_conv3 = torch.zeros(batch_size, 128, (self.img_size) // 2, (self.img_size) // 2).cuda()
-
-        mem_conv_list = [mem_conv1, mem_conv2, mem_conv3]
+    def forward(self, inp):
 
-        mem_fc1 = torch.zeros(batch_size, 1024).cuda()
-        mem_fc2 = torch.zeros(batch_size, self.num_cls).cuda()
+        input_current = InputCurrent(self.conv1, inp, self.direct, self.encoder)
+        if self.layer_major:
+            return self.forward_layer_major(input_current)
 
-        mem_fc_list = [mem_fc1, mem_fc2]
+        batch_size = inp.size(0)
 
-        # Direct coding - static input from conv1
+        # membranes start at rest, lif_step allocates them on the first timestep
+        mem_conv_list = [None] * len(self.conv_list)
+        mem_fc_list = [None] * (len(self.fc_list) - 1)
 
-        static_input = self.conv1(inp)
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
 
         for t in range(self.num_steps):
-            # Charging and firing (lif for conv1)
-            mem_conv_list[0] = self.leak_mem * mem_conv_list[0] + (1 - self.leak_mem) * static_input
-            mem_thr = (mem_conv_list[0] / self.conv_list[0].threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-
-            # Soft reset
-            rst = torch.zeros_like(mem_conv_list[0]).cuda()
-            rst[mem_thr > 0] = self.conv_list[0].threshold
-            mem_conv_list[0] = mem_conv_list[0] - rst
-            out_prev = out.clone()
+            # Charging, firing and soft reset (lif for conv1)
+            out_prev, mem_conv_list[0] = lif_step((1 - self.leak_mem) * input_current(t), mem_conv_list[0], self.leak_mem, self.conv_list[0].threshold)
 
             # Pooling
-            out = self.pool_list[0](out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool_list[0](out_prev)
 
-            mem_conv_list[1] = self.leak_mem * mem_conv_list[1] + (1 - self.leak_mem) * self.conv2(out_prev)
-            mem_thr = (mem_conv_list[1] / self.conv_list[1].threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv_list[1]).cuda()
-            rst[mem_thr > 0] = self.conv_list[1].threshold
-            mem_conv_list[1] = mem_conv_list[1] - rst
-            out_prev = out.clone()
+            out_prev, mem_conv_list[1] = lif_step((1 - self.leak_mem) * self.conv2(out_prev), mem_conv_list[1], self.leak_mem, self.conv_list[1].threshold)
 
             # print ("aa", out_prev.sum())
 
-            mem_conv_list[2] = self.leak_mem * mem_conv_list[2] + (1 - self.leak_mem) * self.conv3(out_prev)
-            mem_thr = (mem_conv_list[2] / self.conv_list[2].threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv_list[2]).cuda()
-            rst[mem_thr > 0] = self.conv_list[2].threshold
-            mem_conv_list[2] = mem_conv_list[2] - rst
-            out_prev = out.clone()
+            out_prev, mem_conv_list[2] = lif_step((1 - self.leak_mem) * self.conv3(out_prev), mem_conv_list[2], self.leak_mem, self.conv_list[2].threshold)
 
             # print ("bb",out_prev.sum())
 
             # Pooling
-            out = self.pool_list[1](out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool_list[1](out_prev)
 
             out_prev = out_prev.reshape(batch_size, -1)
 
             for i in range(len(self.fc_list) - 1):
-                mem_fc_list[i] = self.leak_mem * mem_fc_list[i] + (1 - self.leak_mem) * self.fc_list[i](out_prev)
-                mem_thr = (mem_fc_list[i] / self.fc_list[i].threshold) - 1.0
-                out = self.spike_fn(mem_thr)
-
-                rst = torch.zeros_like(mem_fc_list[i]).cuda()
-                rst[mem_thr > 0] = self.fc_list[i].threshold
-                mem_fc_list[i] = mem_fc_list[i] - rst
-                out_prev = out.clone()
+                out_prev, mem_fc_list[i] = lif_step((1 - self.leak_mem) * self.fc_list[i](out_prev), mem_fc_list[i], self.leak_mem, self.fc_list[i].threshold)
 
             # accumulate voltage in the last layer
             mem_fc2 = mem_fc2 + self.fc2(out_prev)
@@ -245,3 +211,20 @@ class VGG5_CF10_NoBNTT(nn.Module):
         out_voltage = mem_fc2 / self.num_steps
 
         return out_voltage
+
+    def forward_layer_major(self, input_current):
+        # all timesteps stacked in the batch dimension, only the membranes run sequentially
+        current = (1 - self.leak_mem) * input_current.time_batched(self.num_steps)
+        out_prev = lif_over_time(current, self.num_steps, self.leak_mem, self.conv_list[0].threshold)
+        out_prev = self.pool_list[0](out_prev)
+
+        out_prev = lif_over_time((1 - self.leak_mem) * self.conv2(out_prev), self.num_steps, self.leak_mem, self.conv_list[1].threshold)
+        out_prev = lif_over_time((1 - self.leak_mem) * self.conv3(out_prev), self.num_steps, self.leak_mem, self.conv_list[2].threshold)
+        out_prev = self.pool_list[1](out_prev)
+
+        out_prev = out_prev.reshape(out_prev.size(0), -1)
+        for i in range(len(self.fc_list) - 1):
+            out_prev = lif_over_time((1 - self.leak_mem) * self.fc_list[i](out_prev), self.num_steps, self.leak_mem, self.fc_list[i].threshold)
+
+        # accumulate voltage in the last layer
+        return sum_timesteps(self.fc2(out_prev), self.num_steps) / self.num_steps
@@ -1,40 +1,24 @@
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-import sys
 
-class Surrogate_BP_Function(torch.autograd.Function):
+from models.spiking import lif_step, compress_saved_activations, InputCurrent, sum_timesteps, lif_over_time, bntt_forward_layer_major, bntt_forward_checkpointed, bntt_forward_truncated, bntt_forward_early_exit, bntt_forward_horizons
+from models.encoding import build_encoder
 
 
-    @staticmethod
-    def forward(ctx, input):
-        ctx.save_for_backward(input)
-        out = torch.zeros_like(input).cuda()
-        out[input > 0] = 1.0
-        return out
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        input, = ctx.saved_tensors
-        grad_input = grad_output.clone()
-        grad = grad_input * 0.3 * F.threshold(1.0 - torch.abs(input), 0, 0)
-        return grad
-
-
-def PoissonGen(inp, rescale_fac=2.0):
-    rand_inp = torch.rand_like(inp).cuda()
-    return torch.mul(torch.le(rand_inp * rescale_fac, torch.abs(inp)).float(), torch.sign(inp))
-
 # use direct coding
 class Simple_Mnist_BNTT(nn.Module):
-    def __init__(self, timesteps=10, leak_mem=0.95, img_size=32,  num_cls=10):
+    def __init__(self, timesteps=10, leak_mem=0.95, img_size=32,  num_cls=10, layer_major=False, direct=True, checkpoint_timesteps=0, checkpoint_layers=0, encoder='poisson', encoder_seed=None, compress_activations=False):
         super(Simple_Mnist_BNTT, self).__init__()
 
         self.img_size = img_size
         self.num_cls = num_cls
         self.timesteps = timesteps
-        self.spike_fn = Surrogate_BP_Function.apply
         self.leak_mem = leak_mem
+        self.layer_major = layer_major
+        self.direct = direct
+        self.encoder = build_encoder(encoder, encoder_seed)
+        self.checkpoint_timesteps = checkpoint_timesteps
+        self.checkpoint_layers = checkpoint_layers
         self.batch_num = self.timesteps
 
         print (">>>>>>>>>>>>>>>>>>> Simple Model w/ BNTT >>>>>>>>>>>>>>>>>>>>>>")
@@ -74,57 +58,41 @@ class Simple_Mnist_BNTT(nn.Module):
                 m.threshold = 1.0
                 torch.nn.init.xavier_uniform_(m.weight, gain=2)
 
+        if compress_activations:
+            compress_saved_activations(self)
+
 
 
 
     def forward(self, inp):
 
-        batch_size = inp.size(0)
-        mem_conv1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv2 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv_list = [mem_conv1, mem_conv2]
+        input_current = InputCurrent(self.conv1, inp, self.direct, self.encoder)
+        if self.layer_major:
+            return bntt_forward_layer_major(self, input_current)
+        if self.checkpoint_timesteps or self.checkpoint_layers:
+            return bntt_forward_checkpointed(self, input_current)
 
-        mem_fc1 = torch.zeros(batch_size, 64).cuda()
-        mem_fc2 = torch.zeros(batch_size, self.num_cls).cuda()
+        batch_size = inp.size(0)
+        # membranes start at rest, lif_step allocates them on the first timestep
+        mem_conv_list = [None] * len(self.conv_list)
 
-        static_input = self.conv1(inp)
+        mem_fc1 = None
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
 
         for t in range(self.timesteps):
 
-            #spike_inp = PoissonGen(inp)
-            #out_prev = spike_inp
-
             # conv1 and following bntt
-            mem_conv1 = self.leak_mem * mem_conv1 + self.bntt1[t](static_input)
-            mem_thr = (mem_conv1 / self.conv1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv1).cuda()
-            rst[mem_thr > 0] = self.conv1.threshold
-            mem_conv1 = mem_conv1 - rst
-            out_prev = out.clone()
+            out_prev, mem_conv_list[0] = lif_step(self.bntt1[t](input_current(t)), mem_conv_list[0], self.leak_mem, self.conv1.threshold)
 
             for i in range(1, len(self.conv_list)):
-                mem_conv_list[i] = self.leak_mem * mem_conv_list[i] + self.bntt_list[i][t](self.conv_list[i](out_prev))
-                mem_thr = (mem_conv_list[i] / self.conv_list[i].threshold) - 1.0
-                out = self.spike_fn(mem_thr)
-                rst = torch.zeros_like(mem_conv_list[i]).cuda()
-                rst[mem_thr > 0] = self.conv_list[i].threshold
-                mem_conv_list[i] = mem_conv_list[i] - rst
-                out_prev = out.clone()
+                out_prev, mem_conv_list[i] = lif_step(self.bntt_list[i][t](self.conv_list[i](out_prev)), mem_conv_list[i], self.leak_mem, self.conv_list[i].threshold)
 
                 if self.pool_list[i] is not False:
-                    out = self.pool_list[i](out_prev)
-                    out_prev = out.clone()
+                    out_prev = self.pool_list[i](out_prev)
 
             out_prev = out_prev.reshape(batch_size, -1)
 
-            mem_fc1 = self.leak_mem * mem_fc1 + self.bntt_fc[t](self.fc1(out_prev))
-            mem_thr = (mem_fc1 / self.fc1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_fc1).cuda()
-            rst[mem_thr > 0] = self.fc1.threshold
-            mem_fc1 = mem_fc1 - rst
-            out_prev = out.clone()
+            out_prev, mem_fc1 = lif_step(self.bntt_fc[t](self.fc1(out_prev)), mem_fc1, self.leak_mem, self.fc1.threshold)
 
             # accumulate voltage in the last layer
             mem_fc2 = mem_fc2 + self.fc2(out_prev)
@@ -134,15 +102,36 @@ class Simple_Mnist_BNTT(nn.Module):
 
         return out_voltage
 
+    def forward_truncated(self, inp, window):
+        """
+        Forward over windows of timesteps for truncated BPTT, see bntt_forward_truncated
+        """
+        return bntt_forward_truncated(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), window)
+
+    def forward_early_exit(self, inp, margin, patience):
+        """
+        Inference that stops simulating confident samples, see bntt_forward_early_exit
+        """
+        return bntt_forward_early_exit(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), margin, patience)
+
+    def forward_horizons(self, inp, horizons):
+        """
+        Inference read out at several numbers of timesteps in one simulation, see bntt_forward_horizons
+        """
+        return bntt_forward_horizons(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), horizons)
+
+
 class Simple_Mnist_NoBNTT(nn.Module):
-    def __init__(self, timesteps=10, leak_mem=0.5, img_size=32,  num_cls=10):
+    def __init__(self, timesteps=10, leak_mem=0.5, img_size=32,  num_cls=10, layer_major=False, direct=True, encoder='poisson', encoder_seed=None, compress_activations=False):
         super(Simple_Mnist_NoBNTT, self).__init__()
 
         self.img_size = img_size
         self.num_cls = num_cls
         self.timesteps = timesteps
-        self.spike_fn = Surrogate_BP_Function.apply
         self.leak_mem = leak_mem
+        self.layer_major = layer_major
+        self.direct = direct
+        self.encoder = build_encoder(encoder, encoder_seed)
         self.batch_num = self.timesteps
 
         print (">>>>>>>>>>>>>>>>>>> Simple Model no BNTT >>>>>>>>>>>>>>>>>>>>>>")
@@ -160,6 +149,9 @@ class Simple_Mnist_NoBNTT(nn.Module):
         self.fc1 = nn.Linear(576, 64, bias=bias_flag)
         self.fc2 = nn.Linear(64, self.num_cls, bias=bias_flag)
 
+        self.conv_list = [self.conv1, self.conv2]
+        self.pool_list = [False, self.pool1]
+
         # Initialize the firing thresholds of all the layers
         for m in self.modules():
             if (isinstance(m, nn.Conv2d)):
@@ -169,52 +161,38 @@ class Simple_Mnist_NoBNTT(nn.Module):
                 m.threshold = 1.0
                 torch.nn.init.xavier_uniform_(m.weight, gain=2)
 
+        if compress_activations:
+            compress_saved_activations(self)
+
 
 
 
     def forward(self, inp):
 
-        batch_size = inp.size(0)
-        mem_conv1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv2 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
+        input_current = InputCurrent(self.conv1, inp, self.direct, self.encoder)
+        if self.layer_major:
+            return self.forward_layer_major(input_current)
 
-        mem_fc1 = torch.zeros(batch_size, 64).cuda()
-        mem_fc2 = torch.zeros(batch_size, self.num_cls).cuda()
+        batch_size = inp.size(0)
+        # membranes start at rest, lif_step allocates them on the first timestep
+        mem_conv1 = mem_conv2 = None
 
-        static_input = self.conv1(inp)
+        mem_fc1 = None
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
 
         for t in range(self.timesteps):
             # conv1
-            mem_conv1 = self.leak_mem * mem_conv1 + (1 - self.leak_mem) * static_input
-            mem_thr = (mem_conv1 / self.conv1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv1).cuda()
-            rst[mem_thr > 0] = self.conv1.threshold
-            mem_conv1 = mem_conv1 - rst
-            out_prev = out.clone()
+            out_prev, mem_conv1 = lif_step((1 - self.leak_mem) * input_current(t), mem_conv1, self.leak_mem, self.conv1.threshold)
 
             # conv2
-            mem_conv2 = self.leak_mem * mem_conv2 + (1 - self.leak_mem) * self.conv2(out_prev)
-            mem_thr = (mem_conv2 / self.conv2.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv2).cuda()
-            rst[mem_thr > 0] = self.conv2.threshold
-            mem_conv2 = mem_conv2 - rst
-            out_prev = out.clone()
+            out_prev, mem_conv2 = lif_step((1 - self.leak_mem) * self.conv2(out_prev), mem_conv2, self.leak_mem, self.conv2.threshold)
 
             # pooling
-            out = self.pool1(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool1(out_prev)
 
             out_prev = out_prev.reshape(batch_size, -1)
 
-            mem_fc1 = self.leak_mem * mem_fc1 + (1 - self.leak_mem) * self.fc1(out_prev)
-            mem_thr = (mem_fc1 / self.fc1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_fc1).cuda()
-            rst[mem_thr > 0] = self.fc1.threshold
-            mem_fc1 = mem_fc1 - rst
-            out_prev = out.clone()
+            out_prev, mem_fc1 = lif_step((1 - self.leak_mem) * self.fc1(out_prev), mem_fc1, self.leak_mem, self.fc1.threshold)
 
             # accumulate voltage in the last layer
             mem_fc2 = mem_fc2 + self.fc2(out_prev)
@@ -224,16 +202,33 @@ class Simple_Mnist_NoBNTT(nn.Module):
 
         return out_voltage
 
+    def forward_layer_major(self, input_current):
+        # all timesteps stacked in the batch dimension, only the membranes run sequentially
+        current = (1 - self.leak_mem) * input_current.time_batched(self.timesteps)
+        out_prev = lif_over_time(current, self.timesteps, self.leak_mem, self.conv1.threshold)
+        out_prev = lif_over_time((1 - self.leak_mem) * self.conv2(out_prev), self.timesteps, self.leak_mem, self.conv2.threshold)
+        out_prev = self.pool1(out_prev)
+
+        out_prev = out_prev.reshape(out_prev.size(0), -1)
+        out_prev = lif_over_time((1 - self.leak_mem) * self.fc1(out_prev), self.timesteps, self.leak_mem, self.fc1.threshold)
+
+        # accumulate voltage in the last layer
+        return sum_timesteps(self.fc2(out_prev), self.timesteps) / self.timesteps
+
 # Use Rate coding
 class Simple_Mnist_BNTT_Rate(nn.Module):
-    def __init__(self, timesteps=10, leak_mem=0.95, img_size=32,  num_cls=10):
+    def __init__(self, timesteps=10, leak_mem=0.95, img_size=32,  num_cls=10, layer_major=False, direct=False, checkpoint_timesteps=0, checkpoint_layers=0, encoder='poisson', encoder_seed=None, compress_activations=False):
         super(Simple_Mnist_BNTT_Rate, self).__init__()
 
         self.img_size = img_size
         self.num_cls = num_cls
         self.timesteps = timesteps
-        self.spike_fn = Surrogate_BP_Function.apply
         self.leak_mem = leak_mem
+        self.layer_major = layer_major
+        self.direct = direct
+        self.encoder = build_encoder(encoder, encoder_seed)
+        self.checkpoint_timesteps = checkpoint_timesteps
+        self.checkpoint_layers = checkpoint_layers
         self.batch_num = self.timesteps
 
         print (">>>>>>>>>>>>>>>>>>> Simple Model >>>>>>>>>>>>>>>>>>>>>>")
@@ -273,49 +268,42 @@ class Simple_Mnist_BNTT_Rate(nn.Module):
                 m.threshold = 1.0
                 torch.nn.init.xavier_uniform_(m.weight, gain=2)
 
+        if compress_activations:
+            compress_saved_activations(self)
+
 
 
 
     def forward(self, inp):
 
+        input_current = InputCurrent(self.conv1, inp, self.direct, self.encoder)
+        if self.layer_major:
+            return bntt_forward_layer_major(self, input_current)
+        if self.checkpoint_timesteps or self.checkpoint_layers:
+            return bntt_forward_checkpointed(self, input_current)
+
         batch_size = inp.size(0)
-        mem_conv1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv2 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv_list = [mem_conv1, mem_conv2]
+        # membranes start at rest, lif_step allocates them on the first timestep
+        mem_conv_list = [None] * len(self.conv_list)
 
-        mem_fc1 = torch.zeros(batch_size, 64).cuda()
-        mem_fc2 = torch.zeros(batch_size, self.num_cls).cuda()
+        mem_fc1 = None
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
 
 
 
         for t in range(self.timesteps):
 
-            spike_inp = PoissonGen(inp)
-            out_prev = spike_inp
-
             for i in range(len(self.conv_list)):
-                mem_conv_list[i] = self.leak_mem * mem_conv_list[i] + self.bntt_list[i][t](self.conv_list[i](out_prev))
-                mem_thr = (mem_conv_list[i] / self.conv_list[i].threshold) - 1.0
-                out = self.spike_fn(mem_thr)
-                rst = torch.zeros_like(mem_conv_list[i]).cuda()
-                rst[mem_thr > 0] = self.conv_list[i].threshold
-                mem_conv_list[i] = mem_conv_list[i] - rst
-                out_prev = out.clone()
+                conv_out = input_current(t) if i == 0 else self.conv_list[i](out_prev)
+                out_prev, mem_conv_list[i] = lif_step(self.bntt_list[i][t](conv_out), mem_conv_list[i], self.leak_mem, self.conv_list[i].threshold)
 
 
                 if self.pool_list[i] is not False:
-                    out = self.pool_list[i](out_prev)
-                    out_prev = out.clone()
+                    out_prev = self.pool_list[i](out_prev)
 
             out_prev = out_prev.reshape(batch_size, -1)
 
-            mem_fc1 = self.leak_mem * mem_fc1 + self.bntt_fc[t](self.fc1(out_prev))
-            mem_thr = (mem_fc1 / self.fc1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_fc1).cuda()
-            rst[mem_thr > 0] = self.fc1.threshold
-            mem_fc1 = mem_fc1 - rst
-            out_prev = out.clone()
+            out_prev, mem_fc1 = lif_step(self.bntt_fc[t](self.fc1(out_prev)), mem_fc1, self.leak_mem, self.fc1.threshold)
 
             # accumulate voltage in the last layer
             mem_fc2 = mem_fc2 + self.fc2(out_prev)
@@ -323,4 +311,23 @@ class Simple_Mnist_BNTT_Rate(nn.Module):
         out_voltage = mem_fc2 / self.timesteps
 
 
-        return out_voltage
\ No newline at end of file
+        return out_voltage
+
+    def forward_truncated(self, inp, window):
+        """
+        Forward over windows of timesteps for truncated BPTT, see bntt_forward_truncated
+        """
+        return bntt_forward_truncated(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), window)
+
+    def forward_early_exit(self, inp, margin, patience):
+        """
+        Inference that stops simulating confident samples, see bntt_forward_early_exit
+        """
+        return bntt_forward_early_exit(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), margin, patience)
+
+    def forward_horizons(self, inp, horizons):
+        """
+        Inference read out at several numbers of timesteps in one simulation, see bntt_forward_horizons
+        """
+        return bntt_forward_horizons(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), horizons)
+
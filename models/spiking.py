@@ -0,0 +1,828 @@
+import contextlib
+import sys
+import threading
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.nn.modules.utils import _pair
+from torch.utils.checkpoint import checkpoint
+
+from models.encoding import pack_bits, unpack_bits
+
+
+# --------------------------------------------------
+# Surrogate gradients of the spike w.r.t. x = mem / threshold - 1
+# Same shapes and constants as the spike functions in vgg_spiking_bntt_activity.py.
+# x is a scratch tensor owned by the caller and is overwritten in place.
+# --------------------------------------------------
+def linear_surrogate(x, gamma=0.3):
+    return x.abs_().neg_().add_(1.0).clamp_(min=0).mul_(gamma)
+
+
+def superspike_surrogate(x, scale=100.0):
+    return x.abs_().mul_(scale).add_(1.0).pow_(-2)
+
+
+def exp_surrogate(x, alpha=1.0, beta=10.0):
+    return x.abs_().mul_(-beta).exp_().mul_(alpha)
+
+
+def passthru_surrogate(x):
+    return x.fill_(1.0)
+
+
+SURROGATES = {
+    'Linear': linear_surrogate,
+    'FastSigm': superspike_surrogate,
+    'Exp': exp_surrogate,
+    'PassThru': passthru_surrogate,
+}
+
+
+class LIFSpike(torch.autograd.Function):
+    """
+    Leak, integrate, fire and reset of a layer of LIF neurons in a single pass.
+
+    Integrate-then-fire (BNTT models):
+        mem' = leak * mem + current, spike = H(mem' - threshold), mem_new = mem' - threshold * spike
+    Fire-then-integrate (TBN models, spikes come from the previous membrane):
+        spike = H(mem - threshold), mem_new = leak * mem + current - threshold * spike
+
+    The reset is treated as a constant in the backward pass, exactly like the masked
+    `rst` tensors it replaces, so gradients match the unfused code. Only the membrane
+    that produced the spike is saved for backward, or its compact surrogate context, see save_surrogate.
+    """
+
+    @staticmethod
+    def forward(ctx, current, mem, leak, threshold, grad_type, fire_first, compact):
+        ctx.set_materialize_grads(False)
+        if fire_first:
+            if mem is None:
+                spike = torch.zeros_like(current)
+                mem_new = current.clone()
+            else:
+                spike = torch.gt(mem, threshold).to(current.dtype)
+                mem_new = torch.add(current, mem, alpha=leak)
+                mem_new.sub_(spike, alpha=threshold)
+            fired_from = mem
+        else:
+            mem_int = current if mem is None else torch.add(current, mem, alpha=leak)
+            spike = torch.gt(mem_int, threshold).to(current.dtype)
+            mem_new = torch.sub(mem_int, spike, alpha=threshold)
+            fired_from = mem_int
+        if fired_from is not None:
+            save_surrogate(ctx, fired_from, threshold, grad_type, compact)
+        ctx.leak = leak
+        ctx.threshold = threshold
+        ctx.grad_type = grad_type
+        ctx.fire_first = fire_first
+        ctx.has_mem = mem is not None
+        ctx.has_fired_from = fired_from is not None
+        return spike, mem_new
+
+    @staticmethod
+    def backward(ctx, grad_spike, grad_mem):
+        # surrogate gradient through the spike, w.r.t. the membrane that fired
+        grad_fired = None
+        if grad_spike is not None and ctx.has_fired_from:
+            grad_fired = saved_surrogate(ctx)
+            grad_fired.mul_(grad_spike).div_(ctx.threshold)
+
+        if ctx.fire_first:
+            grad_current = grad_mem
+            grad_prev = None
+            if ctx.has_mem:
+                if grad_fired is None:
+                    grad_prev = None if grad_mem is None else grad_mem * ctx.leak
+                elif grad_mem is None:
+                    grad_prev = grad_fired
+                else:
+                    grad_prev = grad_fired.add_(grad_mem, alpha=ctx.leak)
+        else:
+            if grad_fired is None:
+                grad_int = grad_mem
+            elif grad_mem is None:
+                grad_int = grad_fired
+            else:
+                grad_int = grad_fired.add_(grad_mem)
+            grad_current = grad_int
+            grad_prev = grad_int * ctx.leak if (ctx.has_mem and grad_int is not None) else None
+        return grad_current, grad_prev, None, None, None, None, None
+
+
+def membrane_precision(current):
+    """
+    Input current in fp32. Under bf16 autocast the conv / linear currents come in bfloat16, whose
+    8-bit mantissa would lose small currents added to a large membrane and move the membrane /
+    threshold comparisons; the membranes and surrogate gradients are computed in fp32 instead.
+    The spikes are then fp32 as well and are cast back by the next autocast layer, exactly.
+    """
+    if current.dtype in (torch.bfloat16, torch.float16):
+        return current.float()
+    return current
+
+
+def lif_step(current, mem, leak, threshold, grad_type='Linear', fire_first=False):
+    """
+    Advance a layer of LIF neurons by one timestep.
+    :param current: input current of this timestep (conv/BNTT output)
+    :param mem: membrane potential from the previous timestep, None for a resting (all zero) membrane
+    :param leak: membrane leak factor
+    :param threshold: firing threshold (float)
+    :param grad_type: surrogate gradient, one of 'Linear', 'FastSigm', 'Exp', 'PassThru'
+    :param fire_first: fire from the previous membrane before integrating (TBN models)
+    :return: (spikes, new membrane potential)
+    """
+    if grad_type not in SURROGATES:
+        sys.exit("Unknown gradient type '{}'".format(grad_type))
+    current = membrane_precision(current)
+    compact = compressing()
+    spike, mem_new = LIFSpike.apply(current, mem, leak, float(threshold), grad_type, fire_first, compact)
+    if compact:
+        spike.spike_counts = 1
+    if spike_observer() is not None:
+        spike_observer().record_spikes(spike, first=mem is None)
+    return spike, mem_new
+
+
+def lif_inference(current, mem: Optional[torch.Tensor], leak: float, threshold: float):
+    """
+    lif_step of integrate-then-fire neurons for inference only: plain tensor ops without autograd
+    bookkeeping or observers, so it can be compiled by TorchScript
+    """
+    mem_int = current if mem is None else torch.add(current, mem, alpha=leak)
+    spike = torch.gt(mem_int, threshold).to(current.dtype)
+    return spike, torch.sub(mem_int, spike, alpha=threshold)
+
+
+# --------------------------------------------------
+# Layer-major (time-batched) execution
+#   Tensors hold all T timesteps stacked in the batch dimension as (B*T, ...), sample-major:
+#   timestep t of sample b is row b*T + t. Stateless layers run once on the whole stack and
+#   only the membrane recurrence is sequential in T. With this order the per-timestep BNTT
+#   becomes a free view with T*C channels instead of a transpose.
+# --------------------------------------------------
+def stack_timesteps(x_list):
+    """
+    Stack a list of T per-timestep (B, ...) tensors into a time-batched (B*T, ...) tensor
+    """
+    return torch.stack(x_list, dim=1).flatten(0, 1)
+
+
+def repeat_timesteps(x, timesteps):
+    """
+    Time-batched (B*T, ...) tensor holding the same x at every timestep
+    """
+    return x.repeat_interleave(timesteps, dim=0)
+
+
+def sum_timesteps(x, timesteps):
+    """
+    Sum a time-batched (B*T, ...) tensor over time, giving (B, ...); bf16 / fp16 outputs are summed in fp32
+    """
+    x = x.reshape(-1, timesteps, *x.shape[1:])
+    if x.dtype in (torch.bfloat16, torch.float16):
+        return x.sum(1, dtype=torch.float32)
+    return x.sum(1)
+
+
+def bntt_over_time(bntt, x, timesteps):
+    """
+    Apply bntt[t] to timestep t of a time-batched tensor with a single batch_norm call.
+    (B*T, C, ...) is viewed as (B, T*C, ...), so every (timestep, channel) pair gets its own
+    statistics, affine weight and running stats, exactly as calling bntt[t] per timestep.
+    :param bntt: ModuleList of per-timestep BatchNorm1d/2d
+    :param x: (B*T, C, ...) tensor
+    :param timesteps: T
+    :return: normalised (B*T, C, ...) tensor
+    """
+    bns = [bntt[t] for t in range(timesteps)]
+    bn = bns[0]
+    channels = x.size(1)
+    x_tc = x.reshape(-1, timesteps * channels, *x.shape[2:])
+
+    weight = torch.cat([m.weight for m in bns]) if bn.weight is not None else None
+    bias = torch.cat([m.bias for m in bns]) if bn.bias is not None else None
+    # as in nn.BatchNorm: running stats are updated in training if tracked, and used in eval if present
+    running_mean = running_var = None
+    if bn.running_mean is not None and (bn.track_running_stats or not bn.training):
+        running_mean = torch.cat([m.running_mean for m in bns])
+        running_var = torch.cat([m.running_var for m in bns])
+    bn_training = bn.training or running_mean is None
+
+    out = F.batch_norm(x_tc, running_mean, running_var, weight, bias, bn_training, bn.momentum, bn.eps)
+
+    if bn.training and running_mean is not None:
+        for t, m in enumerate(bns):
+            m.running_mean.copy_(running_mean[t * channels:(t + 1) * channels])
+            m.running_var.copy_(running_var[t * channels:(t + 1) * channels])
+            m.num_batches_tracked.add_(1)
+    return out.reshape(x.shape)
+
+
+class LIFOverTime(torch.autograd.Function):
+    """
+    The LIFSpike recurrence of one layer over all T timesteps of a time-batched current.
+    Spikes and the saved membranes are written into preallocated (B, T, ...) buffers, and the
+    backward pass evaluates the surrogate for all timesteps at once, then runs the reverse
+    recurrence in place, so nothing is allocated per timestep.
+    """
+
+    @staticmethod
+    def forward(ctx, current, timesteps, leak, threshold, grad_type, fire_first, compact):
+        cur = current.reshape(-1, timesteps, *current.shape[1:])
+        spikes = torch.empty_like(cur, memory_format=torch.contiguous_format)
+        fired_from = torch.empty_like(spikes)
+        mem = torch.zeros_like(cur[:, 0], memory_format=torch.contiguous_format)
+        # only in-place ops on the (strided) timestep slices, no out= arguments, so that the loop also
+        # traces under torch.compile; spike = H(v - threshold) is written as clamp(sign(v - threshold), 0)
+        for t in range(timesteps):
+            if fire_first:
+                fired_from[:, t].copy_(mem)
+                spikes[:, t].copy_(mem).sub_(threshold).sign_().clamp_(min=0)
+                mem.mul_(leak).add_(cur[:, t]).sub_(spikes[:, t], alpha=threshold)
+            else:
+                fired_from[:, t].copy_(cur[:, t]).add_(mem, alpha=leak)
+                spikes[:, t].copy_(fired_from[:, t]).sub_(threshold).sign_().clamp_(min=0)
+                mem.copy_(fired_from[:, t]).sub_(spikes[:, t], alpha=threshold)
+        save_surrogate(ctx, fired_from, threshold, grad_type, compact)
+        ctx.timesteps = timesteps
+        ctx.leak = leak
+        ctx.threshold = threshold
+        ctx.grad_type = grad_type
+        ctx.fire_first = fire_first
+        return spikes.reshape(current.shape)
+
+    @staticmethod
+    def backward(ctx, grad_spikes):
+        timesteps = ctx.timesteps
+        grad_fired = saved_surrogate(ctx)
+        grad_fired.mul_(grad_spikes.reshape(grad_fired.shape)).div_(ctx.threshold)
+        if ctx.fire_first:
+            # the current of step t reaches the spikes of steps t+1, t+2, ...
+            grad_current = torch.zeros_like(grad_fired)
+            for t in range(timesteps - 2, -1, -1):
+                grad_current[:, t].copy_(grad_fired[:, t + 1]).add_(grad_current[:, t + 1], alpha=ctx.leak)
+        else:
+            # the current of step t reaches the spikes of steps t, t+1, ...
+            grad_current = grad_fired
+            for t in range(timesteps - 2, -1, -1):
+                grad_current[:, t].add_(grad_current[:, t + 1], alpha=ctx.leak)
+        return grad_current.reshape(grad_spikes.shape), None, None, None, None, None, None
+
+
+def lif_over_time(current, timesteps, leak, threshold, grad_type='Linear', fire_first=False):
+    """
+    Run the membrane recurrence of one layer over a time-batched input current,
+    starting from a resting membrane. Same dynamics and gradients as calling lif_step per timestep.
+    :return: time-batched (B*T, ...) spikes
+    """
+    if grad_type not in SURROGATES:
+        sys.exit("Unknown gradient type '{}'".format(grad_type))
+    current = membrane_precision(current)
+    compact = compressing()
+    spikes = LIFOverTime.apply(current, timesteps, leak, float(threshold), grad_type, fire_first, compact)
+    if compact:
+        spikes.spike_counts = 1
+    if spike_observer() is not None:
+        spike_observer().record_spikes(spikes, first=True)
+    return spikes
+
+
+# --------------------------------------------------
+# Compressed saved activations
+#   Under autograd every spiking layer keeps its binary input (for the weight gradient) and the
+#   membrane that fired (for the surrogate) as float32 until backward. Both are stored compactly:
+#   spike maps bit-packed, average-pooled spike maps as uint8 spike counts, and instead of the
+#   membrane the surrogate value itself, quantised to uint8 with one float scale per tensor.
+#   Spikes and pooled spikes round trip exactly, the surrogate to within 1/510 of its maximum.
+# --------------------------------------------------
+def save_surrogate(ctx, fired_from, threshold, grad_type, compact):
+    ctx.compact = compact
+    if not compact:
+        ctx.save_for_backward(fired_from)
+        return
+    surrogate = SURROGATES[grad_type](torch.div(fired_from, threshold).sub_(1.0))
+    scale = surrogate.amax().clamp_(min=1e-12).div_(255)
+    ctx.save_for_backward(surrogate.div_(scale).round_().to(torch.uint8), scale)
+
+
+def saved_surrogate(ctx):
+    """
+    Surrogate gradient of the spikes w.r.t. the membrane that fired, without the 1 / threshold
+    """
+    if ctx.compact:
+        codes, scale = ctx.saved_tensors
+        return codes.to(scale.dtype).mul_(scale)
+    fired_from, = ctx.saved_tensors
+    return SURROGATES[ctx.grad_type](torch.div(fired_from, ctx.threshold).sub_(1.0))
+
+
+def spike_counts(x):
+    """
+    n if x holds spike maps averaged over n inputs (n=1 for plain spikes), so that n * x is a count, else None
+    """
+    counts = getattr(x, 'spike_counts', None)
+    if counts is None and x._base is not None:
+        counts = getattr(x._base, 'spike_counts', None)
+    return counts
+
+
+def pack_saved(x):
+    counts = spike_counts(x)
+    if counts is None:
+        return x
+    if counts == 1:
+        return x.shape, x.dtype, counts, pack_bits(x.reshape(1, -1) != 0)
+    return x.shape, x.dtype, counts, x.mul(counts).round_().to(torch.uint8)
+
+
+def unpack_saved(packed):
+    if isinstance(packed, torch.Tensor):
+        return packed
+    shape, dtype, counts, codes = packed
+    if counts == 1:
+        return unpack_bits(codes, shape.numel()).to(dtype).reshape(shape)
+    return codes.to(dtype).div_(counts).reshape(shape)
+
+
+_compression = threading.local()
+
+
+def compressing():
+    """
+    True inside the forward of a model with compressed saved activations, with autograd enabled
+    """
+    stack = getattr(_compression, 'stack', None)
+    return bool(stack) and stack[-1] is not None
+
+
+def compress_saved_activations(net):
+    """
+    Store the activations autograd saves during the forward of net in compact form, see above.
+    Registers hooks on net, so replicas and copies of the model compress as well.
+    Checkpointing already discards these activations and recomputes them uncompressed, so the two are exclusive.
+    :param net: SNN model running its spiking layers through lif_step / lif_over_time
+    """
+    if getattr(net, 'checkpoint_timesteps', 0) or getattr(net, 'checkpoint_layers', 0):
+        sys.exit("compress_activations cannot be combined with checkpoint_timesteps / checkpoint_layers")
+
+    def enter(module, inputs):
+        if not hasattr(_compression, 'stack'):
+            _compression.stack = []
+        hooks = None
+        if torch.is_grad_enabled():
+            hooks = torch.autograd.graph.saved_tensors_hooks(pack_saved, unpack_saved)
+            hooks.__enter__()
+        _compression.stack.append(hooks)
+
+    def exit(module, inputs, output):
+        hooks = _compression.stack.pop()
+        if hooks is not None:
+            hooks.__exit__(None, None, None)
+
+    def tag_pooled(pool, inputs, output):
+        counts = spike_counts(inputs[0])
+        kh, kw = _pair(pool.kernel_size)
+        if counts is not None and counts * kh * kw <= 255:
+            output.spike_counts = counts * kh * kw
+
+    for m in net.modules():
+        if isinstance(m, nn.AvgPool2d):
+            m.register_forward_hook(tag_pooled)
+    net.register_forward_pre_hook(enter)
+    net.register_forward_hook(exit)
+
+
+# --------------------------------------------------
+# Spike observers
+#   An observer pushed for the duration of a model forward (see models/activity.py) is handed the
+#   spikes of every lif_step / lif_over_time call and the encoded input spikes, in forward order.
+#   Nothing is recorded, and nothing is checked beyond an empty stack, when no observer is pushed.
+# --------------------------------------------------
+_observers = threading.local()
+
+
+def spike_observer():
+    stack = getattr(_observers, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def push_spike_observer(observer):
+    if not hasattr(_observers, 'stack'):
+        _observers.stack = []
+    _observers.stack.append(observer)
+
+
+def pop_spike_observer():
+    return _observers.stack.pop()
+
+
+# --------------------------------------------------
+# BNTT banks
+# --------------------------------------------------
+class BNTTBank(nn.ModuleList):
+    """
+    The per-timestep BatchNorm layers of one layer, bntt[t] for timestep t, out of `size` timestep
+    slots of which only the first `slots` are built. A client replica that runs T timesteps builds T,
+    the server keeps all of them. The state_dict holds the built slots only, and a state_dict of a
+    bigger bank loads into the built slots, the others are skipped instead of reported unexpected.
+    """
+
+    def __init__(self, make_bn, size, slots=None):
+        """
+        :param make_bn: returns a new BatchNorm for one slot
+        :param size: number of timestep slots of the full bank
+        :param slots: slots to build, all of them if None
+        """
+        slots = size if slots is None else min(slots, size)
+        super(BNTTBank, self).__init__([make_bn() for _ in range(slots)])
+        self.size = size
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return nn.ModuleList(list(self._modules.values())[idx])
+        if isinstance(idx, int) and len(self) <= idx < self.size:
+            raise IndexError("BNTT slot {} of {} is not built, only {} timesteps are".format(idx, self.size, len(self)))
+        return super(BNTTBank, self).__getitem__(idx)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs):
+        super(BNTTBank, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs)
+        unexpected_keys[:] = [key for key in unexpected_keys if not self.unbuilt_slot(key, prefix)]
+
+    def unbuilt_slot(self, key, prefix):
+        if not key.startswith(prefix):
+            return False
+        slot = key[len(prefix):].split('.', 1)[0]
+        return slot.isdigit() and len(self) <= int(slot) < self.size
+
+
+class InputCurrent(object):
+    """
+    Synaptic current of the first layer, called with the timestep.
+    Rate coding encodes a new spike map at every timestep and convolves it. With direct coding the
+    image itself is the input at every timestep, so conv(inp) is computed once per batch and the
+    same tensor is returned for every timestep: autograd sums its gradient over the timesteps and
+    runs the conv backward once as well.
+    """
+
+    def __init__(self, conv, inp, direct, encode):
+        """
+        :param conv: first layer
+        :param inp: input batch
+        :param direct: use direct coding instead of the encoder
+        :param encode: spike encoder for rate coding, called as encode(inp, t), see models/encoding.py
+        """
+        self.conv = conv
+        self.inp = inp
+        self.encode = encode
+        self.direct = direct
+        self.static_current = conv(inp) if direct else None
+
+    def refresh(self):
+        """
+        Recompute the static current of direct coding so that it starts a new autograd graph,
+        used when the graph is backpropagated and freed part way through the timesteps
+        """
+        if self.direct:
+            self.static_current = self.conv(self.inp)
+
+    def select(self, index):
+        """
+        Keep only the samples in index (bool mask or indices) for the following timesteps
+        """
+        self.inp = self.inp[index]
+        if hasattr(self.encode, 'select'):
+            self.encode.select(index)
+        if self.static_current is not None:
+            self.static_current = self.static_current[index]
+
+    def __call__(self, t):
+        if self.static_current is not None:
+            return self.static_current
+        spikes = self.encode(self.inp, t)
+        if spike_observer() is not None:
+            spike_observer().record_input(spikes)
+        return self.conv(spikes)
+
+    def time_batched(self, timesteps):
+        """
+        Current of all timesteps stacked as (B*T, ...)
+        """
+        if self.static_current is not None:
+            return repeat_timesteps(self.static_current, timesteps)
+        spikes = stack_timesteps([self.encode(self.inp, t) for t in range(timesteps)])
+        if spike_observer() is not None:
+            spike_observer().record_input(spikes)
+        return self.conv(spikes)
+
+
+def bntt_forward_layer_major(net, input_current):
+    """
+    Layer-major forward of the BNTT models built from conv_list / bntt_list / pool_list and
+    fc1 / bntt_fc / fc2 (SNN_VGG9_BNTT, SNN_VGG11_BNTT, Simple_*_BNTT).
+    With net.checkpoint_layers the spiking layers are checkpointed in segments of that many layers.
+    :param net: the model, net.timesteps gives T
+    :param input_current: InputCurrent of conv_list[0]
+    :return: output voltage averaged over time, (B, num_cls)
+    """
+    if net.checkpoint_timesteps:
+        sys.exit("checkpoint_timesteps needs the time-major forward, use checkpoint_layers with layer_major")
+    timesteps = net.timesteps
+
+    def run_layers(l0, l1, out_prev):
+        for i in range(l0, l1):
+            if i == 0:
+                current = input_current.time_batched(timesteps)
+            elif i == len(net.conv_list):
+                current = net.fc1(out_prev.reshape(out_prev.size(0), -1))
+            else:
+                current = net.conv_list[i](out_prev)
+            current = bntt_over_time(net.bntt_list[i], current, timesteps)
+            out_prev = lif_over_time(current, timesteps, net.leak_mem, spiking_layers(net)[i].threshold)
+            if i < len(net.pool_list) and net.pool_list[i] is not False:
+                out_prev = net.pool_list[i](out_prev)
+        return out_prev
+
+    # the device of input_current.inp tells checkpoint which RNG to restore for rate coding
+    out_prev = input_current.inp
+    for l0, l1 in segments(len(spiking_layers(net)), net.checkpoint_layers):
+        out_prev = checkpoint_segment(net, run_layers, l0, l1, out_prev, enabled=net.checkpoint_layers > 0)
+
+    # accumulate voltage in the last layer
+    return sum_timesteps(net.fc2(out_prev), timesteps) / timesteps
+
+
+# --------------------------------------------------
+# Activation checkpointing
+# Only the inputs of a segment (membranes, spikes) are kept for the backward pass and the
+# activations inside it are recomputed from them, trading compute for memory.
+# --------------------------------------------------
+def segments(length, size):
+    """
+    [start, end) ranges splitting range(length) into chunks of size, one chunk when size is 0
+    """
+    size = size or length
+    return [(start, min(start + size, length)) for start in range(0, length, size)]
+
+
+def checkpoint_segment(net, fn, *args, enabled=True):
+    """
+    Run fn(*args) under torch.utils.checkpoint. The buffers of net (BNTT running stats) are restored
+    after fn is recomputed in the backward pass, so they are updated once per forward as without
+    checkpointing. torch.utils.checkpoint restores the global RNG for the recomputation, and the
+    private generators of a seeded net.encoder are rewound here, so Poisson coding draws the same spikes.
+    :param net: the model that owns the layers used by fn
+    :param fn: segment to checkpoint, returns a tensor or a tuple of tensors
+    :param enabled: run fn directly when False
+    """
+    if not (enabled and torch.is_grad_enabled()):
+        return fn(*args)
+    encoder = getattr(net, 'encoder', None)
+    seeded = hasattr(encoder, 'get_state')
+    # encoder generator states at the start of the first run
+    calls = []
+
+    def run(*args):
+        if not calls:
+            calls.append(encoder.get_state() if seeded else None)
+            return fn(*args)
+        buffers = [b.clone() for b in net.buffers()]
+        if seeded:
+            rng_state = encoder.get_state()
+            encoder.set_state(calls[0])
+        try:
+            return fn(*args)
+        finally:
+            with torch.no_grad():
+                for b, saved in zip(net.buffers(), buffers):
+                    b.copy_(saved)
+            if seeded:
+                encoder.set_state(rng_state)
+
+    return checkpoint(run, *args, use_reentrant=False)
+
+
+def spiking_layers(net):
+    """
+    Weight layers of the BNTT models that drive a LIF layer: conv_list followed by fc1, matching bntt_list
+    """
+    return net.conv_list + [net.fc1]
+
+
+def bntt_step(net, input_current, i, t, out_prev, mem):
+    """
+    Timestep t of spiking layer i of a BNTT model, as in the time-major loop of its forward
+    :return: (output spikes after pooling, new membrane)
+    """
+    if i == 0:
+        current = input_current(t)
+    elif i == len(net.conv_list):
+        current = net.fc1(out_prev.reshape(out_prev.size(0), -1))
+    else:
+        current = net.conv_list[i](out_prev)
+    out_prev, mem = lif_step(net.bntt_list[i][t](current), mem, net.leak_mem, spiking_layers(net)[i].threshold)
+    if i < len(net.pool_list) and net.pool_list[i] is not False:
+        out_prev = net.pool_list[i](out_prev)
+    return out_prev, mem
+
+
+def bntt_forward_checkpointed(net, input_current):
+    """
+    Time-major forward of the BNTT models with the timesteps checkpointed in segments of
+    net.checkpoint_timesteps and, within a timestep, the spiking layers in segments of
+    net.checkpoint_layers (0 leaves that dimension unsplit). Only the membranes at the segment
+    boundaries are kept, so memory no longer grows with every layer of every timestep.
+    :param net: the model, net.timesteps gives T
+    :param input_current: InputCurrent of conv_list[0]
+    :return: output voltage averaged over time, (B, num_cls)
+    """
+    num_layers = len(spiking_layers(net))
+
+    def run_layers(t, l0, l1, out_prev, *mems):
+        mems = list(mems)
+        for i in range(l0, l1):
+            out_prev, mems[i - l0] = bntt_step(net, input_current, i, t, out_prev, mems[i - l0])
+        return (out_prev, *mems)
+
+    def run_timesteps(t0, t1, mem_fc2, *mems):
+        mems = list(mems)
+        for t in range(t0, t1):
+            out_prev = None
+            for l0, l1 in segments(num_layers, net.checkpoint_layers):
+                out_prev, *mems[l0:l1] = checkpoint_segment(net, run_layers, t, l0, l1, out_prev, *mems[l0:l1],
+                                                            enabled=net.checkpoint_layers > 0)
+            # accumulate voltage in the last layer
+            mem_fc2 = mem_fc2 + net.fc2(out_prev)
+        return (mem_fc2, *mems)
+
+    inp = input_current.inp
+    # membranes start at rest, lif_step allocates them on the first timestep
+    mems = [None] * num_layers
+    mem_fc2 = torch.zeros(inp.size(0), net.num_cls, device=inp.device)
+    for t0, t1 in segments(net.timesteps, net.checkpoint_timesteps):
+        mem_fc2, *mems = checkpoint_segment(net, run_timesteps, t0, t1, mem_fc2, *mems,
+                                            enabled=net.checkpoint_timesteps > 0)
+
+    return mem_fc2 / net.timesteps
+
+
+# --------------------------------------------------
+# Truncated BPTT
+# --------------------------------------------------
+def bntt_forward_truncated(net, input_current, window):
+    """
+    Time-major forward of the BNTT models over windows of `window` timesteps, for truncated BPTT.
+    The membranes are detached at the start of every window, so the graph of one window never
+    reaches into the previous ones and can be backpropagated and freed before the next window runs.
+    window=1 gives online training, one timestep per graph.
+    :param net: the model, net.timesteps gives T
+    :param input_current: InputCurrent of conv_list[0]
+    :param window: timesteps per window
+    :return: generator of the output voltage averaged over the timesteps run so far, one per window
+    """
+    num_layers = len(spiking_layers(net))
+    inp = input_current.inp
+    # membranes start at rest, lif_step allocates them on the first timestep
+    mems = [None] * num_layers
+    mem_fc2 = torch.zeros(inp.size(0), net.num_cls, device=inp.device)
+    for t0, t1 in segments(net.timesteps, window):
+        mems = [mem.detach() if mem is not None else None for mem in mems]
+        mem_fc2 = mem_fc2.detach()
+        if t0 > 0:
+            input_current.refresh()
+        for t in range(t0, t1):
+            out_prev = None
+            for i in range(num_layers):
+                out_prev, mems[i] = bntt_step(net, input_current, i, t, out_prev, mems[i])
+            # accumulate voltage in the last layer
+            mem_fc2 = mem_fc2 + net.fc2(out_prev)
+        yield mem_fc2 / t1
+
+
+def truncated_backward(net, loss_func, images, labels, window, autocast=contextlib.nullcontext):
+    """
+    Truncated BPTT for one batch: every window backpropagates the loss of the output accumulated so
+    far and the gradients are averaged over the windows. Memory and the cost of each backward depend
+    on the window instead of T; window >= T is the same as full BPTT.
+    :param net: a BNTT model, or nn.DataParallel of one
+    :param window: timesteps per window
+    :param autocast: returns the context the forward of each window runs in, e.g. bf16 autocast
+    :return: loss of the output over all timesteps
+    """
+    model = net.module if isinstance(net, torch.nn.DataParallel) else net
+    if not hasattr(model, 'forward_truncated'):
+        sys.exit("Truncated BPTT is not supported by {}".format(type(model).__name__))
+    windows = 0
+    outputs = model.forward_truncated(images, window)
+    while True:
+        # the generator runs the forward of the next window on next()
+        with autocast():
+            log_probs = next(outputs, None)
+            if log_probs is None:
+                break
+            loss = loss_func(log_probs, labels)
+        loss.backward()
+        windows += 1
+    for p in net.parameters():
+        if p.grad is not None:
+            p.grad.div_(windows)
+    return loss
+
+
+# --------------------------------------------------
+# Early-exit inference
+# --------------------------------------------------
+def bntt_forward_early_exit(net, input_current, margin, patience):
+    """
+    Time-major inference of the BNTT models where a sample stops being simulated once the gap between
+    the two largest averaged output voltages has been above `margin` for `patience` consecutive
+    timesteps with the same predicted class. Exited samples are dropped from the batch, so the
+    remaining timesteps only run on the undecided ones. That would change batch statistics, so every
+    BNTT layer must normalise with running stats: the model is in eval mode and, if it does not track
+    them (SNN_VGG9_BNTT), calibrated with calibrate_running_stats.
+    :param net: the model, net.timesteps gives the maximum T
+    :param input_current: InputCurrent of conv_list[0]
+    :param margin: top-1 minus top-2 output voltage needed to count a timestep as confident
+    :param patience: consecutive confident timesteps before a sample exits
+    :return: (output voltage averaged over the timesteps each sample ran (B, num_cls), timesteps each sample ran (B,))
+    """
+    if any(bntt[t].training or bntt[t].running_mean is None for bntt in net.bntt_list for t in range(net.timesteps)):
+        sys.exit("Early exit needs BNTT running stats: put {} in eval mode and calibrate it (--calibrate_bntt)".format(type(net).__name__))
+    num_layers = len(spiking_layers(net))
+    inp = input_current.inp
+    batch_size = inp.size(0)
+    out_voltage = torch.zeros(batch_size, net.num_cls, dtype=inp.dtype, device=inp.device)
+    timesteps_used = torch.full((batch_size,), net.timesteps, dtype=torch.long, device=inp.device)
+
+    # original batch index, confident streak and last prediction of the samples still running
+    active = torch.arange(batch_size, device=inp.device)
+    streak = torch.zeros(batch_size, dtype=torch.long, device=inp.device)
+    prev_pred = torch.full((batch_size,), -1, dtype=torch.long, device=inp.device)
+    # membranes start at rest, lif_step allocates them on the first timestep
+    mems = [None] * num_layers
+    mem_fc2 = torch.zeros(batch_size, net.num_cls, dtype=inp.dtype, device=inp.device)
+
+    for t in range(net.timesteps):
+        out_prev = None
+        for i in range(num_layers):
+            out_prev, mems[i] = bntt_step(net, input_current, i, t, out_prev, mems[i])
+        # accumulate voltage in the last layer
+        mem_fc2 = mem_fc2 + net.fc2(out_prev)
+
+        avg_voltage = mem_fc2 / (t + 1)
+        if t == net.timesteps - 1:
+            out_voltage[active] = avg_voltage
+            break
+        top2, pred = avg_voltage.topk(2, dim=1)
+        above = (top2[:, 0] - top2[:, 1]) > margin
+        streak = torch.where(above & (pred[:, 0] == prev_pred), streak + 1, above.long())
+        prev_pred = pred[:, 0]
+        done = streak >= patience
+        if not done.any():
+            continue
+
+        out_voltage[active[done]] = avg_voltage[done]
+        timesteps_used[active[done]] = t + 1
+        keep = ~done
+        if not keep.any():
+            break
+        active, streak, prev_pred, mem_fc2 = active[keep], streak[keep], prev_pred[keep], mem_fc2[keep]
+        mems = [mem[keep] for mem in mems]
+        input_current.select(keep)
+
+    return out_voltage, timesteps_used
+
+
+# --------------------------------------------------
+# Multi-horizon inference
+# --------------------------------------------------
+def bntt_forward_horizons(net, input_current, horizons):
+    """
+    Time-major inference of the BNTT models read out at several numbers of timesteps in one
+    simulation. Timestep t uses bntt[t] whatever the total, so the readout at horizon T is the output
+    of the model run with T timesteps (on the same input spikes).
+    :param net: the model; net.timesteps is ignored, the simulation runs to max(horizons)
+    :param input_current: InputCurrent of conv_list[0]
+    :param horizons: numbers of timesteps to read the output at
+    :return: list of output voltages averaged over each horizon, (B, num_cls) each, in the order of horizons
+    """
+    num_layers = len(spiking_layers(net))
+    inp = input_current.inp
+    # membranes start at rest, lif_step allocates them on the first timestep
+    mems = [None] * num_layers
+    mem_fc2 = torch.zeros(inp.size(0), net.num_cls, device=inp.device)
+    readouts = {}
+
+    for t in range(max(horizons)):
+        out_prev = None
+        for i in range(num_layers):
+            out_prev, mems[i] = bntt_step(net, input_current, i, t, out_prev, mems[i])
+        # accumulate voltage in the last layer
+        mem_fc2 = mem_fc2 + net.fc2(out_prev)
+        if t + 1 in horizons:
+            readouts[t + 1] = mem_fc2 / (t + 1)
+
+    return [readouts[horizon] for horizon in horizons]
@@ -5,9 +5,50 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
-from torch.utils.data import DataLoader, RandomSampler
+from torch.utils.data import DataLoader, RandomSampler, Subset
 import sys
 import os
+from utils.device import to_device
+from models.encoding import SpikeTrainCache
+from models.activity import ActivityRecorder
+
+# (test subset, SpikeTrainCache) per dataset and number of timesteps, kept across rounds
+eval_spike_caches = {}
+
+
+def eval_spike_cache(model, datatest, args, timesteps=None):
+    """
+    Fixed test subset of size args.test_size (the whole dataset if unset) and its input spike trains,
+    encoded by model.encoder on the first evaluation and reused by every later one
+    :param timesteps: length of the trains, model.timesteps if None
+    """
+    timesteps = model.timesteps if timesteps is None else timesteps
+    key = (id(datatest), timesteps)
+    if key not in eval_spike_caches:
+        test_size = min(len(datatest), args.test_size) if args.test_size else len(datatest)
+        idxs = torch.randperm(len(datatest), generator=torch.Generator().manual_seed(args.seed))[:test_size]
+        subset = Subset(datatest, idxs.tolist())
+        batches = (to_device(data, args) for data, target in DataLoader(subset, batch_size=args.bs))
+        with torch.no_grad():
+            eval_spike_caches[key] = (subset, SpikeTrainCache(model.encoder, batches, timesteps))
+    return eval_spike_caches[key]
+
+
+def test_loader(model, datatest, args, timesteps=None):
+    """
+    Evaluation batches of test_img: the cached spike subset with args.cache_eval_spikes, a random
+    subset of args.test_size, or the whole dataset
+    :param timesteps: timesteps the cached trains must cover, model.timesteps if None
+    :return: (data_loader, test_size, SpikeTrainCache or None)
+    """
+    if args.cache_eval_spikes and hasattr(model, 'encoder') and hasattr(model, 'timesteps') and not model.direct:
+        datatest, cache = eval_spike_cache(model, datatest, args, timesteps)
+        return DataLoader(datatest, batch_size=args.bs), len(datatest), cache
+    if args.test_size:
+        test_size = min(len(datatest), args.test_size)
+        sampler = RandomSampler(datatest, num_samples=test_size)
+        return DataLoader(datatest, sampler=sampler, batch_size=args.bs), test_size, None
+    return DataLoader(datatest, batch_size=args.bs), len(datatest), None
 
 
 def test_img(net_g, datatest, args):
@@ -15,50 +56,104 @@ def test_img(net_g, datatest, args):
     # testing
     test_loss = 0
     correct = 0
-    if args.test_size:
-        test_size = min(len(datatest), args.test_size)
-        sampler = RandomSampler(datatest, num_samples=test_size)
-        data_loader = DataLoader(datatest, sampler=sampler, batch_size=args.bs)
-    else:
-        data_loader = DataLoader(datatest, batch_size=args.bs)
-        test_size = len(data_loader.dataset)
-    
+    model = net_g.module if isinstance(net_g, nn.DataParallel) else net_g
+    data_loader, test_size, cache = test_loader(model, datatest, args)
+    if cache is not None:
+        encoder = model.encoder
+        # the replayed trains follow the batch order, so run the model on a single device
+        net_g = model
+
+    early_exit = args.early_exit_margin is not None and hasattr(model, 'forward_early_exit')
+    timesteps_used = 0
+
     print("Testing on {} images".format(test_size))
     # l = len(data_loader)
     for idx, (data, target) in enumerate(data_loader):
-        if args.gpu != -1:
-            data, target = data.cuda(), target.cuda()
-        log_probs = net_g(data)
+        data, target = to_device(data, args), target.to(args.device)
+        if cache is not None:
+            model.encoder = cache.replay(torch.arange(idx * args.bs, idx * args.bs + len(data), device=cache.spikes.device))
+        if early_exit:
+            with torch.no_grad():
+                log_probs, timesteps = model.forward_early_exit(data, args.early_exit_margin, args.early_exit_patience)
+            timesteps_used += timesteps.sum().item()
+        else:
+            log_probs = net_g(data)
         # sum up batch loss
         test_loss += F.cross_entropy(log_probs, target, reduction='sum').item()
         # get the index of the max log-probability
         y_pred = log_probs.data.max(1, keepdim=True)[1]
         correct += y_pred.eq(target.data.view_as(y_pred)).long().cpu().sum()
 
+    if cache is not None:
+        model.encoder = encoder
+
     test_loss /= test_size
     accuracy = 100.00 * correct / test_size
     if args.verbose:
         print('\nTest set: Average loss: {:.4f} \nAccuracy: {}/{} ({:.2f}%)\n'.format(
             test_loss, correct, test_size, accuracy))
+    if early_exit:
+        print('Early exit: accuracy {:.2f}%, {:.2f} of {} timesteps on average'.format(
+            accuracy, timesteps_used / test_size, model.timesteps))
     return accuracy.item(), test_loss
 
+def test_img_horizons(net_g, datatest, args, horizons):
+    """
+    Accuracy and loss of the model run with each number of timesteps in horizons. Models with
+    forward_horizons read all of them out of a single simulation to max(horizons) on the same
+    inputs; the others are tested once per horizon.
+    :return: list of (accuracy, loss), in the order of horizons
+    """
+    model = net_g.module if isinstance(net_g, nn.DataParallel) else net_g
+    if not hasattr(model, 'forward_horizons'):
+        timesteps = model.timesteps
+        results = []
+        for horizon in horizons:
+            model.timesteps = horizon
+            results.append(test_img(net_g, datatest, args))
+        model.timesteps = timesteps
+        return results
+
+    model.eval()
+    test_loss = [0.0] * len(horizons)
+    correct = [0] * len(horizons)
+    data_loader, test_size, cache = test_loader(model, datatest, args, max(horizons))
+    encoder = model.encoder
+
+    print("Testing on {} images at timesteps {}".format(test_size, horizons))
+    for idx, (data, target) in enumerate(data_loader):
+        data, target = to_device(data, args), target.to(args.device)
+        if cache is not None:
+            model.encoder = cache.replay(torch.arange(idx * args.bs, idx * args.bs + len(data), device=cache.spikes.device))
+        with torch.no_grad():
+            outputs = model.forward_horizons(data, horizons)
+        for h, log_probs in enumerate(outputs):
+            test_loss[h] += F.cross_entropy(log_probs, target, reduction='sum').item()
+            y_pred = log_probs.data.max(1, keepdim=True)[1]
+            correct[h] += y_pred.eq(target.data.view_as(y_pred)).long().cpu().sum().item()
+
+    model.encoder = encoder
+    results = [(100.00 * correct[h] / test_size, test_loss[h] / test_size) for h in range(len(horizons))]
+    if args.verbose:
+        for horizon, hits, (accuracy, loss) in zip(horizons, correct, results):
+            print('\nTest set, {} timesteps: Average loss: {:.4f} \nAccuracy: {}/{} ({:.2f}%)\n'.format(
+                horizon, loss, hits, test_size, accuracy))
+    return results
+
 def comp_activity(net_g, dataset, args):
+    """
+    Firing rate of every spiking layer of net_g over dataset, in a single pass with one readback
+    :return: tensor of per-layer rates, preceded by the input spike rate for rate-coded models
+    """
     net_g.eval()
-    # testing
     data_loader = DataLoader(dataset, batch_size=args.bs)
-    l = len(data_loader)
-    for idx, (data, target) in enumerate(data_loader):
-        if args.gpu != -1:
-            data, target = data.cuda(), target.cuda()
-        activity = torch.zeros(net_g(data, count_active_layers = True))
-        break
-    batch_count = 0
-    for idx, (data, target) in enumerate(data_loader):
-        if args.gpu != -1:
-            data, target = data.cuda(), target.cuda()
-        activity += torch.tensor(net_g(data, report_activity = True))
-        # sum up batch loss
-        batch_count += 1
-    activity = activity/batch_count
-
-    return activity
\ No newline at end of file
+    recorder = ActivityRecorder(net_g)
+    with torch.no_grad():
+        for idx, (data, target) in enumerate(data_loader):
+            net_g(to_device(data, args))
+    activity = recorder.read()
+    recorder.remove()
+    rates = activity['firing_rate']
+    if activity['input_rate'] is not None:
+        rates = [activity['input_rate']] + rates
+    return torch.tensor(rates)
\ No newline at end of file
@@ -1,47 +1,23 @@
 import torch
 import torch.nn as nn
-import torch.nn.functional as F
-import sys
-
-
-
-
-class Surrogate_BP_Function(torch.autograd.Function):
-
-
-    @staticmethod
-    def forward(ctx, input):
-        ctx.save_for_backward(input)
-        out = torch.zeros_like(input).cuda()
-        out[input > 0] = 1.0
-        return out
-
-    @staticmethod
-    def backward(ctx, grad_output):
-        input, = ctx.saved_tensors
-        grad_input = grad_output.clone()
-        grad = grad_input * 0.3 * F.threshold(1.0 - torch.abs(input), 0, 0)
-        return grad
-
-
-def PoissonGen(inp, rescale_fac=2.0):
-    rand_inp = torch.rand_like(inp).cuda()
-    return torch.mul(torch.le(rand_inp * rescale_fac, torch.abs(inp)).float(), torch.sign(inp))
-
-
-
 
+from models.spiking import BNTTBank, lif_step, compress_saved_activations, InputCurrent, bntt_forward_layer_major, bntt_forward_checkpointed, bntt_forward_truncated, bntt_forward_early_exit, bntt_forward_horizons
+from models.encoding import build_encoder
 
 
 class SNN_VGG9_BNTT(nn.Module):
-    def __init__(self, timesteps=25, max_timestep=35, leak_mem=0.95, img_size=32,  num_cls=10):
+    def __init__(self, timesteps=25, max_timestep=35, leak_mem=0.95, img_size=32,  num_cls=10, layer_major=False, direct=False, checkpoint_timesteps=0, checkpoint_layers=0, encoder='poisson', encoder_seed=None, compress_activations=False, bntt_slots=None):
         super(SNN_VGG9_BNTT, self).__init__()
 
         self.img_size = img_size
         self.num_cls = num_cls
         self.timesteps = timesteps
-        self.spike_fn = Surrogate_BP_Function.apply
         self.leak_mem = leak_mem
+        self.layer_major = layer_major
+        self.direct = direct
+        self.encoder = build_encoder(encoder, encoder_seed)
+        self.checkpoint_timesteps = checkpoint_timesteps
+        self.checkpoint_layers = checkpoint_layers
         self.batch_num = self.timesteps
         self.max_batch_num = max_timestep
 
@@ -53,28 +29,28 @@ class SNN_VGG9_BNTT(nn.Module):
         bias_flag = False
 
         self.conv1 = nn.Conv2d(3, 64, kernel_size=3, stride=1, padding=1, bias=bias_flag)
-        self.bntt1 = nn.ModuleList([nn.BatchNorm2d(64, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False) for i in range(self.max_batch_num)])
+        self.bntt1 = BNTTBank(lambda: nn.BatchNorm2d(64, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False), self.max_batch_num, bntt_slots)
         self.conv2 = nn.Conv2d(64, 64, kernel_size=3, stride=1, padding=1, bias=bias_flag)
-        self.bntt2 = nn.ModuleList([nn.BatchNorm2d(64, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False) for i in range(self.max_batch_num)])
+        self.bntt2 = BNTTBank(lambda: nn.BatchNorm2d(64, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False), self.max_batch_num, bntt_slots)
         self.pool1 = nn.AvgPool2d(kernel_size=2)
 
         self.conv3 = nn.Conv2d(64, 128, kernel_size=3, stride=1, padding=1, bias=bias_flag)
-        self.bntt3 = nn.ModuleList([nn.BatchNorm2d(128, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False) for i in range(self.max_batch_num)])
+        self.bntt3 = BNTTBank(lambda: nn.BatchNorm2d(128, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False), self.max_batch_num, bntt_slots)
         self.conv4 = nn.Conv2d(128, 128, kernel_size=3, stride=1, padding=1, bias=bias_flag)
-        self.bntt4 = nn.ModuleList([nn.BatchNorm2d(128, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False) for i in range(self.max_batch_num)])
+        self.bntt4 = BNTTBank(lambda: nn.BatchNorm2d(128, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False), self.max_batch_num, bntt_slots)
         self.pool2 = nn.AvgPool2d(kernel_size=2)
 
         self.conv5 = nn.Conv2d(128, 256, kernel_size=3, stride=1, padding=1, bias=bias_flag)
-        self.bntt5 = nn.ModuleList([nn.BatchNorm2d(256, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False) for i in range(self.max_batch_num)])
+        self.bntt5 = BNTTBank(lambda: nn.BatchNorm2d(256, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False), self.max_batch_num, bntt_slots)
         self.conv6 = nn.Conv2d(256, 256, kernel_size=3, stride=1, padding=1, bias=bias_flag)
-        self.bntt6 = nn.ModuleList([nn.BatchNorm2d(256, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False) for i in range(self.max_batch_num)])
+        self.bntt6 = BNTTBank(lambda: nn.BatchNorm2d(256, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False), self.max_batch_num, bntt_slots)
         self.conv7 = nn.Conv2d(256, 256, kernel_size=3, stride=1, padding=1, bias=bias_flag)
-        self.bntt7 = nn.ModuleList([nn.BatchNorm2d(256, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False) for i in range(self.max_batch_num)])
+        self.bntt7 = BNTTBank(lambda: nn.BatchNorm2d(256, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False), self.max_batch_num, bntt_slots)
         self.pool3 = nn.AvgPool2d(kernel_size=2)
 
 
         self.fc1 = nn.Linear((self.img_size//8)*(self.img_size//8)*256, 1024, bias=bias_flag)
-        self.bntt_fc = nn.ModuleList([nn.BatchNorm1d(1024, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False) for i in range(self.max_batch_num)])
+        self.bntt_fc = BNTTBank(lambda: nn.BatchNorm1d(1024, eps=1e-4, momentum=0.1, affine=affine_flag, track_running_stats=False), self.max_batch_num, bntt_slots)
         self.fc2 = nn.Linear(1024, self.num_cls, bias=bias_flag)
 
         self.conv_list = [self.conv1, self.conv2, self.conv3, self.conv4, self.conv5, self.conv6, self.conv7]
@@ -96,65 +72,43 @@ class SNN_VGG9_BNTT(nn.Module):
                 m.threshold = 1.0
                 torch.nn.init.xavier_uniform_(m.weight, gain=2)
 
+        if compress_activations:
+            compress_saved_activations(self)
+
 
 
     def forward(self, inp):
 
-        batch_size = inp.size(0)
-        mem_conv1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv2 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv3 = torch.zeros(batch_size, 128, self.img_size//2, self.img_size//2).cuda()
-        mem_conv4 = torch.zeros(batch_size, 128, self.img_size//2, self.img_size//2).cuda()
-        mem_conv5 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-        mem_conv6 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-        mem_conv7 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-        mem_conv_list = [mem_conv1, mem_conv2, mem_conv3, mem_conv4, mem_conv5, mem_conv6, mem_conv7]
+        input_current = InputCurrent(self.conv1, inp, self.direct, self.encoder)
+        if self.layer_major:
+            return bntt_forward_layer_major(self, input_current)
+        if self.checkpoint_timesteps or self.checkpoint_layers:
+            return bntt_forward_checkpointed(self, input_current)
 
-        mem_fc1 = torch.zeros(batch_size, 1024).cuda()
-        mem_fc2 = torch.zeros(batch_size, self.num_cls).cuda()
+        batch_size = inp.size(0)
+        # membranes start at rest, lif_step allocates them on the first timestep
+        mem_conv_list = [None] * len(self.conv_list)
 
-        active_layer_count = 9
-        # activity = torch.zeros(active_layer_count).cuda()
+        mem_fc1 = None
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
 
         for t in range(self.timesteps):
 
-            spike_inp = PoissonGen(inp)
-            out_prev = spike_inp
-            # activity[0] += torch.count_nonzero(spike_inp.detach())/torch.numel(spike_inp.detach())
-
             for i in range(len(self.conv_list)):
-                mem_conv_list[i] = self.leak_mem * mem_conv_list[i] + self.bntt_list[i][t](self.conv_list[i](out_prev))
-                mem_thr = (mem_conv_list[i] / self.conv_list[i].threshold) - 1.0
-                out = self.spike_fn(mem_thr)
-                rst = torch.zeros_like(mem_conv_list[i]).cuda()
-                rst[mem_thr > 0] = self.conv_list[i].threshold
-                mem_conv_list[i] = mem_conv_list[i] - rst
-                out_prev = out.clone()
+                conv_out = input_current(t) if i == 0 else self.conv_list[i](out_prev)
+                out_prev, mem_conv_list[i] = lif_step(self.bntt_list[i][t](conv_out), mem_conv_list[i], self.leak_mem, self.conv_list[i].threshold)
 
                 if self.pool_list[i] is not False:
-                    out = self.pool_list[i](out_prev)
-                    out_prev = out.clone()
-                
-                # activity[i+1] += torch.count_nonzero(out_prev.detach())/torch.numel(out_prev.detach())
+                    out_prev = self.pool_list[i](out_prev)
 
             out_prev = out_prev.reshape(batch_size, -1)
 
-            mem_fc1 = self.leak_mem * mem_fc1 + self.bntt_fc[t](self.fc1(out_prev))
-            mem_thr = (mem_fc1 / self.fc1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_fc1).cuda()
-            rst[mem_thr > 0] = self.fc1.threshold
-            mem_fc1 = mem_fc1 - rst
-            out_prev = out.clone()
-
-            # activity[8] += torch.count_nonzero(out_prev.detach())/torch.numel(out_prev.detach())
+            out_prev, mem_fc1 = lif_step(self.bntt_fc[t](self.fc1(out_prev)), mem_fc1, self.leak_mem, self.fc1.threshold)
 
             # accumulate voltage in the last layer
             mem_fc2 = mem_fc2 + self.fc2(out_prev)
 
         out_voltage = mem_fc2 / self.timesteps
-        # activity = torch.stack([x / self.timesteps for x in activity])
-        # print(activity)
 
         return out_voltage
     
@@ -162,16 +116,38 @@ class SNN_VGG9_BNTT(nn.Module):
         print("setting timestep: ", timestep)
         self.timesteps = timestep
 
+    def forward_truncated(self, inp, window):
+        """
+        Forward over windows of timesteps for truncated BPTT, see bntt_forward_truncated
+        """
+        return bntt_forward_truncated(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), window)
+
+    def forward_early_exit(self, inp, margin, patience):
+        """
+        Inference that stops simulating confident samples, see bntt_forward_early_exit
+        """
+        return bntt_forward_early_exit(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), margin, patience)
+
+    def forward_horizons(self, inp, horizons):
+        """
+        Inference read out at several numbers of timesteps in one simulation, see bntt_forward_horizons
+        """
+        return bntt_forward_horizons(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), horizons)
+
 
 class SNN_VGG11_BNTT(nn.Module):
-    def __init__(self, timesteps=20, leak_mem=0.95, img_size=32,  num_cls=10):
+    def __init__(self, timesteps=20, leak_mem=0.95, img_size=32,  num_cls=10, layer_major=False, direct=False, checkpoint_timesteps=0, checkpoint_layers=0, encoder='poisson', encoder_seed=None, compress_activations=False):
         super(SNN_VGG11_BNTT, self).__init__()
 
         self.img_size = img_size
         self.num_cls = num_cls
         self.timesteps = timesteps
-        self.spike_fn = Surrogate_BP_Function.apply
         self.leak_mem = leak_mem
+        self.layer_major = layer_major
+        self.direct = direct
+        self.encoder = build_encoder(encoder, encoder_seed)
+        self.checkpoint_timesteps = checkpoint_timesteps
+        self.checkpoint_layers = checkpoint_layers
         self.batch_num = self.timesteps
 
         print (">>>>>>>>>>>>>>>>> VGG11 >>>>>>>>>>>>>>>>>>>>>>>")
@@ -234,56 +210,43 @@ class SNN_VGG11_BNTT(nn.Module):
                 m.threshold = 1.0
                 torch.nn.init.xavier_uniform_(m.weight, gain=2)
 
+        if compress_activations:
+            compress_saved_activations(self)
+
 
 
 
     def forward(self, inp):
 
+        input_current = InputCurrent(self.conv1, inp, self.direct, self.encoder)
+        if self.layer_major:
+            return bntt_forward_layer_major(self, input_current)
+        if self.checkpoint_timesteps or self.checkpoint_layers:
+            return bntt_forward_checkpointed(self, input_current)
+
         batch_size = inp.size(0)
-        mem_conv1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv2 = torch.zeros(batch_size, 128, self.img_size // 2, self.img_size // 2).cuda()
-        mem_conv3 = torch.zeros(batch_size, 256, self.img_size // 4, self.img_size // 4).cuda()
-        mem_conv4 = torch.zeros(batch_size, 256, self.img_size // 4, self.img_size // 4).cuda()
-        mem_conv5 = torch.zeros(batch_size, 512, self.img_size // 8, self.img_size // 8).cuda()
-        mem_conv6 = torch.zeros(batch_size, 512, self.img_size // 8, self.img_size // 8).cuda()
-        mem_conv7 = torch.zeros(batch_size, 512, self.img_size // 16, self.img_size // 16).cuda()
-        mem_conv8 = torch.zeros(batch_size, 512, self.img_size // 16, self.img_size // 16).cuda()
-        mem_conv_list = [mem_conv1, mem_conv2, mem_conv3, mem_conv4, mem_conv5, mem_conv6, mem_conv7, mem_conv8]
+        # membranes start at rest, lif_step allocates them on the first timestep
+        mem_conv_list = [None] * len(self.conv_list)
 
-        mem_fc1 = torch.zeros(batch_size, 4096).cuda()
-        mem_fc2 = torch.zeros(batch_size, self.num_cls).cuda()
+        mem_fc1 = None
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
 
 
 
         for t in range(self.timesteps):
 
-            spike_inp = PoissonGen(inp)
-            out_prev = spike_inp
-
             for i in range(len(self.conv_list)):
-                mem_conv_list[i] = self.leak_mem * mem_conv_list[i] + self.bntt_list[i][t](self.conv_list[i](out_prev))
-                mem_thr = (mem_conv_list[i] / self.conv_list[i].threshold) - 1.0
-                out = self.spike_fn(mem_thr)
-                rst = torch.zeros_like(mem_conv_list[i]).cuda()
-                rst[mem_thr > 0] = self.conv_list[i].threshold
-                mem_conv_list[i] = mem_conv_list[i] - rst
-                out_prev = out.clone()
+                conv_out = input_current(t) if i == 0 else self.conv_list[i](out_prev)
+                out_prev, mem_conv_list[i] = lif_step(self.bntt_list[i][t](conv_out), mem_conv_list[i], self.leak_mem, self.conv_list[i].threshold)
 
 
                 if self.pool_list[i] is not False:
-                    out = self.pool_list[i](out_prev)
-                    out_prev = out.clone()
+                    out_prev = self.pool_list[i](out_prev)
 
 
             out_prev = out_prev.reshape(batch_size, -1)
 
-            mem_fc1 = self.leak_mem * mem_fc1 + self.bntt_fc[t](self.fc1(out_prev))
-            mem_thr = (mem_fc1 / self.fc1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_fc1).cuda()
-            rst[mem_thr > 0] = self.fc1.threshold
-            mem_fc1 = mem_fc1 - rst
-            out_prev = out.clone()
+            out_prev, mem_fc1 = lif_step(self.bntt_fc[t](self.fc1(out_prev)), mem_fc1, self.leak_mem, self.fc1.threshold)
 
             # accumulate voltage in the last layer
             mem_fc2 = mem_fc2 + self.fc2(out_prev)
@@ -291,4 +254,23 @@ class SNN_VGG11_BNTT(nn.Module):
 
         out_voltage = mem_fc2 / self.timesteps
 
-        return out_voltage
\ No newline at end of file
+        return out_voltage
+
+    def forward_truncated(self, inp, window):
+        """
+        Forward over windows of timesteps for truncated BPTT, see bntt_forward_truncated
+        """
+        return bntt_forward_truncated(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), window)
+
+    def forward_early_exit(self, inp, margin, patience):
+        """
+        Inference that stops simulating confident samples, see bntt_forward_early_exit
+        """
+        return bntt_forward_early_exit(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), margin, patience)
+
+    def forward_horizons(self, inp, horizons):
+        """
+        Inference read out at several numbers of timesteps in one simulation, see bntt_forward_horizons
+        """
+        return bntt_forward_horizons(self, InputCurrent(self.conv1, inp, self.direct, self.encoder), horizons)
+
@@ -14,6 +14,9 @@ import numpy as np
 import numpy.linalg as LA
 from torch.autograd import Variable
 
+from models.spiking import lif_step, InputCurrent
+from models.encoding import PoissonGen, build_encoder
+
 
 # --------------------------------------------------
 # Spiking neuron with fast-sigmoid surrogate gradient
@@ -39,7 +42,7 @@ class SuperSpike(torch.autograd.Function):
         the ctx.save_for_backward method.
         """
         ctx.save_for_backward(input)
-        out = torch.zeros_like(input).cuda()
+        out = torch.zeros_like(input)
         out[input > 0] = 1.0
         return out
 
@@ -79,7 +82,7 @@ class LinearSpike(torch.autograd.Function):
         the ctx.save_for_backward method.
         """
         ctx.save_for_backward(input)
-        out = torch.zeros_like(input).cuda()
+        out = torch.zeros_like(input)
         out[input > 0] = 1.0
         return out
 
@@ -120,7 +123,7 @@ class ExpSpike(torch.autograd.Function):
         the ctx.save_for_backward method.
         """
         ctx.save_for_backward(input)
-        out = torch.zeros_like(input).cuda()
+        out = torch.zeros_like(input)
         out[input > 0] = 1.0
         return out
 
@@ -157,7 +160,7 @@ class PassThruSpike(torch.autograd.Function):
         stash input information since it is not used for backpropagation.
         """
         # ctx.save_for_backward(input)
-        out = torch.zeros_like(input).cuda()
+        out = torch.zeros_like(input)
         out[input > 0] = 1.0
         return out
 
@@ -188,30 +191,16 @@ def init_spike_fn(grad_type):
     return spike_fn
 
 
-# --------------------------------------------------
-# Poisson spike generator
-#   Positive spike is generated (i.e.  1 is returned) if rand()<=abs(input) and sign(input)= 1
-#   Negative spike is generated (i.e. -1 is returned) if rand()<=abs(input) and sign(input)=-1
-# --------------------------------------------------
-def PoissonGen(inp, rescale_fac=2.0):
-    rand_inp = torch.rand_like(inp).cuda()
-    return torch.mul(torch.le(rand_inp * rescale_fac, torch.abs(inp)).float(), torch.sign(inp))
-
-
-
-
-
-
-
-
 class SNN_VGG9_TBN(nn.Module):
     def __init__(self, dt=0.001, t_end=0.100, inp_rate=100, grad_type='Linear', thresh_init_wnorm=False,
                  leak_mem=0.99, img_size=32, inp_maps=3, c1_maps=64, c2_maps=64, ksize=3, fc0_size=200,
-                 num_cls=1000, drop_rate=0.5, use_max_out_over_time=False, timesteps = 20):
+                 num_cls=1000, drop_rate=0.5, use_max_out_over_time=False, timesteps = 20, direct=False, encoder='poisson', encoder_seed=None):
         super(SNN_VGG9_TBN, self).__init__()
 
         # ConvSNN architecture parameters
         self.img_size = img_size
+        self.direct = direct
+        self.encoder = build_encoder(encoder, encoder_seed)
         self.inp_maps = inp_maps
         self.c1_maps = 64
         self.c1_dim = self.img_size
@@ -314,165 +303,92 @@ class SNN_VGG9_TBN(nn.Module):
         torch.nn.init.xavier_uniform_(self.fc2.weight)
 
 
-    def forward(self, inp, count_active_layers = False, report_activity = False):
-
-        active_layer_count = 9
-        if count_active_layers == True:
-            return active_layer_count
-        activity = torch.zeros(active_layer_count).cuda()
+    def forward(self, inp):
 
         # avg_spike_time = []
         # Initialize the neuronal membrane potentials and dropout masks
         batch_size = inp.size(0)
-        mem_conv1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv1_1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv2 = torch.zeros(batch_size, 128, self.img_size//2, self.img_size//2).cuda()
-        mem_conv3 = torch.zeros(batch_size, 128, self.img_size//2, self.img_size//2).cuda()
-        mem_conv4 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-        mem_conv5 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-        mem_conv6 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-
-
+        # membranes start at rest, lif_step allocates them on the first timestep
+        mem_conv1 = mem_conv1_1 = mem_conv2 = mem_conv3 = mem_conv4 = mem_conv5 = mem_conv6 = None
+        mem_fc1 = None
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
 
-        mem_fc1 = torch.zeros(batch_size, 1024).cuda()
-        mem_fc2 = torch.zeros(batch_size, self.num_cls).cuda()
+        fc_dropout_mask = self.drop(torch.ones([batch_size, 1024], device=inp.device))
 
-        fc_dropout_mask = self.drop(torch.ones([batch_size, 1024]).cuda())
+        input_current = InputCurrent(self.conv1, inp, self.direct, self.encoder)
 
         for t in range(self.num_steps):
-            spike_inp = PoissonGen(inp)
-            activity[0] += torch.count_nonzero(spike_inp.detach())/torch.numel(spike_inp.detach())
-            # # spike_x = torch.cat([spike_inp]*22,1)[:,:64,:,:]
-            # out_prev = spike_inp
-            #
             # Compute the conv1 outputs
-            mem_thr   = (mem_conv1/self.conv1.threshold) - 1.0
-            out       = self.spike_fn(mem_thr)
-            rst       = torch.zeros_like(mem_conv1).cuda()
-            rst[mem_thr>0] = self.conv1.threshold
-            mem_conv1 = (self.leak_mem*mem_conv1 + self.bn1_list[int(t/self.one_stamp)](self.conv1(spike_inp)) -rst)
-            out_prev  = out.clone()
-
-            activity[1] += torch.count_nonzero(out_prev.detach())/torch.numel(out_prev.detach())
+            current = input_current(t)
+            out_prev, mem_conv1 = lif_step(self.bn1_list[int(t/self.one_stamp)](current), mem_conv1, self.leak_mem, self.conv1.threshold, self.grad_type, fire_first=True)
+
             # Compute the conv1_1 outputs
-            mem_thr = (mem_conv1_1 / self.conv1_1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv1_1).cuda()
-            rst[mem_thr > 0] = self.conv1_1.threshold
-            mem_conv1_1 = (self.leak_mem * mem_conv1_1 + self.bn1_1_list[int(t/self.one_stamp)](self.conv1_1(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv1_1 = lif_step(self.bn1_1_list[int(t/self.one_stamp)](self.conv1_1(out_prev)), mem_conv1_1, self.leak_mem, self.conv1_1.threshold, self.grad_type, fire_first=True)
 
 
             # Compute the avgpool1 outputs
-            out =  self.pool1(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool1(out_prev)
 
             # mem_thr = (mem_pool1 / self.pool1.threshold) - 1.0
             # out = self.spike_pool(mem_thr)
-            # rst = torch.zeros_like(mem_pool1).cuda()
+            # rst = torch.zeros_like(mem_pool1)
             # rst[mem_thr > 0] = self.pool1.threshold
             # mem_pool1 = mem_pool1 + self.pool1(out_prev) - rst
             # out_prev = out.clone()
 
 
-            activity[2] += torch.count_nonzero(out_prev.detach())/torch.numel(out_prev.detach())
             # Compute the conv2 outputs
-            mem_thr   = (mem_conv2/self.conv2.threshold) - 1.0
-            out       = self.spike_fn(mem_thr)
-            rst       = torch.zeros_like(mem_conv2).cuda()
-            rst[mem_thr>0] = self.conv2.threshold
-            mem_conv2 = (self.leak_mem*mem_conv2 + self.bn2_list[int(t/self.one_stamp)](self.conv2(out_prev)) -rst)
-            out_prev  = out.clone()
+            out_prev, mem_conv2 = lif_step(self.bn2_list[int(t/self.one_stamp)](self.conv2(out_prev)), mem_conv2, self.leak_mem, self.conv2.threshold, self.grad_type, fire_first=True)
 
 
-            activity[3] += torch.count_nonzero(out_prev.detach())/torch.numel(out_prev.detach())
             # Compute the conv3 outputs
-            mem_thr = (mem_conv3 / self.conv3.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv3).cuda()
-            rst[mem_thr > 0] = self.conv3.threshold
-            mem_conv3 = (self.leak_mem * mem_conv3 + self.bn3_list[int(t/self.one_stamp)](self.conv3(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv3 = lif_step(self.bn3_list[int(t/self.one_stamp)](self.conv3(out_prev)), mem_conv3, self.leak_mem, self.conv3.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool2 outputs
-            out = self.pool2(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool2(out_prev)
             # mem_thr = (mem_pool2 / self.pool2.threshold) - 1.0
             # out = self.spike_pool(mem_thr)
-            # rst = torch.zeros_like(mem_pool2).cuda()
+            # rst = torch.zeros_like(mem_pool2)
             # rst[mem_thr > 0] = self.pool2.threshold
             # mem_pool2 = mem_pool2 + self.pool2(out_prev) - rst
             # out_prev = out.clone()
 
 
-            activity[4] += torch.count_nonzero(out_prev.detach())/torch.numel(out_prev.detach())
             # Compute the conv4 outputs
-            mem_thr = (mem_conv4 / self.conv4.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv4).cuda()
-            rst[mem_thr > 0] = self.conv4.threshold
-            mem_conv4 = (self.leak_mem * mem_conv4 + self.bn4_list[int(t/self.one_stamp)](self.conv4(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv4 = lif_step(self.bn4_list[int(t/self.one_stamp)](self.conv4(out_prev)), mem_conv4, self.leak_mem, self.conv4.threshold, self.grad_type, fire_first=True)
 
 
-            activity[5] += torch.count_nonzero(out_prev.detach())/torch.numel(out_prev.detach())
             # Compute the conv5 outputs
-            mem_thr = (mem_conv5 / self.conv5.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv5).cuda()
-            rst[mem_thr > 0] = self.conv5.threshold
-            mem_conv5 = (self.leak_mem * mem_conv5 + self.bn5_list[int(t/self.one_stamp)](self.conv5(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv5 = lif_step(self.bn5_list[int(t/self.one_stamp)](self.conv5(out_prev)), mem_conv5, self.leak_mem, self.conv5.threshold, self.grad_type, fire_first=True)
 
 
-            activity[6] += torch.count_nonzero(out_prev.detach())/torch.numel(out_prev.detach())
             # Compute the conv6 outputs
-            mem_thr = (mem_conv6 / self.conv6.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv6).cuda()
-            rst[mem_thr > 0] = self.conv6.threshold
-            mem_conv6 = (self.leak_mem * mem_conv6 + self.bn6_list[int(t/self.one_stamp)](self.conv6(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv6 = lif_step(self.bn6_list[int(t/self.one_stamp)](self.conv6(out_prev)), mem_conv6, self.leak_mem, self.conv6.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool3 outputs
-            out = self.pool3(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool3(out_prev)
             # mem_thr = (mem_pool3 / self.pool3.threshold) - 1.0
             # out = self.spike_pool(mem_thr)
-            # rst = torch.zeros_like(mem_pool3).cuda()
+            # rst = torch.zeros_like(mem_pool3)
             # rst[mem_thr > 0] = self.pool3.threshold
             # mem_pool3 = mem_pool3 + self.pool3(out_prev) - rst
             # out_prev = out.clone()
 
 
-            activity[7] += torch.count_nonzero(out_prev.detach())/torch.numel(out_prev.detach())
             out_prev = out_prev.reshape(batch_size, -1)
             # compute fc1
-            mem_thr = (mem_fc1 / self.fc1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_fc1).cuda()
-            rst[mem_thr > 0] = self.fc1.threshold
-            mem_fc1 = (self.leak_mem * mem_fc1 + self.bnfc_list[int(t/self.one_stamp)](self.fc1(out_prev)) - rst)
+            out_prev, mem_fc1 = lif_step(self.bnfc_list[int(t/self.one_stamp)](self.fc1(out_prev)), mem_fc1, self.leak_mem, self.fc1.threshold, self.grad_type, fire_first=True)
             # mem_fc1 = (self.leak_mem * mem_fc1 + (self.fc1(out_prev)) - rst)
 
-            out_prev = out.clone()
-
             # out_prev = fc_dropout_mask *out_prev
 
             # # TODO last spike expectation
             # avg_spike = out_prev.sum(1).sum(0) / out_prev.size(1) / out_prev.size(0)
             # avg_spike_time.append(float(avg_spike.cpu().data.numpy()))
 
-            activity[8] += torch.count_nonzero(out_prev.detach())/torch.numel(out_prev.detach())
             # compute fc1
             mem_fc2 = (1 * mem_fc2 + self.fc2(out_prev))
 
-        print(activity)
-        activity = [x / self.num_steps for x in activity]
-        print(activity)
-        if report_activity:
-            return activity
-
         out_voltage  = mem_fc2
         out_voltage = (out_voltage) / self.num_steps
 
@@ -489,11 +405,13 @@ class SNN_VGG9_TBN(nn.Module):
 class SNN_VGG16_TBN(nn.Module):
     def __init__(self, dt=0.001, t_end=0.100, inp_rate=100, grad_type='Linear', thresh_init_wnorm=False,
                  leak_mem=0.99, img_size=32, inp_maps=3, c1_maps=64, c2_maps=64, ksize=3, fc0_size=200,
-                 num_cls=1000, drop_rate=0.5, use_max_out_over_time=False, timesteps = 20):
+                 num_cls=1000, drop_rate=0.5, use_max_out_over_time=False, timesteps = 20, direct=False, encoder='poisson', encoder_seed=None):
         super(SNN_VGG16_TBN, self).__init__()
 
         # ConvSNN architecture parameters
         self.img_size = img_size
+        self.direct = direct
+        self.encoder = build_encoder(encoder, encoder_seed)
         self.inp_maps = inp_maps
         self.c1_maps = 64
         self.c1_dim = self.img_size
@@ -600,8 +518,8 @@ class SNN_VGG16_TBN(nn.Module):
                 if (self.thresh_init_wnorm):
                     lnorm = LA.norm(m.weight.data, self.lnorm_ord)
                     thresh_init = lnorm * self.scale_thresh
-                    m.threshold = torch.from_numpy(np.array([thresh_init])).float().cuda()
-                    print('Wl{}norm: {:.2f}; Threshold: {:.2f}\n'.format(self.lnorm_ord, lnorm, m.threshold[0]))
+                    m.threshold = float(thresh_init)
+                    print('Wl{}norm: {:.2f}; Threshold: {:.2f}\n'.format(self.lnorm_ord, lnorm, m.threshold))
 
         # Instantiate differentiable spiking nonlinearity
         self.spike_fn = init_spike_fn(self.grad_type)
@@ -617,177 +535,80 @@ class SNN_VGG16_TBN(nn.Module):
         # avg_spike_time = []
         # Initialize the neuronal membrane potentials and dropout masks
         batch_size = inp.size(0)
-        mem_conv1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv1_1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-
-        mem_conv2 = torch.zeros(batch_size, 128, self.img_size//2, self.img_size//2).cuda()
-        mem_conv3 = torch.zeros(batch_size, 128, self.img_size//2, self.img_size//2).cuda()
-
-        mem_conv4 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-        mem_conv5 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-        mem_conv6 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-
-        mem_conv7 = torch.zeros(batch_size, 512, self.img_size//8, self.img_size//8).cuda()
-        mem_conv8 = torch.zeros(batch_size, 512, self.img_size//8, self.img_size//8).cuda()
-        mem_conv9 = torch.zeros(batch_size, 512, self.img_size//8, self.img_size//8).cuda()
-
-        mem_conv10 = torch.zeros(batch_size, 512, self.img_size//16, self.img_size//16).cuda()
-        mem_conv11 = torch.zeros(batch_size, 512, self.img_size//16, self.img_size//16).cuda()
-        mem_conv12 = torch.zeros(batch_size, 512, self.img_size//16, self.img_size//16).cuda()
-
+        # membranes start at rest, lif_step allocates them on the first timestep
+        mem_conv1 = mem_conv1_1 = mem_conv2 = mem_conv3 = mem_conv4 = mem_conv5 = mem_conv6 = mem_conv7 = mem_conv8 = mem_conv9 = mem_conv10 = mem_conv11 = mem_conv12 = None
+        mem_fc1 = None
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
 
 
-
-
-        mem_fc1 = torch.zeros(batch_size, 4096).cuda()
-        mem_fc2 = torch.zeros(batch_size, self.num_cls).cuda()
-
+        input_current = InputCurrent(self.conv1, inp, self.direct, self.encoder)
 
         for t in range(self.num_steps):
-            spike_inp = PoissonGen(inp)
-            # spike_x = torch.cat([spike_inp]*22,1)[:,:64,:,:]
-            out_prev = spike_inp
-
             # Compute the conv1 outputs
-            mem_thr   = (mem_conv1/self.conv1.threshold) - 1.0
-            out       = self.spike_fn(mem_thr)
-            rst       = torch.zeros_like(mem_conv1).cuda()
-            rst[mem_thr>0] = self.conv1.threshold
-            mem_conv1 = (self.leak_mem*mem_conv1 + self.bn1_list[int(t/self.one_stamp)](self.conv1(out_prev)) -rst)
-            out_prev  = out.clone()
+            out_prev, mem_conv1 = lif_step(self.bn1_list[int(t/self.one_stamp)](input_current(t)), mem_conv1, self.leak_mem, self.conv1.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv1_1 outputs
-            mem_thr = (mem_conv1_1 / self.conv1_1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv1_1).cuda()
-            rst[mem_thr > 0] = self.conv1_1.threshold
-            mem_conv1_1 = (self.leak_mem * mem_conv1_1 + self.bn1_1_list[int(t/self.one_stamp)](self.conv1_1(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv1_1 = lif_step(self.bn1_1_list[int(t/self.one_stamp)](self.conv1_1(out_prev)), mem_conv1_1, self.leak_mem, self.conv1_1.threshold, self.grad_type, fire_first=True)
 
 
             # Compute the avgpool1 outputs
-            out = self.pool1(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool1(out_prev)
 
 
 
             # Compute the conv2 outputs
-            mem_thr   = (mem_conv2/self.conv2.threshold) - 1.0
-            out       = self.spike_fn(mem_thr)
-            rst       = torch.zeros_like(mem_conv2).cuda()
-            rst[mem_thr>0] = self.conv2.threshold
-            mem_conv2 = (self.leak_mem*mem_conv2 + self.bn2_list[int(t/self.one_stamp)](self.conv2(out_prev)) -rst)
-            out_prev  = out.clone()
+            out_prev, mem_conv2 = lif_step(self.bn2_list[int(t/self.one_stamp)](self.conv2(out_prev)), mem_conv2, self.leak_mem, self.conv2.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv3 outputs
-            mem_thr = (mem_conv3 / self.conv3.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv3).cuda()
-            rst[mem_thr > 0] = self.conv3.threshold
-            mem_conv3 = (self.leak_mem * mem_conv3 + self.bn3_list[int(t/self.one_stamp)](self.conv3(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv3 = lif_step(self.bn3_list[int(t/self.one_stamp)](self.conv3(out_prev)), mem_conv3, self.leak_mem, self.conv3.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool2 outputs
-            out = self.pool2(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool2(out_prev)
 
             # Compute the conv4 outputs
-            mem_thr = (mem_conv4 / self.conv4.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv4).cuda()
-            rst[mem_thr > 0] = self.conv4.threshold
-            mem_conv4 = (self.leak_mem * mem_conv4 + self.bn4_list[int(t/self.one_stamp)](self.conv4(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv4 = lif_step(self.bn4_list[int(t/self.one_stamp)](self.conv4(out_prev)), mem_conv4, self.leak_mem, self.conv4.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv5 outputs
-            mem_thr = (mem_conv5 / self.conv5.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv5).cuda()
-            rst[mem_thr > 0] = self.conv5.threshold
-            mem_conv5 = (self.leak_mem * mem_conv5 + self.bn5_list[int(t/self.one_stamp)](self.conv5(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv5 = lif_step(self.bn5_list[int(t/self.one_stamp)](self.conv5(out_prev)), mem_conv5, self.leak_mem, self.conv5.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv6 outputs
-            mem_thr = (mem_conv6 / self.conv6.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv6).cuda()
-            rst[mem_thr > 0] = self.conv6.threshold
-            mem_conv6 = (self.leak_mem * mem_conv6 + self.bn6_list[int(t/self.one_stamp)](self.conv6(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv6 = lif_step(self.bn6_list[int(t/self.one_stamp)](self.conv6(out_prev)), mem_conv6, self.leak_mem, self.conv6.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool3 outputs
-            out = self.pool3(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool3(out_prev)
 
 
 
             # Compute the conv7 outputs
-            mem_thr = (mem_conv7 / self.conv7.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv7).cuda()
-            rst[mem_thr > 0] = self.conv7.threshold
-            mem_conv7 = (self.leak_mem * mem_conv7 + self.bn7_list[int(t / self.one_stamp)](self.conv7(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv7 = lif_step(self.bn7_list[int(t / self.one_stamp)](self.conv7(out_prev)), mem_conv7, self.leak_mem, self.conv7.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv8 outputs
-            mem_thr = (mem_conv8 / self.conv8.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv8).cuda()
-            rst[mem_thr > 0] = self.conv8.threshold
-            mem_conv8 = (self.leak_mem * mem_conv8 + self.bn8_list[int(t / self.one_stamp)](self.conv8(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv8 = lif_step(self.bn8_list[int(t / self.one_stamp)](self.conv8(out_prev)), mem_conv8, self.leak_mem, self.conv8.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv9 outputs
-            mem_thr = (mem_conv9 / self.conv9.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv9).cuda()
-            rst[mem_thr > 0] = self.conv9.threshold
-            mem_conv9 = (self.leak_mem * mem_conv9 + self.bn9_list[int(t / self.one_stamp)](self.conv9(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv9 = lif_step(self.bn9_list[int(t / self.one_stamp)](self.conv9(out_prev)), mem_conv9, self.leak_mem, self.conv9.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool4 outputs
-            out = self.pool4(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool4(out_prev)
 
 
 
             # Compute the conv10 outputs
-            mem_thr = (mem_conv10 / self.conv10.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv10).cuda()
-            rst[mem_thr > 0] = self.conv10.threshold
-            mem_conv10 = (self.leak_mem * mem_conv10 + self.bn10_list[int(t / self.one_stamp)](self.conv10(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv10 = lif_step(self.bn10_list[int(t / self.one_stamp)](self.conv10(out_prev)), mem_conv10, self.leak_mem, self.conv10.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv11 outputs
-            mem_thr = (mem_conv11 / self.conv11.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv11).cuda()
-            rst[mem_thr > 0] = self.conv11.threshold
-            mem_conv11 = (self.leak_mem * mem_conv11 + self.bn11_list[int(t / self.one_stamp)](self.conv11(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv11 = lif_step(self.bn11_list[int(t / self.one_stamp)](self.conv11(out_prev)), mem_conv11, self.leak_mem, self.conv11.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv12 outputs
-            mem_thr = (mem_conv12 / self.conv12.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv12).cuda()
-            rst[mem_thr > 0] = self.conv12.threshold
-            mem_conv12 = (self.leak_mem * mem_conv12 + self.bn12_list[int(t / self.one_stamp)](self.conv12(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv12 = lif_step(self.bn12_list[int(t / self.one_stamp)](self.conv12(out_prev)), mem_conv12, self.leak_mem, self.conv12.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool5 outputs
-            out = self.pool5(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool5(out_prev)
 
             out_prev = out_prev.reshape(batch_size, -1)
 
             # compute fc1
-            mem_thr = (mem_fc1 / self.fc1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_fc1).cuda()
-            rst[mem_thr > 0] = self.fc1.threshold
-            mem_fc1 = (self.leak_mem * mem_fc1 + self.bnfc_list[int(t/self.one_stamp)](self.fc1(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_fc1 = lif_step(self.bnfc_list[int(t/self.one_stamp)](self.fc1(out_prev)), mem_fc1, self.leak_mem, self.fc1.threshold, self.grad_type, fire_first=True)
 
             # # TODO last spike expectation
             # avg_spike = out_prev.sum(1).sum(0) / out_prev.size(1) / out_prev.size(0)
@@ -838,11 +659,13 @@ class AverageMeter(object):
 class SNN_VGG11_TBN(nn.Module):
     def __init__(self, dt=0.001, t_end=0.100, inp_rate=100, grad_type='Linear', thresh_init_wnorm=False,
                  leak_mem=0.99, img_size=32, inp_maps=3, c1_maps=64, c2_maps=64, ksize=3, fc0_size=200,
-                 num_cls=1000, drop_rate=0.5, use_max_out_over_time=False):
+                 num_cls=1000, drop_rate=0.5, use_max_out_over_time=False, direct=False, encoder='poisson', encoder_seed=None):
         super(SNN_VGG11_TBN, self).__init__()
 
         # ConvSNN architecture parameters
         self.img_size = img_size
+        self.direct = direct
+        self.encoder = build_encoder(encoder, encoder_seed)
         self.inp_maps = inp_maps
         self.c1_maps = 64
         self.c1_dim = self.img_size
@@ -956,116 +779,61 @@ class SNN_VGG11_TBN(nn.Module):
         # avg_spike_time = []
         # Initialize the neuronal membrane potentials and dropout masks
         batch_size = inp.size(0)
-        mem_conv1 = torch.zeros(batch_size, 64, self.img_size, self.img_size).cuda()
-        mem_conv2 = torch.zeros(batch_size, 128, self.img_size//2, self.img_size//2).cuda()
-        mem_conv3 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-        mem_conv4 = torch.zeros(batch_size, 256, self.img_size//4, self.img_size//4).cuda()
-        mem_conv5 = torch.zeros(batch_size, 512, self.img_size//8, self.img_size//8).cuda()
-        mem_conv6 = torch.zeros(batch_size, 512, self.img_size//8, self.img_size//8).cuda()
-        mem_conv7 = torch.zeros(batch_size, 512, self.img_size // 16, self.img_size // 16).cuda()
-        mem_conv8 = torch.zeros(batch_size, 512, self.img_size // 16, self.img_size // 16).cuda()
+        # membranes start at rest, lif_step allocates them on the first timestep
+        mem_conv1 = mem_conv2 = mem_conv3 = mem_conv4 = mem_conv5 = mem_conv6 = mem_conv7 = mem_conv8 = None
+        mem_fc1 = None
+        mem_fc2 = torch.zeros(batch_size, self.num_cls, device=inp.device)
 
+        fc_dropout_mask = self.drop(torch.ones([batch_size, 1024], device=inp.device))
 
-        mem_fc1 = torch.zeros(batch_size, 4*1024).cuda()
-        mem_fc2 = torch.zeros(batch_size, self.num_cls).cuda()
-
-        fc_dropout_mask = self.drop(torch.ones([batch_size, 1024]).cuda())
+        input_current = InputCurrent(self.conv1, inp, self.direct, self.encoder)
 
         for t in range(self.num_steps):
-            spike_inp = PoissonGen(inp)
-            # spike_x = torch.cat([spike_inp]*22,1)[:,:64,:,:]
-            out_prev = spike_inp
-
             # Compute the conv1 outputs
-            mem_thr   = (mem_conv1/self.conv1.threshold) - 1.0
-            out       = self.spike_fn(mem_thr)
-            rst       = torch.zeros_like(mem_conv1).cuda()
-            rst[mem_thr>0] = self.conv1.threshold
-            mem_conv1 = (self.leak_mem*mem_conv1 + self.bn1_list[int(t/self.one_stamp)](self.conv1(out_prev)) -rst)
-            out_prev  = out.clone()
+            out_prev, mem_conv1 = lif_step(self.bn1_list[int(t/self.one_stamp)](input_current(t)), mem_conv1, self.leak_mem, self.conv1.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool1 outputs
-            out =  self.pool1(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool1(out_prev)
 
 
             # Compute the conv2 outputs
-            mem_thr   = (mem_conv2/self.conv2.threshold) - 1.0
-            out       = self.spike_fn(mem_thr)
-            rst       = torch.zeros_like(mem_conv2).cuda()
-            rst[mem_thr>0] = self.conv2.threshold
-            mem_conv2 = (self.leak_mem*mem_conv2 + self.bn2_list[int(t/self.one_stamp)](self.conv2(out_prev)) -rst)
-            out_prev  = out.clone()
+            out_prev, mem_conv2 = lif_step(self.bn2_list[int(t/self.one_stamp)](self.conv2(out_prev)), mem_conv2, self.leak_mem, self.conv2.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool2 outputs
-            out = self.pool2(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool2(out_prev)
 
 
 
             # Compute the conv3 outputs
-            mem_thr = (mem_conv3 / self.conv3.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv3).cuda()
-            rst[mem_thr > 0] = self.conv3.threshold
-            mem_conv3 = (self.leak_mem * mem_conv3 + self.bn3_list[int(t/self.one_stamp)](self.conv3(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv3 = lif_step(self.bn3_list[int(t/self.one_stamp)](self.conv3(out_prev)), mem_conv3, self.leak_mem, self.conv3.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv4 outputs
-            mem_thr = (mem_conv4 / self.conv4.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv4).cuda()
-            rst[mem_thr > 0] = self.conv4.threshold
-            mem_conv4 = (self.leak_mem * mem_conv4 + self.bn4_list[int(t/self.one_stamp)](self.conv4(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv4 = lif_step(self.bn4_list[int(t/self.one_stamp)](self.conv4(out_prev)), mem_conv4, self.leak_mem, self.conv4.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool3 outputs
-            out = self.pool3(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool3(out_prev)
 
 
 
             # Compute the conv5 outputs
-            mem_thr = (mem_conv5 / self.conv5.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv5).cuda()
-            rst[mem_thr > 0] = self.conv5.threshold
-            mem_conv5 = (self.leak_mem * mem_conv5 + self.bn5_list[int(t/self.one_stamp)](self.conv5(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv5 = lif_step(self.bn5_list[int(t/self.one_stamp)](self.conv5(out_prev)), mem_conv5, self.leak_mem, self.conv5.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv6 outputs
-            mem_thr = (mem_conv6 / self.conv6.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv6).cuda()
-            rst[mem_thr > 0] = self.conv6.threshold
-            mem_conv6 = (self.leak_mem * mem_conv6 + self.bn6_list[int(t/self.one_stamp)](self.conv6(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv6 = lif_step(self.bn6_list[int(t/self.one_stamp)](self.conv6(out_prev)), mem_conv6, self.leak_mem, self.conv6.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool4 outputs
-            out = self.pool4(out_prev)
-            out_prev = out.clone()
+            out_prev = self.pool4(out_prev)
 
 
 
             # Compute the conv7 outputs
-            mem_thr = (mem_conv7 / self.conv7.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv7).cuda()
-            rst[mem_thr > 0] = self.conv7.threshold
-            mem_conv7 = (self.leak_mem * mem_conv7 + self.bn7_list[int(t / self.one_stamp)](self.conv7(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv7 = lif_step(self.bn7_list[int(t / self.one_stamp)](self.conv7(out_prev)), mem_conv7, self.leak_mem, self.conv7.threshold, self.grad_type, fire_first=True)
 
             # Compute the conv8 outputs
-            mem_thr = (mem_conv8 / self.conv8.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_conv8).cuda()
-            rst[mem_thr > 0] = self.conv8.threshold
-            mem_conv8 = (self.leak_mem * mem_conv8 + self.bn8_list[int(t / self.one_stamp)](self.conv8(out_prev)) - rst)
-            out_prev = out.clone()
+            out_prev, mem_conv8 = lif_step(self.bn8_list[int(t / self.one_stamp)](self.conv8(out_prev)), mem_conv8, self.leak_mem, self.conv8.threshold, self.grad_type, fire_first=True)
 
             # Compute the avgpool5 outputs
-            out = self.avg_pool(out_prev)
-            out_prev = out.clone()
+            out_prev = self.avg_pool(out_prev)
 
 
 
@@ -1074,13 +842,7 @@ class SNN_VGG11_TBN(nn.Module):
             
 
             # compute fc1
-            mem_thr = (mem_fc1 / self.fc1.threshold) - 1.0
-            out = self.spike_fn(mem_thr)
-            rst = torch.zeros_like(mem_fc1).cuda()
-            rst[mem_thr > 0] = self.fc1.threshold
-            mem_fc1 = (self.leak_mem * mem_fc1 + self.bnfc_list[int(t/self.one_stamp)](self.fc1(out_prev)) - rst)
-
-            out_prev = out.clone()
+            out_prev, mem_fc1 = lif_step(self.bnfc_list[int(t/self.one_stamp)](self.fc1(out_prev)), mem_fc1, self.leak_mem, self.fc1.threshold, self.grad_type, fire_first=True)
 
             # compute fc1
             mem_fc2 = (1 * mem_fc2 + self.fc2(out_prev))
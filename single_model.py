@@ -14,7 +14,8 @@ import torch
 import torch.nn as nn
 
 from utils.sampling import mnist_iid, mnist_non_iid, cifar_iid, cifar_non_iid, mnist_dvs_iid, mnist_dvs_non_iid, nmnist_iid, nmnist_non_iid
-from utils.options import args_parser
+from utils.options import args_parser, snn_model_options
+from utils.device import setup_device, model_to_device, to_device, autocast
 from torch.utils.data import DataLoader, Dataset, RandomSampler
 from models.test import test_img
 import models.vgg as ann_models
@@ -51,10 +52,7 @@ if __name__ == '__main__':
     args = args_parser()
     torch.manual_seed(args.seed)
     np.random.seed(args.seed)
-    args.device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() and args.gpu != -1 else 'cpu')
-    if args.device != 'cpu':
-        torch.backends.cudnn.deterministic = True
-        torch.backends.cudnn.benchmark = False
+    setup_device(args)
     # torch.set_default_tensor_type('torch.cuda.FloatTensor')
 
     dataset_keys = None
@@ -108,33 +106,33 @@ if __name__ == '__main__':
     model_args = {'args': args}
     if args.model[0:3].lower() == 'vgg':
         if args.snn:
-            model_args = {'num_cls': args.num_classes, 'timesteps': max_timestep}
-            net = snn_models_bntt.SNN_VGG9_BNTT(**model_args).cuda()
+            model_args = {'num_cls': args.num_classes, 'timesteps': max_timestep, **snn_model_options(args)}
+            net = model_to_device(snn_models_bntt.SNN_VGG9_BNTT(**model_args), args)
         else:
             model_args = {'vgg_name': args.model, 'labels': args.num_classes, 'dataset': args.dataset, 'kernel_size': 3, 'dropout': args.dropout}
-            net = ann_models.VGG(**model_args).cuda()
+            net = model_to_device(ann_models.VGG(**model_args), args)
     elif args.model[0:6].lower() == 'resnet':
         if args.snn:
             pass
         else:
             model_args = {'num_cls': args.num_classes}
-            net = resnet_models.Network(**model_args).cuda()
+            net = model_to_device(resnet_models.Network(**model_args), args)
     elif args.model == 'simple':
-        model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps, 'img_size': args.img_size}
+        model_args = {'num_cls': args.num_classes, 'timesteps': args.timesteps, 'img_size': args.img_size, **snn_model_options(args)}
         if args.dataset == 'MNIST' or args.dataset == 'EMNIST':
             if args.bntt:
                 model_args['leak_mem'] = 0.5
-                net = Simple_Mnist_BNTT(**model_args).cuda()
+                net = model_to_device(Simple_Mnist_BNTT(**model_args), args)
             else:
                 model_args['leak_mem'] = 0.5
-                net = Simple_Mnist_NoBNTT(**model_args).cuda()
+                net = model_to_device(Simple_Mnist_NoBNTT(**model_args), args)
         else:
             if args.bntt:
                 model_args['leak_mem'] = 0.5
-                net = Simple_CF10_BNTT(**model_args).cuda()
+                net = model_to_device(Simple_CF10_BNTT(**model_args), args)
             else:
                 model_args['leak_mem'] = 0.5
-                net = VGG5_CF10_NoBNTT(**model_args).cuda()
+                net = model_to_device(VGG5_CF10_NoBNTT(**model_args), args)
     else:
         exit('Error: unrecognized model')
     # print(net)
@@ -199,11 +197,12 @@ if __name__ == '__main__':
             print("local epoch: ", local_ep)
             batch_loss = []
             for batch_idx, (images, labels) in enumerate(ldr_train):
-                images, labels = images.to(args.device), labels.to(args.device)
+                images, labels = to_device(images, args), labels.to(args.device)
                 trained_data_size += len(images)
                 net.zero_grad()
-                log_probs = net(images)
-                loss = loss_func(log_probs, labels)
+                with autocast(args):
+                    log_probs = net(images)
+                    loss = loss_func(log_probs, labels)
                 loss.backward()
                 optimizer.step()
                 if args.verbose and batch_idx % 10 == 0:
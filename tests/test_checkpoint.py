@@ -0,0 +1,24 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from models.vgg_spiking_bntt import SNN_VGG9_BNTT
+
+
+def gradients(**checkpoint):
+    torch.manual_seed(0)
+    net = SNN_VGG9_BNTT(timesteps=4, img_size=16, encoder_seed=5, **checkpoint).double()
+    images = torch.rand(4, 3, 16, 16, dtype=torch.float64) * 2 - 1
+    labels = torch.arange(4)
+    F.cross_entropy(net(images), labels).backward()
+    return [p.grad for p in net.parameters() if p.grad is not None]
+
+
+@pytest.mark.parametrize('checkpoint', [{'checkpoint_timesteps': 2}, {'checkpoint_layers': 2}])
+def test_checkpoint_seeded_encoder_gradients(checkpoint):
+    # the recomputation must draw the same Poisson spikes as the forward
+    plain = gradients()
+    checkpointed = gradients(**checkpoint)
+    assert len(plain) == len(checkpointed)
+    for g, g_ckpt in zip(plain, checkpointed):
+        assert torch.allclose(g, g_ckpt)
@@ -0,0 +1,35 @@
+import pytest
+import torch
+
+from models.vgg_spiking_bntt import SNN_VGG9_BNTT
+from models.encoding import RateEncoder
+from models.export import calibrate_running_stats
+
+
+def make_net():
+    torch.manual_seed(0)
+    # float64 and deterministic rate coding, so a sample gives the same output in any batch
+    net = SNN_VGG9_BNTT(timesteps=8, img_size=16).double().eval()
+    net.encoder = RateEncoder()
+    images = torch.rand(6, 3, 16, 16, dtype=torch.float64)
+    return net, images
+
+
+def test_early_exit_needs_running_stats():
+    net, images = make_net()
+    with pytest.raises(SystemExit):
+        net.forward_early_exit(images, 0.2, 1)
+
+
+def test_early_exit_single_sample_left():
+    net, images = make_net()
+    calibrate_running_stats(net, [images])
+    with torch.no_grad():
+        out, timesteps = net.forward_early_exit(images, 0.2, 1)
+        # the last timesteps run on one sample only
+        last = timesteps.sort().values
+        assert last[-1] > last[-2]
+        for i in range(images.size(0)):
+            out_single, timesteps_single = net.forward_early_exit(images[i:i + 1], 0.2, 1)
+            assert timesteps_single.item() == timesteps[i].item()
+            assert torch.allclose(out_single[0], out[i])
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Python version: 3.6
+
+import torch
+
+
+def setup_device(args):
+    """
+    Resolve args.device from --gpu and configure the backend for it.
+    On CPU this applies the thread counts and enables oneDNN (mkldnn) so
+    that channels_last convolutions run on the optimised kernels.
+    :param args: parsed command line arguments
+    :return: the selected torch.device
+    """
+    args.device = torch.device('cuda:{}'.format(args.gpu) if torch.cuda.is_available() and args.gpu != -1 else 'cpu')
+    if args.device.type == 'cuda':
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+    else:
+        if args.num_threads:
+            torch.set_num_threads(args.num_threads)
+        if args.num_interop_threads:
+            torch.set_num_interop_threads(args.num_interop_threads)
+        torch.backends.mkldnn.enabled = True
+        print("Running on CPU with {} threads, channels_last {}".format(torch.get_num_threads(), args.channels_last))
+    return args.device
+
+
+def model_to_device(net, args):
+    """
+    Move a model to args.device, converting conv weights to channels_last if requested.
+    With --compile the forward of the model (inside a DataParallel wrapper) is compiled with
+    torch.compile in place, so state_dict keys do not change and copies built the same way reuse
+    the compiled graphs.
+    """
+    net = net.to(args.device)
+    if args.channels_last:
+        net = net.to(memory_format=torch.channels_last)
+    if getattr(args, 'compile', False):
+        (net.module if isinstance(net, torch.nn.DataParallel) else net).compile()
+    return net
+
+
+def autocast(args):
+    """
+    Autocast context of the forward passes of training: with --precision bf16 convolutions and
+    matmuls run in bfloat16 on args.device, fp32 otherwise. bfloat16 keeps the fp32 exponent range,
+    so no loss scaling is needed.
+    """
+    return torch.autocast(device_type=args.device.type, dtype=torch.bfloat16,
+                          enabled=getattr(args, 'precision', 'fp32') == 'bf16')
+
+
+def to_device(images, args):
+    """
+    Move a batch of images to args.device in the memory format the model expects.
+    """
+    if args.channels_last and images.dim() == 4:
+        return images.to(args.device, memory_format=torch.channels_last)
+    return images.to(args.device)
@@ -3,6 +3,7 @@
 # Python version: 3.6
 
 import argparse
+import sys
 
 def args_parser():
     parser = argparse.ArgumentParser()
@@ -39,6 +40,12 @@ def args_parser():
     parser.add_argument('--candidate_frac', type=float, default=0.1, help='the fraction of candidates in training: d')
     parser.add_argument('--gamma', type=float, default=2, help='divide the prob by gamma after client is chosen')
     parser.add_argument('--FedAvgWeight', type=str, default=None, help='specify way to apply weighted FedAvg')
+    parser.add_argument('--update_codec', type=str, default='none', choices=['none', 'q8', 'q4', 'q2', 'sign', 'lowrank'], help='compression of the client updates: stochastic 8/4/2-bit quantisation, sign or low-rank factors (main_fed.py)')
+    parser.add_argument('--codec_bucket', type=int, default=512, help='entries per quantisation scale of --update_codec, a multiple of 8')
+    parser.add_argument('--lowrank_rank', type=int, default=4, help='rank of the factors of --update_codec lowrank')
+    parser.add_argument('--error_feedback', action='store_true', help='add the compression error of each client to its next update')
+    parser.add_argument('--ef_dir', type=str, default=None, help='keep the --error_feedback residuals on disk in this directory instead of in memory')
+    parser.add_argument('--stream_aggregation', action='store_true', help='fold every client update into the aggregate as soon as it is trained instead of keeping all of them (main_fed.py: --client_selection random only)')
     parser.add_argument('--timestep_pattern', type=str, default=None, help='timestep pattern for single model')
 
     # model arguments
@@ -51,7 +58,20 @@ def args_parser():
     parser.add_argument('--max_pool', type=str, default='True',
                         help="Whether use max pooling rather than strided convolutions")
     parser.add_argument('--bntt', action='store_true', help='whether use bntt or not')
-    parser.add_argument('--direct', action='store_true', help='whether use direct or rate coding')
+    parser.add_argument('--direct', action='store_true', help='direct coding: feed the image itself at every timestep, conv1 is computed once per batch')
+    parser.add_argument('--encoder', type=str, default='poisson', help='spike encoder of rate-coded SNNs: poisson or rate (deterministic)')
+    parser.add_argument('--encoder_seed', type=int, default=None, help='seed of the encoder random stream, default uses the global RNG')
+    parser.add_argument('--cache_eval_spikes', action='store_true', help='encode a fixed test subset once and replay its bit-packed spike trains at every evaluation')
+    parser.add_argument('--layer_major', action='store_true', help='run SNN layers on all timesteps at once, only the membranes step through time')
+    parser.add_argument('--checkpoint_timesteps', type=int, default=0, help='BNTT SNNs: recompute activations in backward in segments of this many timesteps, 0 to keep all')
+    parser.add_argument('--checkpoint_layers', type=int, default=0, help='BNTT SNNs: recompute activations in backward in segments of this many layers, 0 to keep all')
+    parser.add_argument('--compress_activations', action='store_true', help='BNTT and Simple SNNs: keep the activations saved for backward bit-packed / uint8 instead of float32')
+    parser.add_argument('--tbptt', type=int, default=0, help='BNTT SNNs: truncated BPTT, detach the membranes every this many timesteps (1 for online training), 0 for full BPTT')
+    parser.add_argument('--early_exit_margin', type=float, default=None, help='BNTT SNNs: at test time, stop simulating a sample once the gap between its two largest output voltages exceeds this')
+    parser.add_argument('--early_exit_patience', type=int, default=3, help='consecutive timesteps above --early_exit_margin before a sample exits')
+    parser.add_argument('--quantize', action='store_true', help='SNN_VGG9_BNTT and Simple SNNs: after training, also test the integer (int8 weights, int32 membranes) inference model')
+    parser.add_argument('--calibrate_bntt', action='store_true', help='SNN_VGG9_BNTT: before every evaluation, calibrate per-timestep BNTT statistics so that the test results do not depend on the batch size')
+    parser.add_argument('--calib_batches', type=int, default=10, help='training batches used to calibrate --quantize and --calibrate_bntt')
 
     # other arguments
     parser.add_argument('--dataset', type=str, default='mnist', help="name of dataset")
@@ -60,6 +80,11 @@ def args_parser():
     parser.add_argument('--num_channels', type=int, default=3, help="number of channels of imges")
     parser.add_argument('--img_size', type=int, default=32, help="side length of imgs in pixels")
     parser.add_argument('--gpu', type=int, default=0, help="GPU ID, -1 for CPU")
+    parser.add_argument('--num_threads', type=int, default=None, help="intra-op threads when running on CPU")
+    parser.add_argument('--num_interop_threads', type=int, default=None, help="inter-op threads when running on CPU")
+    parser.add_argument('--channels_last', action='store_true', help="use channels_last memory format for conv inputs and weights")
+    parser.add_argument('--compile', action='store_true', help="compile the model forward with torch.compile (the first batch pays the compile time)")
+    parser.add_argument('--precision', type=str, default='fp32', choices=['fp32', 'bf16'], help="precision of local training, bf16 autocasts convolutions and matmuls (membranes stay fp32)")
     parser.add_argument('--stopping_rounds', type=int, default=10, help='rounds of early stopping')
     parser.add_argument('--verbose', action='store_true', help='verbose print')
     parser.add_argument('--seed', type=int, default=1, help='random seed (default: 1)')
@@ -69,8 +94,19 @@ def args_parser():
     parser.add_argument('--pretrained_model', type=str, default=None, help="Path for the pre-trained mode if any")
     parser.add_argument('--result_dir', type=str, default="results", help="Directory to store results")
     parser.add_argument('--snn', action='store_true', help="Whether to train SNN or ANN")
+    parser.add_argument('--count_ops', action='store_true', help="log MACs, SynOps and energy per inference and of the client training in the metrics CSV")
+    parser.add_argument('--energy_mac', type=float, default=4.6, help="energy of a MAC in pJ for --count_ops (45nm, 32-bit)")
+    parser.add_argument('--energy_ac', type=float, default=0.9, help="energy of an accumulate in pJ for --count_ops (45nm, 32-bit)")
     parser.add_argument('--train_acc_batches', default=200, type=int, help='print training progress after this many batches')
     parser.add_argument('--straggler_prob', type=float, default=0.0, help="straggler probability")
+    parser.add_argument('--buffer_size', type=int, default=5, help='client updates per aggregate of the buffered asynchronous server (async_fed.py)')
+    parser.add_argument('--async_concurrency', type=int, default=0, help='clients training at any time in async_fed.py, 0 for frac * num_users')
+    parser.add_argument('--async_workers', type=int, default=4, help='worker threads that train the clients in async_fed.py')
+    parser.add_argument('--server_lr', type=float, default=1.0, help='step size of the buffered asynchronous server on the mean buffered update')
+    parser.add_argument('--client_speed_sigma', type=float, default=1.0, help='standard deviation of the log-normal speed of the simulated clients')
+    parser.add_argument('--client_delay', type=float, default=0.0, help='real seconds a client sleeps per unit of simulated training time, to emulate slow devices')
+    parser.add_argument('--target_acc', type=float, default=None, help='test accuracy at which async_fed.py stops and reports the time taken')
+    parser.add_argument('--compare_sync', action='store_true', help='also run synchronous FedAvg on the same simulated clock in async_fed.py')
     parser.add_argument('--grad_noise_stdev', type=float, default=0.0, help="Noise level for gradients")
     parser.add_argument('--dvs', action='store_true', help="Whether the input data is DVS")
     parser.add_argument('--modality', type=str, default='aps', help="aps or dvs for the type of data to work on DDD20")
@@ -79,3 +115,40 @@ def args_parser():
 
     args = parser.parse_args()
     return args
+
+
+def client_model_args(model_args, args, round_idx, client):
+    """
+    model_args of the replica a client builds in a round. Replicas are built afresh every round, so
+    with --encoder_seed each (round, client) gets its own encoder stream,
+    encoder_seed + (round + 1) * num_users + client, instead of all of them replaying the noise of
+    encoder_seed; the global model keeps encoder_seed itself. A run stays reproducible for a given seed.
+    """
+    if model_args.get('encoder_seed') is None:
+        return model_args
+    return dict(model_args, encoder_seed=args.encoder_seed + (round_idx + 1) * args.num_users + client)
+
+
+def snn_model_options(args):
+    """
+    Execution options accepted by every SNN model constructor, added to model_args
+    so that client replicas built from model_args run the same way.
+    Without --direct each model keeps its own input coding, and the checkpoint and compression
+    options are only passed when set since only some of the models accept them.
+    """
+    options = {'layer_major': args.layer_major, 'encoder': args.encoder, 'encoder_seed': args.encoder_seed}
+    if args.direct:
+        options['direct'] = True
+    if (args.checkpoint_timesteps or args.checkpoint_layers) and args.model == 'simple' and not args.bntt:
+        # Simple_Mnist_NoBNTT / VGG5_CF10_NoBNTT have no checkpointed forward
+        sys.exit('Error: --checkpoint_timesteps / --checkpoint_layers need a BNTT model, pass --bntt or drop them')
+    if args.early_exit_margin is not None and args.model[0:3].lower() == 'vgg' and not args.calibrate_bntt:
+        # the VGG BNTT layers do not track running stats, and early exit changes the batch as samples exit
+        sys.exit('Error: --early_exit_margin on the VGG SNNs needs --calibrate_bntt')
+    if args.checkpoint_timesteps:
+        options['checkpoint_timesteps'] = args.checkpoint_timesteps
+    if args.checkpoint_layers:
+        options['checkpoint_layers'] = args.checkpoint_layers
+    if args.compress_activations:
+        options['compress_activations'] = True
+    return options